@@ -1,9 +1,18 @@
+from multiprocessing import Pool, cpu_count
+
 import numpy as np
 from sklearn.pipeline import make_pipeline
 from sklearn.preprocessing import Normalizer
 from sklearn.decomposition import TruncatedSVD
-from scipy.spatial.distance import cdist, pdist
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+
+# The k-means fits of the elbow analysis run in parallel, one k per process
+N_JOBS = cpu_count()
+
+# Fits with at least this many clusters use MiniBatchKMeans, which is much
+# faster for large k at the cost of a slightly worse fit (None: never)
+MINI_BATCH_MIN_K = None
+MINI_BATCH_SIZE = 1000
 
 # Load data and transform to Numpy matrix
 
@@ -64,16 +73,37 @@ print "Getting k-means clusters..."
 
 k_range = [1, 10, 20, 30, 40, 50, 60, 70, 80, 90, 100]
 
-# Calculate k-means for all of the specified Ns
-k_means_var = [KMeans(n_clusters=k, init='k-means++').fit(dims_reduced) for k in k_range]
 
-# Calculate the cluster centers for each analysis
-centroids = [X.cluster_centers_ for X in k_means_var]
-k_euclid = [cdist(dims_reduced, cent, 'euclidean') for cent in centroids]
-dist = [np.min(ke, axis=1) for ke in k_euclid]
+def get_wcss(k):
+    """Returns the within-cluster sum of squares of a k-means fit with k
+    clusters: the sum of squared distances to the closest cluster center, which
+    k-means keeps as inertia_.
+
+    Runs in a worker process; dims_reduced is inherited from the parent when
+    the pool is forked, rather than copied to each worker."""
+
+    if MINI_BATCH_MIN_K is not None and k >= MINI_BATCH_MIN_K:
+        k_means = MiniBatchKMeans(n_clusters=k, init='k-means++',
+                                  batch_size=MINI_BATCH_SIZE)
+    else:
+        k_means = KMeans(n_clusters=k, init='k-means++')
+
+    return k_means.fit(dims_reduced).inertia_
+
+
+# Calculate k-means for all of the specified Ns, the slowest (largest k) first
+# so that no worker is left with a long fit at the end
+pool = Pool(min(N_JOBS, len(k_range)))
+k_order = sorted(k_range, reverse=True)
+wcss_by_k = dict(zip(k_order, pool.map(get_wcss, k_order, chunksize=1)))
+pool.close()
+pool.join()
+
+wcss = np.array([wcss_by_k[k] for k in k_range])  # distances to the cluster center: large # --> more variance within clusters
 
-wcss = [sum(d**2) for d in dist]  # distances to the cluster center: large # --> more variance within clusters
-tss = sum(pdist(dims_reduced)**2)/dims_reduced.shape[0]  # total variance (constant)
+# Total variance (constant): the sum of squared pairwise distances over n equals
+# the sum of squared distances to the centroid, without the n x n distances
+tss = ((dims_reduced - dims_reduced.mean(axis=0)) ** 2).sum()
 bss = tss - wcss # Roughly, amount of variance explained by the clustering 
 
 
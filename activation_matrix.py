@@ -0,0 +1,206 @@
+"""Sparse study matrices used to build word and topic intensity maps.
+
+Two matrices share the same study rows (sorted PubMed IDs):
+
+    activations:  studies x surface vertices, the number of times a study
+                  reports activation at each vertex
+    frequencies:  studies x terms, the frequency of each term in each study
+
+A word or topic map is then one sparse matrix-vector product: the studies'
+summed term frequencies, weighted by their activations. The matrices are
+built from the database, or loaded from a file written by running this module:
+
+    python activation_matrix.py
+
+The file records the version of the database it was built from (see
+model.get_data_version); once the database has been reseeded, migrated or
+swapped, the file is out of date and the matrices are built from the database
+instead, until the file is written again.
+"""
+
+import logging
+import os
+
+import numpy as np
+from scipy import sparse
+
+from intensity import NUM_VERTICES, empty_map
+
+logger = logging.getLogger(__name__)
+
+
+# Default location of the prebuilt matrices
+MATRIX_FILE = 'activation_matrix.npz'
+
+
+class ActivationMatrix(object):
+    """Study x vertex activations and study x term frequencies."""
+
+    def __init__(self, pmids, words, activations, frequencies,
+                 data_version=None):
+        """Args:
+            pmids: sorted PubMed IDs, one per matrix row
+            words: sorted terms, one per column of frequencies
+            activations: studies x vertices sparse matrix
+            frequencies: studies x terms sparse matrix
+            data_version: the version of the database the matrices were
+                built from (see model.get_data_version), if known"""
+
+        self.pmids = pmids
+        self.data_version = data_version
+        self.words = words
+        self.activations = activations.tocsr()
+        self.frequencies = frequencies.tocsc()
+
+        self._columns_by_word = dict((word, i) for i, word in enumerate(words))
+
+    def __repr__(self):
+        """Displays info about the matrices."""
+
+        return "<ActivationMatrix studies=%d terms=%d activations=%d>" % (
+            len(self.pmids), len(self.words), self.activations.nnz)
+
+    ### Build, save and load ##################################################
+
+    @classmethod
+    def from_db(cls):
+        """Returns matrices built from the activations and studies_terms tables.
+
+        Activations are mapped onto their nearest surface vertex."""
+
+        # Imported here so the matrices can be loaded without the Flask app
+        from model import (Activation, StudyTerm, fetch_columns,
+                           get_data_version)
+        from sqlalchemy import select
+
+        logger.info("Building activation matrix...")
+
+        data_version = get_data_version()
+
+        act_pmids, location_ids = Activation.get_activation_columns()
+        term_pmids, term_words, term_freqs = fetch_columns(
+            select([StudyTerm.pmid, StudyTerm.word, StudyTerm.frequency]),
+            [np.int32, object, np.float32])
+
+        pmids = np.union1d(act_pmids, term_pmids).astype(np.int64)
+        words, word_columns = np.unique(term_words, return_inverse=True)
+
+        # Duplicate (row, column) entries are summed when converting to CSR
+        activations = sparse.coo_matrix(
+            (np.ones(len(act_pmids), dtype=np.float32),
+             (np.searchsorted(pmids, act_pmids), location_ids)),
+            shape=(len(pmids), NUM_VERTICES))
+
+        frequencies = sparse.coo_matrix(
+            (term_freqs, (np.searchsorted(pmids, term_pmids), word_columns)),
+            shape=(len(pmids), len(words)))
+
+        return cls(pmids, list(words), activations, frequencies, data_version)
+
+    @classmethod
+    def load(cls, path=MATRIX_FILE):
+        """Returns matrices saved with save()."""
+
+        arrays = np.load(path)
+
+        activations = sparse.csr_matrix(
+            (arrays['act_data'], arrays['act_indices'], arrays['act_indptr']),
+            shape=tuple(arrays['act_shape']))
+        frequencies = sparse.csc_matrix(
+            (arrays['freq_data'], arrays['freq_indices'], arrays['freq_indptr']),
+            shape=tuple(arrays['freq_shape']))
+
+        data_version = (str(arrays['data_version'])
+                        if 'data_version' in arrays.files else None)
+
+        return cls(arrays['pmids'], arrays['words'].tolist(), activations,
+                   frequencies, data_version)
+
+    def save(self, path=MATRIX_FILE):
+        """Writes the matrices to an .npz file."""
+
+        np.savez(path,
+                 pmids=self.pmids,
+                 words=np.array(self.words, dtype=unicode),
+                 act_data=self.activations.data,
+                 act_indices=self.activations.indices,
+                 act_indptr=self.activations.indptr,
+                 act_shape=self.activations.shape,
+                 freq_data=self.frequencies.data,
+                 freq_indices=self.frequencies.indices,
+                 freq_indptr=self.frequencies.indptr,
+                 freq_shape=self.frequencies.shape,
+                 data_version=np.array(self.data_version or ''))
+
+    ### Build intensity maps ##################################################
+
+    def get_frequencies_by_study(self, words):
+        """Returns the summed frequency of some word(s) in each study.
+
+            Args: a word 'word' or list of words ['word', 'word', ...]"""
+
+        if not isinstance(words, list):
+            words = [words]
+
+        columns = [self._columns_by_word[word] for word in words
+                   if word in self._columns_by_word]
+
+        return np.asarray(
+            self.frequencies[:, columns].sum(axis=1), dtype=np.float64).ravel()
+
+    def get_intensity_for_words(self, words):
+        """Returns an intensity map of word frequencies per location, scaled
+        using the maximal study frequency.
+
+            Args: a word 'word' or list of words ['word', 'word', ...]
+
+        Used to build intensity maps for words and topic clusters."""
+
+        frequencies_by_study = self.get_frequencies_by_study(words)
+        max_intensity = frequencies_by_study.max() if len(
+            frequencies_by_study) else 0.0
+
+        if not max_intensity:
+            return empty_map()
+
+        intensity_map = self.activations.T.dot(frequencies_by_study)
+
+        return (intensity_map / max_intensity).astype(np.float32)
+
+
+_activation_matrix = None
+
+
+def get_activation_matrix():
+    """Returns the shared ActivationMatrix, loading it from MATRIX_FILE if it
+    was prebuilt from the current database, or from the database otherwise."""
+
+    from model import get_data_version
+
+    global _activation_matrix
+
+    if _activation_matrix is None:
+        if os.path.exists(MATRIX_FILE):
+            _activation_matrix = ActivationMatrix.load(MATRIX_FILE)
+
+            if _activation_matrix.data_version != get_data_version():
+                logger.warning("%s is out of date with the database; run "
+                               "activation_matrix.py to rebuild it",
+                               MATRIX_FILE)
+                _activation_matrix = None
+
+        if _activation_matrix is None:
+            _activation_matrix = ActivationMatrix.from_db()
+
+    return _activation_matrix
+
+
+if __name__ == "__main__":
+    from server import app
+    from model import connect_to_db
+
+    connect_to_db(app)
+
+    activation_matrix = ActivationMatrix.from_db()
+    activation_matrix.save(MATRIX_FILE)
+    print "Saved", activation_matrix, "to", MATRIX_FILE
@@ -0,0 +1,156 @@
+"""In-memory registry of static assets.
+
+Static files (the BrainBrowser bundles, D3, color maps and model files) are
+read once at startup, together with a gzip-compressed copy of each, so that
+serving them involves no file reads or compression. Responses carry a strong
+ETag and Cache-Control, answer If-None-Match with a 304, and honor single byte
+ranges (416 if unsatisfiable), unless an If-Range does not match the ETag."""
+
+import os
+import mimetypes
+from hashlib import md5
+
+from flask import request, current_app
+
+from intensity import gzip_body
+
+
+# How long browsers may use an asset before revalidating it with its ETag
+CACHE_MAX_AGE = 3600
+
+# Only keep the gzipped copy if it saves at least this fraction of the bytes
+MIN_GZIP_SAVING = 0.1
+
+
+class Asset(object):
+    """A static file held in memory, plain and gzipped."""
+
+    def __init__(self, name, body, mimetype):
+        self.name = name
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = md5(body).hexdigest()
+
+        gzipped = gzip_body(body, level=9)
+        if len(gzipped) <= len(body) * (1 - MIN_GZIP_SAVING):
+            self.gzipped = gzipped
+        else:
+            self.gzipped = None
+
+    def __repr__(self):
+        """Displays info about an asset."""
+
+        return "<Asset name=%s bytes=%d gzipped=%s>" % (
+            self.name, len(self.body),
+            len(self.gzipped) if self.gzipped else None)
+
+
+class AssetRegistry(object):
+    """Static assets by name (their path relative to the static folder)."""
+
+    def __init__(self):
+        self._assets = {}
+
+    def __repr__(self):
+        """Displays info about the registry."""
+
+        return "<AssetRegistry assets=%d bytes=%d>" % (
+            len(self._assets), sum(len(asset.body)
+                                   for asset in self._assets.values()))
+
+    def add_file(self, name, path):
+        """Reads a file into the registry under some name."""
+
+        with open(path, 'rb') as asset_file:
+            body = asset_file.read()
+
+        mimetype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        self._assets[name] = Asset(name, body, mimetype)
+
+    def add_directory(self, root):
+        """Reads every file under a directory into the registry, named by their
+        path relative to it."""
+
+        for directory, _, filenames in os.walk(root):
+            for filename in filenames:
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                self.add_file(name, path)
+
+    def get(self, name):
+        """Returns the asset with some name, or None."""
+
+        return self._assets.get(name)
+
+    def serve(self, name):
+        """Returns a response for an asset, or None if there is no such asset.
+
+        Ranges are served from the plain body; otherwise the gzipped body is
+        sent to clients that accept it."""
+
+        asset = self._assets.get(name)
+
+        if asset is None:
+            return None
+
+        body = asset.body
+        etag = asset.etag
+        status = 200
+        headers = {'Cache-Control': 'public, max-age=%d' % CACHE_MAX_AGE,
+                   'Accept-Ranges': 'bytes',
+                   'Vary': 'Accept-Encoding'}
+
+        # Several ranges are not supported, and are answered with the whole
+        # body, as is a range of an older version of the asset (If-Range)
+        use_range = (request.range and len(request.range.ranges) == 1 and
+                     ('If-Range' not in request.headers or
+                      request.if_range.etag == asset.etag))
+
+        if use_range:
+            byte_range = get_byte_range(request.range.ranges[0], len(body))
+
+            if byte_range is None:
+                return current_app.response_class(
+                    status=416, headers={
+                        'Content-Range': 'bytes */%d' % len(asset.body)})
+
+            start, stop = byte_range
+            body = body[start:stop]
+            status = 206
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (
+                start, stop - 1, len(asset.body))
+
+        elif asset.gzipped and request.accept_encodings['gzip']:
+            body = asset.gzipped
+            etag += '-gzip'
+            headers['Content-Encoding'] = 'gzip'
+
+        response = current_app.response_class(body, status, headers,
+                                              mimetype=asset.mimetype)
+        response.set_etag(etag)
+
+        return response.make_conditional(request)
+
+
+def get_byte_range(byte_range, length):
+    """Returns (start, stop) of the bytes of a body of some length selected by a
+    (start, stop) range as parsed by werkzeug, with a negative start for the
+    last bytes, or None if it selects none.
+
+        >>> get_byte_range((2, None), 5), get_byte_range((-10, None), 5)
+        ((2, 5), (0, 5))
+        >>> print get_byte_range((5, 8), 5)
+        None
+    """
+
+    start, stop = byte_range
+
+    if start < 0:
+        start, stop = max(length + start, 0), length
+    else:
+        stop = length if stop is None else min(stop, length)
+
+    if start >= stop:
+        return None
+
+    return start, stop
@@ -0,0 +1,157 @@
+"""Server-side autocomplete index over the terms table.
+
+Words are kept in a sorted array, so the words starting with a prefix are a
+contiguous slice found by binary search. A trigram index adds typo-tolerant
+matches when there are not enough prefix matches. Either way, results are
+ranked by how many studies use each word."""
+
+from bisect import bisect_left
+
+import numpy as np
+
+
+# Minimum trigram similarity (Jaccard) for a fuzzy match
+MIN_SIMILARITY = 0.25
+
+# Most words a search returns
+MAX_LIMIT = 50
+
+
+def get_trigrams(word):
+    """Returns the set of trigrams of a word, padded so that its start and end
+    count as well.
+
+        >>> sorted(get_trigrams('pain'))
+        ['  p', ' pa', 'ain', 'in ', 'pai']
+    """
+
+    padded = '  ' + word.lower() + ' '
+
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class WordIndex(object):
+    """Prefix and trigram indexes of words, with their study counts."""
+
+    def __init__(self, words, study_counts):
+        """Args:
+            words: a list of words
+            study_counts: the number of studies using each word"""
+
+        order = sorted(range(len(words)), key=lambda i: words[i].lower())
+
+        self.words = [words[i] for i in order]
+        self.keys = [word.lower() for word in self.words]
+        self.study_counts = np.array([study_counts[i] for i in order],
+                                     dtype=np.int64)
+
+        # {trigram: array of word positions}
+        trigram_lists = {}
+        self.trigram_counts = np.zeros(len(self.words), dtype=np.int64)
+
+        for position, key in enumerate(self.keys):
+            trigrams = get_trigrams(key)
+            self.trigram_counts[position] = len(trigrams)
+            for trigram in trigrams:
+                trigram_lists.setdefault(trigram, []).append(position)
+
+        self.trigrams = dict((trigram, np.array(positions, dtype=np.int64))
+                             for trigram, positions in trigram_lists.items())
+
+    def __repr__(self):
+        """Displays info about the index."""
+
+        return "<WordIndex words=%d trigrams=%d>" % (len(self.words),
+                                                     len(self.trigrams))
+
+    @classmethod
+    def from_db(cls):
+        """Returns an index of every word in the terms table."""
+
+        from model import db, Term, StudyTerm
+        from sqlalchemy import func
+
+        rows = db.session.query(Term.word, func.count(StudyTerm.pmid)).outerjoin(
+            StudyTerm, StudyTerm.word == Term.word).group_by(Term.word).all()
+
+        return cls([row[0] for row in rows], [row[1] for row in rows])
+
+    ### Look up words #########################################################
+
+    def search(self, query, limit=10):
+        """Returns up to limit words starting with query, most used first,
+        followed by the closest fuzzy matches if there are fewer than limit.
+
+            Args:
+                query: what the user has typed so far
+                limit: the number of words to return, between 1 and
+                    MAX_LIMIT"""
+
+        limit = min(max(limit, 1), MAX_LIMIT)
+        matches = self.get_prefix_matches(query, limit)
+
+        if len(matches) < limit:
+            seen = set(matches)
+            matches += [word for word in self.get_fuzzy_matches(query, limit)
+                        if word not in seen][:limit - len(matches)]
+
+        return matches
+
+    def get_prefix_matches(self, prefix, limit=10):
+        """Returns up to limit words starting with prefix, most used first."""
+
+        prefix = prefix.lower()
+        start = bisect_left(self.keys, prefix)
+        stop = bisect_left(self.keys, prefix + u'\uffff', start)
+
+        return self._get_top(np.arange(start, stop), limit)
+
+    def get_fuzzy_matches(self, query, limit=10):
+        """Returns up to limit words sharing enough trigrams with query, most
+        similar first."""
+
+        query_trigrams = [trigram for trigram in get_trigrams(query)
+                          if trigram in self.trigrams]
+
+        if not query_trigrams:
+            return []
+
+        shared = np.bincount(
+            np.concatenate([self.trigrams[trigram]
+                            for trigram in query_trigrams]),
+            minlength=len(self.words))
+
+        similarity = shared / (float(len(get_trigrams(query))) +
+                               self.trigram_counts - shared)
+        candidates = np.flatnonzero(similarity >= MIN_SIMILARITY)
+
+        # Most similar first; most used first among equally similar words
+        order = np.lexsort((-self.study_counts[candidates],
+                            -similarity[candidates]))
+
+        return [self.words[i] for i in candidates[order[:limit]]]
+
+    def _get_top(self, positions, limit):
+        """Returns the words at some positions with the most studies."""
+
+        if len(positions) > limit:
+            top = np.argpartition(-self.study_counts[positions], limit)[:limit]
+            positions = np.sort(positions[top])
+
+        order = np.argsort(-self.study_counts[positions], kind='mergesort')
+
+        return [self.words[i] for i in positions[order]]
+
+
+_word_index = None
+
+
+def get_word_index():
+    """Returns the shared WordIndex, building it from the database."""
+
+    global _word_index
+
+    if _word_index is None:
+        _word_index = WordIndex.from_db()
+
+    return _word_index
@@ -0,0 +1,84 @@
+"""Microbenchmark: ORM rows vs. the columnar fetch API in model.py.
+
+Fills an in-memory database with the activations of many studies, then times
+fetching them as ORM rows (get_activations_from_studies) and as NumPy columns
+(get_activation_columns, which builds the in-memory indexes), and counts the
+Python objects each result keeps alive. Run from the repository root:
+
+    python benchmarks/columnar_fetch_benchmark.py
+"""
+
+import os
+import gc
+import sys
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from model import db, connect_to_db, Location, Study, Activation
+from server import app
+from intensity_benchmark import best_of
+
+
+N_STUDIES = 20000
+ACTIVATIONS_PER_STUDY = 35
+
+# SQLite allows at most 999 parameters in the IN clause of a query
+N_ACTIVATION_STUDIES = 900
+
+
+def fill_db():
+    """Creates and fills an in-memory database; returns the PubMed IDs."""
+
+    connect_to_db(app, 'sqlite://')
+    db.create_all()
+
+    random.seed(0)
+    pmids = range(10000000, 10000000 + N_STUDIES)
+
+    db.engine.execute(Location.__table__.insert(), [
+        {'location_id': i, 'x_coord': 0, 'y_coord': 0, 'z_coord': 0}
+        for i in xrange(81924)])
+    db.engine.execute(Study.__table__.insert(), [
+        {'pmid': pmid, 'title': '', 'authors': '', 'year': 2015, 'journal': ''}
+        for pmid in pmids])
+    db.engine.execute(Activation.__table__.insert(), [
+        {'pmid': pmid, 'location_id': random.randrange(81924)}
+        for pmid in pmids for _ in xrange(ACTIVATIONS_PER_STUDY)])
+
+    return pmids
+
+
+def count_objects(func, args):
+    """Returns the number of Python objects kept alive by func's result."""
+
+    db.session.expunge_all()
+    gc.collect()
+    before = len(gc.get_objects())
+    result = func(*args)
+    gc.collect()
+    after = len(gc.get_objects())
+    del result
+
+    return after - before
+
+
+def fetch_orm(pmids):
+    return Activation.get_activations_from_studies(pmids)
+
+
+def fetch_columns(pmids):
+    return Activation.get_activation_columns(pmids)
+
+
+if __name__ == "__main__":
+    pmids = fill_db()[:N_ACTIVATION_STUDIES]
+
+    print "activation rows: %d" % (N_ACTIVATION_STUDIES *
+                                   ACTIVATIONS_PER_STUDY)
+
+    for name, func in (('orm', fetch_orm), ('columns', fetch_columns)):
+        milliseconds = best_of(lambda: (db.session.expunge_all(), func(pmids)),
+                               ())
+        print "%-8s %8.2f ms %9d objects" % (name, milliseconds,
+                                             count_objects(func, (pmids,)))
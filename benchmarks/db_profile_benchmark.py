@@ -0,0 +1,90 @@
+"""Latency of representative model queries under each SQLite profile.
+
+Runs the queries behind a word click, a location click and a reference click
+against the seeded database with every profile of model.DB_PROFILES. Each run
+starts a fresh session, as a request does. Run from the repository root:
+
+    python benchmarks/db_profile_benchmark.py [--repeat 20]
+
+The 'seeding' profile only changes write settings; it is included as a
+baseline for reads.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from sqlalchemy import func
+
+from model import (db, connect_to_db, DB_PROFILES, Activation, Study,
+                   StudyTerm)
+from server import app
+from intensity_benchmark import best_of
+
+
+def get_fixtures():
+    """Returns the most used word and the studies mentioning it."""
+
+    word = db.session.query(StudyTerm.word).group_by(StudyTerm.word).order_by(
+        func.count(StudyTerm.pmid).desc()).first()[0]
+    pmids = StudyTerm.get_pmid_by_term(word, limit=None)
+
+    return word, pmids
+
+
+def get_queries(word, pmids):
+    """Returns (name, function) for each benchmarked query."""
+
+    return [
+        ('word frequencies', lambda: StudyTerm.get_by_word(word)),
+        ('word top studies', lambda: StudyTerm.get_pmid_by_term(word)),
+        ('activations', lambda: Activation.get_activation_columns(pmids)),
+        ('location counts', lambda: Activation.get_location_count_from_studies(
+            pmids)),
+        ('terms of studies', lambda: StudyTerm.get_terms_by_pmid(pmids[:40])),
+        ('references', lambda: Study.get_references(pmids[:40])),
+    ]
+
+
+def run_in_session(query):
+    """Runs a query in a fresh session, as a request would."""
+
+    try:
+        query()
+    finally:
+        db.session.remove()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    connect_to_db(app, profile='default')
+    word, pmids = get_fixtures()
+    queries = get_queries(word, pmids)
+
+    results = {}
+    for profile in sorted(DB_PROFILES):
+        db.engine.dispose()
+        connect_to_db(app, profile=profile)
+
+        # Warm the OS cache and the profile's connections first
+        for _, query in queries:
+            run_in_session(query)
+
+        results[profile] = [best_of(run_in_session, (query,), args.repeat)
+                            for _, query in queries]
+        db.engine.dispose()
+
+    print "word: %s   studies: %d   best of %d, ms" % (word, len(pmids),
+                                                       args.repeat)
+    print "%-18s" % 'query' + ''.join('%10s' % profile
+                                      for profile in sorted(DB_PROFILES))
+
+    for i, (name, _) in enumerate(queries):
+        print "%-18s" % name + ''.join('%10.2f' % results[profile][i]
+                                       for profile in sorted(DB_PROFILES))
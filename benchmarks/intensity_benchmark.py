@@ -0,0 +1,118 @@
+"""Microbenchmark: vectorized intensity engine vs. the old dict-and-string
+implementation of the /intensity helpers.
+
+Uses synthetic StudyTerm/Activation rows shaped like a broad word query, so no
+database is needed. Run from the repository root:
+
+    python benchmarks/intensity_benchmark.py
+"""
+
+import os
+import sys
+import random
+import timeit
+from collections import namedtuple
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from intensity import (NUM_VERTICES, organize_frequencies_by_study,
+                       scale_frequencies_by_loc, generate_intensity_map)
+
+
+FakeStudyTerm = namedtuple('FakeStudyTerm', ['pmid', 'frequency'])
+FakeActivation = namedtuple('FakeActivation', ['pmid', 'location_id'])
+
+
+################################################################################
+#  Previous implementation, kept here for comparison only
+################################################################################
+
+def legacy_organize_frequencies_by_study(studies):
+    frequencies_by_pmid = {}
+
+    for study in studies:
+        if study.pmid not in frequencies_by_pmid:
+            frequencies_by_pmid[study.pmid] = study.frequency
+        else:
+            frequencies_by_pmid[study.pmid] += study.frequency
+
+    return frequencies_by_pmid, max(frequencies_by_pmid.values())
+
+
+def legacy_scale_frequencies_by_loc(activations, max_intensity,
+                                    frequencies_by_pmid):
+    intensities_by_location = {}
+
+    for activation in activations:
+        intensity_to_add = frequencies_by_pmid[activation.pmid]
+
+        if activation.location_id not in intensities_by_location:
+            intensities_by_location[activation.location_id] = (
+                intensity_to_add / max_intensity)
+        else:
+            intensities_by_location[activation.location_id] += (
+                intensity_to_add / max_intensity)
+
+    return intensities_by_location
+
+
+def legacy_generate_intensity_map(intensities_by_location):
+    intensity_vals = ""
+
+    for i in range(0, NUM_VERTICES):
+        if i not in intensities_by_location:
+            intensity_vals = intensity_vals + "0\n"
+        else:
+            intensity_vals = intensity_vals + str(intensities_by_location[i]) + "\n"
+
+    return intensity_vals
+
+
+################################################################################
+#  Benchmark
+################################################################################
+
+def make_rows(n_studies=1000, activations_per_study=35):
+    """Returns synthetic (studies_terms, activations) rows."""
+
+    random.seed(0)
+    pmids = random.sample(xrange(10000000, 30000000), n_studies)
+    studies = [FakeStudyTerm(pmid, random.random()) for pmid in pmids]
+    activations = [FakeActivation(pmid, random.randrange(NUM_VERTICES))
+                   for pmid in pmids for _ in xrange(activations_per_study)]
+
+    return studies, activations
+
+
+def run_legacy(studies, activations):
+    frequencies_by_pmid, max_intensity = legacy_organize_frequencies_by_study(
+        studies)
+    intensities = legacy_scale_frequencies_by_loc(activations, max_intensity,
+                                                  frequencies_by_pmid)
+    return legacy_generate_intensity_map(intensities)
+
+
+def run_vectorized(studies, activations):
+    pmids, frequencies_by_pmid, max_intensity = organize_frequencies_by_study(
+        studies)
+    intensity_map = scale_frequencies_by_loc(activations, max_intensity, pmids,
+                                             frequencies_by_pmid)
+    return generate_intensity_map(intensity_map)
+
+
+def best_of(func, args, repeat=5):
+    """Returns the best wall time, in milliseconds, over several runs."""
+
+    return min(timeit.repeat(lambda: func(*args), repeat=repeat, number=1)) * 1000
+
+
+if __name__ == "__main__":
+    rows = make_rows()
+
+    legacy_ms = best_of(run_legacy, rows)
+    vectorized_ms = best_of(run_vectorized, rows)
+
+    print "studies: %d   activations: %d" % (len(rows[0]), len(rows[1]))
+    print "legacy:     %8.2f ms" % legacy_ms
+    print "vectorized: %8.2f ms" % vectorized_ms
+    print "speedup:    %8.1fx" % (legacy_ms / vectorized_ms)
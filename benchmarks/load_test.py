@@ -0,0 +1,440 @@
+"""Load test: replays recorded click traces and reports latency per endpoint.
+
+A trace is a JSON-lines file with one user click per line and the requests the
+page sends for it, in order:
+
+    {"session": 3, "click": "word", "requests": ["/intensity?options=clear",
+     "/d3word.json?word=pain", "/intensity?word=pain&options=word",
+     "/citations.json?word=pain&options=word"]}
+
+Traces are recorded against the seeded database by simulated sessions: each
+starts with a word search or a location click, then follows the topics, words
+and references of the responses it gets, as a user would.
+
+    python benchmarks/load_test.py record [--sessions 100] [--out trace.jsonl]
+
+Replaying runs the clicks of a trace through the Flask test client, or through
+serve.py with some workers, from --concurrency client threads. Requests are
+made unique so that the response cache does not answer them, unless
+--warm-cache is given. p50/p95/p99 latency and throughput are reported per
+endpoint, and saved as JSON.
+
+    python benchmarks/load_test.py run trace.jsonl [--concurrency 4]
+        [--workers 4] [--repeat 1] [--out results.json]
+        [--baseline baseline.json] [--threshold 0.2]
+
+With --baseline, the run fails (exit status 1) if, for some endpoint, the p50
+or p95 latency is more than --threshold higher than the baseline's, or the
+throughput more than --threshold lower. Save a results file as the baseline on
+a quiet machine first. Run from the repository root; the test client uses the
+default database of model.connect_to_db.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import httplib
+import threading
+import subprocess
+from Queue import Queue, Empty
+from urllib import quote
+from urlparse import urlparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+import numpy as np
+
+from prefork_benchmark import ROOT, PORT, wait_until_ready
+
+
+# Endpoints reported on, as the page calls them
+ENDPOINTS = ['/d3.json', '/citations.json', '/intensity', '/d3word.json',
+             '/d3topic.json']
+
+# Compared with the baseline, higher is worse
+LATENCY_CHECKS = ['p50', 'p95']
+
+
+################################################################################
+#  Recording traces
+################################################################################
+
+def get_click_requests(click, value):
+    """Returns the requests the page sends for a click on a location (x, y, z),
+    a word, a topic cluster or a study (PubMed ID)."""
+
+    # Every click first clears the intensity map
+    requests = ['/intensity?options=clear']
+
+    if click == 'location':
+        query = 'xcoord=%s&ycoord=%s&zcoord=%s&options=location' % value
+        requests += ['/d3.json?' + query, '/citations.json?' + query]
+
+    elif click == 'word':
+        value = quote(value.encode('utf-8'))
+        query = 'word=%s&options=word' % value
+        requests += ['/d3word.json?word=%s' % value,
+                     '/citations.json?' + query, '/intensity?' + query]
+
+    elif click == 'topic':
+        query = 'cluster=%s&options=cluster' % value
+        requests += ['/d3topic.json?cluster=%s' % value,
+                     '/citations.json?' + query, '/intensity?' + query]
+
+    elif click == 'reference':
+        query = 'pmid=%s&options=study' % value
+        requests += ['/intensity?' + query, '/citations.json?' + query,
+                     '/d3.json?' + query]
+
+    return requests
+
+
+def get_next_clicks(d3_tree, citations):
+    """Returns the (click, value) a user could make next, given the D3 tree
+    and the references on the page."""
+
+    clicks = [('reference', pmid) for pmid in citations]
+
+    for node in d3_tree.get('children', []):
+        if node['name'] != '':
+            clicks.append(('topic', node['name']))
+
+        for leaf in node.get('children', []):
+            if 'size' in leaf:
+                clicks.append(('word', leaf['name']))
+
+    return clicks
+
+
+def record_session(client, session, start, max_clicks, rng):
+    """Clicks through the app from a first click, following what the
+    responses show; returns the trace lines."""
+
+    lines = []
+    click, value = start
+
+    while True:
+        requests = get_click_requests(click, value)
+        lines.append({'session': session, 'click': click, 'requests': requests})
+
+        d3_tree, citations = {}, {}
+        for path in requests:
+            response = client.get(path)
+            if path.startswith('/d3'):
+                d3_tree = json.loads(response.data)
+            elif path.startswith('/citations.json'):
+                citations = json.loads(response.data)
+
+        next_clicks = get_next_clicks(d3_tree, citations)
+
+        if len(lines) == max_clicks or not next_clicks:
+            return lines
+
+        click, value = rng.choice(next_clicks)
+
+
+def record_trace(num_sessions, max_clicks, seed):
+    """Returns the trace lines of simulated sessions, starting from studied
+    words and reported locations."""
+
+    from sqlalchemy import func
+    from model import connect_to_db, db, Activation, Location, StudyTerm
+    from server import app
+
+    connect_to_db(app)
+    client = app.test_client()
+    rng = random.Random(seed)
+
+    # Words are searched for about as often as they are studied
+    words = [word for word, in db.session.query(StudyTerm.word).order_by(
+        StudyTerm.word)]
+    locations = db.session.query(Location.x_coord, Location.y_coord,
+                                 Location.z_coord).join(Activation).order_by(
+        func.random()).limit(10 * num_sessions).all()
+
+    lines = []
+    for session in range(num_sessions):
+        if rng.random() < 0.5 or not locations:
+            start = ('word', rng.choice(words))
+        else:
+            start = ('location', tuple(int(coord)
+                                       for coord in rng.choice(locations)))
+
+        lines += record_session(client, session, start,
+                                rng.randint(1, max_clicks), rng)
+
+    return lines
+
+
+################################################################################
+#  Replaying traces
+################################################################################
+
+class TestClientTarget(object):
+    """Sends requests to the app through the Flask test client."""
+
+    def __init__(self):
+        from model import connect_to_db
+        from server import app
+
+        connect_to_db(app)
+        self.app = app
+
+    def __repr__(self):
+        return "<TestClientTarget>"
+
+    def get_client(self):
+        """Returns a function requesting a path, for one client thread."""
+
+        client = self.app.test_client()
+        return lambda path: client.get(path).status_code
+
+    def close(self):
+        pass
+
+
+class ServerTarget(object):
+    """Sends requests to serve.py, started with some workers."""
+
+    def __init__(self, workers):
+        self.workers = workers
+        self.process = subprocess.Popen(
+            [sys.executable, 'serve.py', '--port', str(PORT),
+             '--workers', str(workers)],
+            cwd=ROOT, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+        try:
+            wait_until_ready()
+        except Exception:
+            self.close()
+            raise
+
+    def __repr__(self):
+        return "<ServerTarget workers=%d>" % self.workers
+
+    def get_client(self):
+        """Returns a function requesting a path, for one client thread."""
+
+        def request(path):
+            # werkzeug closes the connection after every response
+            connection = httplib.HTTPConnection('127.0.0.1', PORT, timeout=60)
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            finally:
+                connection.close()
+
+        return request
+
+    def close(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+def replay(target, clicks, concurrency, warm_cache=False):
+    """Replays clicks from some client threads; returns the time taken and
+    (endpoint, seconds, status) for every request."""
+
+    queue = Queue()
+    for i, click in enumerate(clicks):
+        queue.put((i, click))
+
+    samples = []
+    run = '%x' % int(time.time() * 1000)
+
+    def run_client():
+        request = target.get_client()
+
+        while True:
+            try:
+                i, click = queue.get_nowait()
+            except Empty:
+                return
+
+            for j, path in enumerate(click['requests']):
+                if not warm_cache:
+                    path += '&nocache=%s-%d-%d' % (run, i, j)
+
+                started = time.time()
+                try:
+                    status = request(path)
+                except Exception:
+                    status = None
+
+                # list.append is atomic
+                samples.append((urlparse(path).path, time.time() - started,
+                                status))
+
+    threads = [threading.Thread(target=run_client) for _ in range(concurrency)]
+
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return time.time() - started, samples
+
+
+def summarize(duration, samples):
+    """Returns {endpoint: {count, errors, p50, p95, p99, throughput}}, with
+    latencies in milliseconds and throughput in requests per second. 'all'
+    covers every request."""
+
+    by_endpoint = {'all': samples}
+    for endpoint in ENDPOINTS:
+        by_endpoint[endpoint] = [sample for sample in samples
+                                 if sample[0] == endpoint]
+
+    summary = {}
+    for endpoint, endpoint_samples in by_endpoint.items():
+        if not endpoint_samples:
+            continue
+
+        latencies = np.array([seconds for _, seconds, _ in endpoint_samples])
+        p50, p95, p99 = np.percentile(latencies * 1000, [50, 95, 99])
+
+        summary[endpoint] = {
+            'count': len(endpoint_samples),
+            'errors': sum(1 for _, _, status in endpoint_samples
+                          if status != 200),
+            'p50': round(p50, 3),
+            'p95': round(p95, 3),
+            'p99': round(p99, 3),
+            'throughput': round(len(endpoint_samples) / duration, 2),
+        }
+
+    return summary
+
+
+def find_regressions(summary, baseline, threshold):
+    """Returns a message for every endpoint slower than in a baseline summary
+    by more than threshold (a fraction), or with errors."""
+
+    regressions = []
+
+    for endpoint, stats in sorted(summary.items()):
+        if stats['errors']:
+            regressions.append("%s: %d errors" % (endpoint, stats['errors']))
+
+        if endpoint not in baseline:
+            continue
+
+        for check in LATENCY_CHECKS:
+            limit = baseline[endpoint][check] * (1 + threshold)
+            if stats[check] > limit:
+                regressions.append("%s: %s %.2fms > %.2fms" % (
+                    endpoint, check, stats[check], limit))
+
+        limit = baseline[endpoint]['throughput'] * (1 - threshold)
+        if stats['throughput'] < limit:
+            regressions.append("%s: throughput %.1f/s < %.1f/s" % (
+                endpoint, stats['throughput'], limit))
+
+    return regressions
+
+
+def print_summary(summary):
+    """Prints a table of the summary."""
+
+    print "%-16s %7s %7s %9s %9s %9s %9s" % ('endpoint', 'count', 'errors',
+                                            'p50 ms', 'p95 ms', 'p99 ms',
+                                            'req/s')
+
+    for endpoint in ENDPOINTS + ['all']:
+        if endpoint in summary:
+            stats = summary[endpoint]
+            print "%-16s %7d %7d %9.2f %9.2f %9.2f %9.1f" % (
+                endpoint, stats['count'], stats['errors'], stats['p50'],
+                stats['p95'], stats['p99'], stats['throughput'])
+
+
+if __name__ == "__main__":
+    import argparse
+    import logging
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    record = commands.add_parser('record', help="record a trace")
+    record.add_argument('--sessions', type=int, default=100)
+    record.add_argument('--max-clicks', type=int, default=6,
+                        help="most clicks per session")
+    record.add_argument('--seed', type=int, default=0)
+    record.add_argument('--out', default='trace.jsonl')
+
+    run = commands.add_parser('run', help="replay a trace")
+    run.add_argument('trace')
+    run.add_argument('--concurrency', type=int, default=4,
+                     help="client threads")
+    run.add_argument('--workers', type=int, default=0,
+                     help="serve.py workers (default: use the test client)")
+    run.add_argument('--repeat', type=int, default=1,
+                     help="times to replay the trace")
+    run.add_argument('--warm-cache', action='store_true',
+                     help="let the response cache answer repeated requests")
+    run.add_argument('--out', default='load_test_results.json')
+    run.add_argument('--baseline', help="results to compare with")
+    run.add_argument('--threshold', type=float, default=0.2,
+                     help="tolerated regression, as a fraction (default 0.2)")
+    args = parser.parse_args()
+
+    # The model's debug logs would drown the results
+    logging.disable(logging.INFO)
+
+    if args.command == 'record':
+        lines = record_trace(args.sessions, args.max_clicks, args.seed)
+
+        with open(args.out, 'w') as trace:
+            for line in lines:
+                trace.write(json.dumps(line) + '\n')
+
+        print "Recorded %d clicks in %d sessions to %s" % (
+            len(lines), args.sessions, args.out)
+        sys.exit()
+
+    with open(args.trace) as trace:
+        clicks = [json.loads(line) for line in trace if line.strip()]
+
+    if args.workers:
+        target = ServerTarget(args.workers)
+    else:
+        target = TestClientTarget()
+
+    try:
+        duration, samples = replay(target, clicks * args.repeat,
+                                   args.concurrency, args.warm_cache)
+    finally:
+        target.close()
+
+    summary = summarize(duration, samples)
+
+    print "%d clicks, %d requests in %.1fs   concurrency: %d   target: %s" % (
+        len(clicks) * args.repeat, len(samples), duration, args.concurrency,
+        'serve.py, %d workers' % args.workers if args.workers
+        else 'test client')
+    print_summary(summary)
+
+    with open(args.out, 'w') as results:
+        json.dump({'trace': args.trace, 'concurrency': args.concurrency,
+                   'workers': args.workers, 'repeat': args.repeat,
+                   'warm_cache': args.warm_cache, 'duration': duration,
+                   'endpoints': summary}, results, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = find_regressions(summary,
+                                           json.load(baseline)['endpoints'],
+                                           args.threshold)
+
+        if regressions:
+            print "\nRegressions against %s:" % args.baseline
+            for regression in regressions:
+                print "  " + regression
+            sys.exit(1)
+
+        print "\nNo regression against %s" % args.baseline
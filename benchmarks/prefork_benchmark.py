@@ -0,0 +1,117 @@
+"""Throughput of serve.py by number of workers.
+
+Starts the pre-fork server with 1, 2, 4... workers (up to twice the number of
+cores), waits for /ready, then has client processes request a mix of routes as
+fast as they can. Responses are built fresh each time (?nocache= defeats the
+response cache). Needs a seeded database; run from the repository root:
+
+    python benchmarks/prefork_benchmark.py [--duration 10] [--clients 8]
+"""
+
+import os
+import sys
+import time
+import httplib
+import subprocess
+import multiprocessing
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+PORT = 5057
+
+PATHS = [
+    '/d3.json?xcoord=40&ycoord=-45&zcoord=-25&options=location',
+    '/citations.json?word=pain&options=word',
+    '/intensity?word=pain&options=word&format=sparse',
+    '/d3word.json?word=face',
+    '/words?prefix=em',
+]
+
+
+def wait_until_ready(timeout=600):
+    """Polls /ready until the server answers 200."""
+
+    deadline = time.time() + timeout
+
+    while time.time() < deadline:
+        try:
+            connection = httplib.HTTPConnection('127.0.0.1', PORT, timeout=5)
+            connection.request('GET', '/ready')
+            if connection.getresponse().status == 200:
+                return
+        except Exception:
+            pass
+        time.sleep(0.5)
+
+    raise RuntimeError("Server did not become ready")
+
+
+def run_client(args):
+    """Requests PATHS in turn for some seconds; returns the number of
+    successful responses."""
+
+    client, duration = args
+    connection = httplib.HTTPConnection('127.0.0.1', PORT, timeout=30)
+    done = 0
+    deadline = time.time() + duration
+
+    while time.time() < deadline:
+        path = PATHS[done % len(PATHS)]
+        connection.request('GET', '%s&nocache=%d-%d' % (path, client, done))
+        response = connection.getresponse()
+        response.read()
+
+        if response.status == 200:
+            done += 1
+
+        # werkzeug closes the connection after every response
+        connection.close()
+
+    return done
+
+
+def measure(workers, clients, duration):
+    """Returns requests per second with some number of workers."""
+
+    server = subprocess.Popen(
+        [sys.executable, 'serve.py', '--port', str(PORT),
+         '--workers', str(workers)],
+        cwd=ROOT, stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+    try:
+        wait_until_ready()
+
+        pool = multiprocessing.Pool(clients)
+        done = sum(pool.map(run_client,
+                            [(client, duration) for client in range(clients)]))
+        pool.close()
+        pool.join()
+    finally:
+        server.terminate()
+        server.wait()
+
+    return done / float(duration)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--clients', type=int, default=8)
+    args = parser.parse_args()
+
+    cores = multiprocessing.cpu_count()
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= cores * 2:
+        worker_counts.append(worker_counts[-1] * 2)
+
+    print "cores: %d   clients: %d   %.0fs per run" % (cores, args.clients,
+                                                     args.duration)
+    print "%8s %10s %8s" % ('workers', 'req/s', 'speedup')
+
+    baseline = None
+    for workers in worker_counts:
+        rate = measure(workers, args.clients, args.duration)
+        baseline = baseline or rate
+        print "%8d %10.1f %7.2fx" % (workers, rate, rate / baseline)
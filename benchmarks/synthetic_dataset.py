@@ -0,0 +1,413 @@
+"""Synthetic Neurosynth-like seed files, for measuring how the app scales.
+
+Writes the files seed.py reads, in their formats, under an output directory
+laid out like the repository:
+
+    <out>/seed_data/database.txt        studies and their activations
+    <out>/seed_data/studies_terms.txt   study-term frequencies
+    <out>/seed_data/topics.csv          topic clusters of words
+    <out>/Clusters.txt                  study clusters
+    <out>/static/models/brain-surface2.obj   surface vertices
+
+At --scale 1 there are as many studies as in the Neurosynth release (11406,
+with ~35 activations and ~60 terms each); --scale 10 and --scale 100 multiply
+the studies. The data is shaped like the real thing:
+
+    - terms are used with Zipfian frequencies, and studies of the same study
+      cluster share a pool of terms
+    - activations are spread around hotspots on the surface, shared by the
+      studies of a cluster; --surface-fraction of them are snapped to a surface
+      vertex, so they map onto the surface as seeded locations
+    - topics are drawn from the single-word terms, the most used most often
+
+The surface vertices are those of static/models/brain-surface2.obj if it is
+there, or else a synthetic pair of hemispheres. Generation is streamed in
+chunks of studies, so memory does not grow with --scale.
+
+    python benchmarks/synthetic_dataset.py --scale 10 --out synthetic-10x
+
+Then seed it into its own database, which model.py, serve.py and the
+benchmarks use when $DATABASE_URI points to it:
+
+    export DATABASE_URI=sqlite:///synthetic-10x/odyssey.db
+    python seed.py --data-dir synthetic-10x
+    python benchmarks/load_test.py record --out synthetic-10x/trace.jsonl
+
+Prebuilt activation_matrix.npz and intensity_cache/ files are for the real
+data: move them aside while serving a synthetic database.
+"""
+
+import os
+import sys
+import time
+import shutil
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir)
+sys.path.insert(0, ROOT)
+
+from seed import (SURFACE_FILE, DATABASE_FILE, STUDIES_TERMS_FILE,
+                  STUDY_CLUSTERS_FILE, TOPICS_FILE)
+from mesh import SURFACE_VERTICES, SurfaceMesh, round_half_away
+
+# Sizes of the Neurosynth data, at scale 1
+NUM_STUDIES = 11406
+ACTIVATIONS_PER_STUDY = 35
+TERMS_PER_STUDY = 60
+NUM_TERMS = 3000
+NUM_TOPICS = 400
+WORDS_PER_TOPIC = 25
+
+# Shape of the distributions
+ZIPF_EXPONENT = 1.1         # term and hotspot popularity
+PHRASE_FRACTION = 0.1       # terms of two words
+NUM_HOTSPOTS = 400          # activation centers on the surface
+HOTSPOTS_PER_CLUSTER = 4
+TERMS_PER_CLUSTER = 40
+CLUSTER_SHARE = 0.6         # activations and terms drawn from the cluster's
+HOTSPOT_SPREAD = 6.0        # standard deviation around a hotspot, in mm
+
+# Studies generated at a time
+CHUNK_SIZE = 5000
+
+SYLLABLES = [consonant + vowel for consonant in 'bcdfghklmnprstvz'
+             for vowel in 'aeiou']
+JOURNALS = ['NeuroImage', 'Human Brain Mapping', 'Cerebral Cortex',
+            'Journal of Neuroscience', 'Neuropsychologia', 'Brain',
+            'Journal of Cognitive Neuroscience', 'Biological Psychiatry',
+            'Social Cognitive and Affective Neuroscience', 'Brain Research']
+TITLES = ['Neural correlates of %s and %s',
+          'The role of %s in %s: an fMRI study',
+          'Dissociable networks for %s and %s',
+          'Effects of %s on %s-related activation']
+
+
+################################################################################
+#  Vocabulary and surface
+################################################################################
+
+def zipf_weights(n, exponent=ZIPF_EXPONENT):
+    """Returns the probabilities of n items ranked by a Zipf law."""
+
+    weights = 1.0 / np.arange(1, n + 1) ** exponent
+
+    return weights / weights.sum()
+
+
+def make_word(rng, min_syllables=2, max_syllables=4):
+    """Returns a pronounceable made-up word."""
+
+    return ''.join(rng.choice(SYLLABLES)
+                   for _ in range(rng.randint(min_syllables, max_syllables + 1)))
+
+
+def make_vocabulary(num_terms, rng):
+    """Returns num_terms distinct terms, single words then phrases of two
+    words. A term's position is its Zipf rank, so they are shuffled."""
+
+    num_words = int(num_terms * (1 - PHRASE_FRACTION))
+    words = set()
+
+    while len(words) < num_words:
+        words.add(make_word(rng))
+
+    words = sorted(words)
+    phrases = set()
+
+    while len(phrases) < num_terms - num_words:
+        phrases.add('%s %s' % (words[rng.randint(num_words)],
+                               words[rng.randint(num_words)]))
+
+    terms = words + sorted(phrases)
+    rng.shuffle(terms)
+
+    return terms
+
+
+def make_surface(rng, num_vertices=SURFACE_VERTICES):
+    """Returns the vertices of two ellipsoid hemispheres roughly the size of
+    a brain in MNI space, in mm."""
+
+    # Evenly spread points on a unit sphere (Fibonacci lattice)
+    per_hemisphere = num_vertices // 2
+    i = np.arange(per_hemisphere) + 0.5
+    polar = np.arccos(1 - 2 * i / per_hemisphere)
+    azimuth = np.pi * (1 + 5 ** 0.5) * i
+    sphere = np.column_stack([np.cos(azimuth) * np.sin(polar),
+                              np.sin(azimuth) * np.sin(polar),
+                              np.cos(polar)])
+
+    # Half-width 34mm (x), 86mm front to back (y), 60mm high (z), with some
+    # folding, centered 36mm either side of the midline
+    radii = np.array([34.0, 86.0, 60.0])
+    folds = 1 + 0.04 * np.sin(12 * polar) * np.cos(9 * azimuth)
+    hemisphere = sphere * radii * folds[:, np.newaxis]
+
+    vertices = np.concatenate([hemisphere + [-36, -18, 12],
+                               hemisphere + [36, -18, 12]])
+
+    return np.round(vertices, 4)
+
+
+################################################################################
+#  Writing seed files
+################################################################################
+
+def write_surface(path, vertices):
+    """Writes surface vertices, one 'x y z' line each."""
+
+    np.savetxt(path, vertices, fmt='%.4f', delimiter=' ')
+
+
+def write_topics(path, terms, rng, num_topics=NUM_TOPICS,
+                 words_per_topic=WORDS_PER_TOPIC):
+    """Writes topic clusters of single words, drawn by popularity."""
+
+    words = np.array([i for i, term in enumerate(terms) if ' ' not in term])
+    weights = zipf_weights(len(terms))[words]
+    weights /= weights.sum()
+
+    with open(path, 'w') as topics:
+        row_id = 1
+
+        for topic in range(num_topics):
+            members = rng.choice(words, words_per_topic, replace=False,
+                                 p=weights)
+
+            for column, word in enumerate(members):
+                topics.write('%d,Topic %03d,%d,%s\n' % (row_id, topic,
+                                                        column + 1, terms[word]))
+                row_id += 1
+
+
+class StudyGenerator(object):
+    """Generates studies chunk by chunk, with their activations, terms and
+    study cluster."""
+
+    def __init__(self, num_studies, terms, vertices, rng,
+                 surface_fraction=0.6):
+        self.num_studies = num_studies
+        self.terms = terms
+        self.vertices = vertices
+        self.rng = rng
+        self.surface_fraction = surface_fraction
+
+        self.tree = cKDTree(vertices)
+        self.surface_coords = round_half_away(vertices).astype(int)
+        self.term_weights = zipf_weights(len(terms))
+
+        # Study clusters: sqrt(n/2) of them, as in DimReductionSelectingK.py,
+        # each with its own terms and hotspots
+        self.num_clusters = max(1, int((num_studies / 2.0) ** 0.5))
+        self.cluster_weights = zipf_weights(self.num_clusters, 0.8)
+        self.cluster_terms = np.array([
+            rng.choice(len(terms), TERMS_PER_CLUSTER, replace=False,
+                       p=self.term_weights)
+            for _ in range(self.num_clusters)])
+
+        self.hotspots = rng.choice(len(vertices), NUM_HOTSPOTS, replace=False)
+        self.hotspot_weights = zipf_weights(NUM_HOTSPOTS)
+        self.cluster_hotspots = rng.choice(
+            self.hotspots, (self.num_clusters, HOTSPOTS_PER_CLUSTER),
+            p=self.hotspot_weights)
+
+        # Spread-out, 8-digit PubMed IDs
+        self.pmids = np.sort(rng.choice(90000000, num_studies, replace=False)
+                             + 10000000)
+        self.authors = ['%s %s' % (make_word(rng).capitalize(),
+                                   make_word(rng, 1, 1)[0].upper())
+                        for _ in range(500)]
+
+    def __repr__(self):
+        """Displays info about the generator."""
+
+        return "<StudyGenerator studies=%d clusters=%d>" % (self.num_studies,
+                                                           self.num_clusters)
+
+    def iter_chunks(self, chunk_size=CHUNK_SIZE):
+        """Yields (pmids, clusters, activations, study_terms) per chunk of
+        studies, where activations is (study index, xyz) and study_terms is
+        (study index, term index, frequency), indices being into pmids."""
+
+        for start in range(0, self.num_studies, chunk_size):
+            pmids = self.pmids[start:start + chunk_size]
+            clusters = self.rng.choice(self.num_clusters, len(pmids),
+                                       p=self.cluster_weights)
+
+            yield (pmids, clusters, self.make_activations(clusters),
+                   self.make_study_terms(clusters))
+
+    def make_activations(self, clusters):
+        """Returns (study index, xyz) of the activations of studies."""
+
+        rng = self.rng
+
+        # Skewed counts: a few studies report many more peaks
+        counts = rng.negative_binomial(2, 2.0 / (2 + ACTIVATIONS_PER_STUDY - 1),
+                                       len(clusters)) + 1
+        studies = np.repeat(np.arange(len(clusters)), counts)
+
+        from_cluster = rng.random_sample(len(studies)) < CLUSTER_SHARE
+        hotspots = np.where(
+            from_cluster,
+            self.cluster_hotspots[clusters[studies],
+                                  rng.randint(HOTSPOTS_PER_CLUSTER,
+                                              size=len(studies))],
+            rng.choice(self.hotspots, len(studies), p=self.hotspot_weights))
+
+        points = self.vertices[hotspots] + rng.normal(
+            0, HOTSPOT_SPREAD, (len(studies), 3))
+        xyz = round_half_away(points).astype(int)
+
+        on_surface = rng.random_sample(len(studies)) < self.surface_fraction
+        _, nearest = self.tree.query(points[on_surface])
+        xyz[on_surface] = self.surface_coords[nearest]
+
+        return studies, xyz
+
+    def make_study_terms(self, clusters):
+        """Returns (study index, term index, frequency) of the terms of
+        studies."""
+
+        rng = self.rng
+
+        counts = rng.poisson(TERMS_PER_STUDY, len(clusters)) + 1
+        studies = np.repeat(np.arange(len(clusters)), counts)
+
+        from_cluster = rng.random_sample(len(studies)) < CLUSTER_SHARE
+        terms = np.where(
+            from_cluster,
+            self.cluster_terms[clusters[studies],
+                               rng.randint(TERMS_PER_CLUSTER,
+                                           size=len(studies))],
+            rng.choice(len(self.terms), len(studies), p=self.term_weights))
+
+        # A term is listed once per study
+        keys = np.unique(studies.astype(np.int64) * len(self.terms) + terms)
+        studies, terms = keys // len(self.terms), keys % len(self.terms)
+
+        # tf-idf like: mostly small, higher for rarer terms
+        frequencies = np.minimum(rng.lognormal(-3.0, 0.9, len(terms)) *
+                                 (1 + np.log1p(terms / 100.0)), 1.0)
+
+        return studies, terms, frequencies
+
+    def get_study_fields(self, pmid, study_terms):
+        """Returns the doi, title, authors, year and journal of a study."""
+
+        rng = self.rng
+        words = [self.terms[term] for term in study_terms[:2]] or ['memory',
+                                                                   'attention']
+        words += words
+
+        return ['10.1016/j.synth.%d' % pmid,
+                rng.choice(TITLES) % (words[0], words[1]),
+                ', '.join(rng.choice(self.authors, rng.randint(1, 6))),
+                str(rng.randint(1997, 2016)),
+                rng.choice(JOURNALS)]
+
+
+def write_studies(out_dir, generator):
+    """Writes database.txt, studies_terms.txt and Clusters.txt; returns the
+    number of activations and of study-term rows written."""
+
+    num_activations = num_study_terms = 0
+
+    with open(os.path.join(out_dir, DATABASE_FILE), 'w') as database, \
+            open(os.path.join(out_dir, STUDIES_TERMS_FILE), 'w') as studies_terms, \
+            open(os.path.join(out_dir, STUDY_CLUSTERS_FILE), 'w') as study_clusters:
+
+        database.write('\t'.join(['id', 'doi', 'x', 'y', 'z', 'space',
+                                  'peak_id', 'table_id', 'table_num', 'title',
+                                  'authors', 'year', 'journal']) + '\n')
+        studies_terms.write('"pmid"\t"word"\t"frequency"\n')
+
+        # R writes phrases with dots in place of spaces, in quotes
+        quoted_terms = ['"%s"' % term.replace(' ', '.')
+                        for term in generator.terms]
+
+        for pmids, clusters, activations, terms in generator.iter_chunks():
+            term_studies, term_ids, frequencies = terms
+            first_terms = np.searchsorted(term_studies, np.arange(len(pmids)))
+
+            # (doi, the fields after the coordinates) of each study
+            fields = []
+            for i, pmid in enumerate(pmids):
+                study_fields = generator.get_study_fields(
+                    pmid, term_ids[first_terms[i]:first_terms[i] + 2])
+                fields.append((study_fields[0], '\t'.join(study_fields[1:])))
+
+            lines = []
+            for peak, (i, (x, y, z)) in enumerate(zip(*activations)):
+                lines.append('%d\t%s\t%d\t%d\t%d\tMNI\t%d\t%d\t%d\t%s\n' % (
+                    pmids[i], fields[i][0], x, y, z, num_activations + peak,
+                    pmids[i] % 1000, 1 + peak % 3, fields[i][1]))
+            database.writelines(lines)
+            num_activations += len(lines)
+
+            studies_terms.writelines(
+                '%d\t%d\t%s\t%.12g\n' % (num_study_terms + j + 1, pmids[i],
+                                         quoted_terms[term], frequency)
+                for j, (i, term, frequency)
+                in enumerate(zip(term_studies, term_ids, frequencies)))
+            num_study_terms += len(term_ids)
+
+            study_clusters.writelines('%d\t%d\n' % (pmid, cluster)
+                                      for pmid, cluster in zip(pmids, clusters))
+
+    return num_activations, num_study_terms
+
+
+def generate(out_dir, num_studies, seed=0, num_terms=NUM_TERMS,
+             surface_fraction=0.6):
+    """Writes a synthetic dataset of some number of studies."""
+
+    rng = np.random.RandomState(seed)
+    started = time.time()
+
+    for directory in ('seed_data', os.path.dirname(SURFACE_FILE)):
+        if not os.path.isdir(os.path.join(out_dir, directory)):
+            os.makedirs(os.path.join(out_dir, directory))
+
+    # Use the real surface if we have it
+    real_surface = os.path.join(ROOT, SURFACE_FILE)
+    if os.path.exists(real_surface):
+        shutil.copy(real_surface, os.path.join(out_dir, SURFACE_FILE))
+        vertices = np.array(SurfaceMesh.load(real_surface).vertices)
+    else:
+        vertices = make_surface(rng)
+        write_surface(os.path.join(out_dir, SURFACE_FILE), vertices)
+
+    terms = make_vocabulary(num_terms, rng)
+    write_topics(os.path.join(out_dir, TOPICS_FILE), terms, rng)
+
+    generator = StudyGenerator(num_studies, terms, vertices, rng,
+                               surface_fraction)
+    num_activations, num_study_terms = write_studies(out_dir, generator)
+
+    print "%d studies, %d activations, %d study terms, %d terms, %d study " \
+          "clusters in %.1fs" % (num_studies, num_activations, num_study_terms,
+                                 len(terms), generator.num_clusters,
+                                 time.time() - started)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--scale', type=float, default=1,
+                        help="studies, as a multiple of Neurosynth's 11406")
+    parser.add_argument('--studies', type=int,
+                        help="number of studies (overrides --scale)")
+    parser.add_argument('--terms', type=int, default=NUM_TERMS)
+    parser.add_argument('--surface-fraction', type=float, default=0.6,
+                        help="share of activations on a surface vertex")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default='synthetic')
+    args = parser.parse_args()
+
+    generate(args.out, args.studies or int(NUM_STUDIES * args.scale),
+             args.seed, args.terms, args.surface_fraction)
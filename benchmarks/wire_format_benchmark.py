@@ -0,0 +1,50 @@
+"""Response size and encode time of each /intensity wire format.
+
+Encodes synthetic intensity maps of increasing density in every format of
+intensity.WIRE_FORMATS, plain and gzipped. Run from the repository root:
+
+    python benchmarks/wire_format_benchmark.py
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir))
+
+from intensity import (WIRE_FORMATS, organize_frequencies_by_study,
+                       scale_frequencies_by_loc, encode_intensity_map, gzip_body)
+from intensity_benchmark import make_rows, best_of
+
+
+def make_map(n_studies):
+    """Returns an intensity map built from n_studies synthetic studies."""
+
+    studies, activations = make_rows(n_studies)
+    pmids, frequencies_by_pmid, max_intensity = organize_frequencies_by_study(
+        studies)
+
+    return scale_frequencies_by_loc(activations, max_intensity, pmids,
+                                    frequencies_by_pmid)
+
+
+if __name__ == "__main__":
+    print "%-8s %-8s %10s %10s %9s %9s %8s" % (
+        'studies', 'format', 'bytes', 'gz bytes', 'enc ms', 'gz ms', 'vs text')
+
+    for n_studies in (40, 1000, 11000):
+        intensity_map = make_map(n_studies)
+        text_bytes = None
+
+        for wire_format in WIRE_FORMATS:
+            body, headers = encode_intensity_map(intensity_map, wire_format)
+            gzipped = gzip_body(body)
+
+            encode_ms = best_of(encode_intensity_map, (intensity_map, wire_format))
+            gzip_ms = best_of(gzip_body, (body,))
+
+            if text_bytes is None:
+                text_bytes = len(body)
+
+            print "%-8d %-8s %10d %10d %9.2f %9.2f %7.1fx" % (
+                n_studies, wire_format, len(body), len(gzipped), encode_ms,
+                gzip_ms, float(text_bytes) / len(gzipped))
@@ -0,0 +1,275 @@
+"""What the page shows for one user click, computed from a single selection.
+
+A click selects a location, a word, a topic cluster or a study. The studies it
+stands for (and, for a topic, its words) are looked up once, on first use, and
+shared by what the page shows, whether it is asked for one route at a time
+(/d3.json, /citations.json, /intensity) or all together (/explore).
+
+Only location and study clicks share their studies between the D3 tree, the
+reference list and the map. For a word or a topic, the references are the top
+40 studies for the words, while the tree is built from the words alone and the
+map weights every study using the words by its frequency (a topic's words are
+still shared by all three)."""
+
+from model import Study, StudyTerm
+from intensity import empty_map
+from activation_matrix import get_activation_matrix
+from intensity_cache import get_intensity_cache
+from spatial_index import get_spatial_index
+from topic_graph import get_topic_graph
+from study_clusters import get_study_clusters
+from smoothing import get_surface_smoother
+
+
+# What a click can select, and the request parameters naming it
+OPTIONS = ('location', 'word', 'cluster', 'study', 'clear')
+
+# Leaf sizes of term trees, by what was clicked on
+D3_SCALES = {'location': 70000, 'study': 30000}
+
+
+class Selection(object):
+    """A location, word, topic cluster or study clicked on by the user."""
+
+    def __init__(self, options, xyz=None, word=None, cluster=None, pmid=None,
+                 radius=3, fwhm=None):
+        """Args:
+            options: what was clicked on, one of OPTIONS
+            xyz: (x, y, z) of a location
+            word: a word
+            cluster: a topic cluster ID
+            pmid: the PubMed ID of a study
+            radius: the search radius around a location, in mm
+            fwhm: the width of the Gaussian smoothing the intensity map, in
+                mm, snapped to smoothing.FWHMS (default: no smoothing)"""
+
+        self.options = options
+        self.xyz = xyz
+        self.word = word
+        self.cluster = cluster
+        self.pmid = pmid
+        self.radius = radius
+        self.fwhm = fwhm
+
+        self._pmids = None
+        self._words = None
+
+    def __repr__(self):
+        """Displays info about a selection."""
+
+        return "<Selection options=%s xyz=%s word=%s cluster=%s pmid=%s>" % (
+            self.options, self.xyz, self.word, self.cluster, self.pmid)
+
+    @classmethod
+    def from_args(cls, args, options=None, radius=3):
+        """Returns the selection described by request args.
+
+            Args:
+                args: request.args, with options= unless options is given,
+                    xcoord/ycoord/zcoord, word, cluster or pmid, and
+                    optionally fwhm
+                options: what was clicked on, if args don't say
+                radius: the search radius around a location, in mm"""
+
+        options = options or args.get('options')
+        xyz = None
+
+        if options == 'location':
+            xyz = tuple(float(args.get(name))
+                        for name in ('xcoord', 'ycoord', 'zcoord'))
+
+        return cls(options, xyz=xyz, word=args.get('word'),
+                   cluster=args.get('cluster'), pmid=args.get('pmid'),
+                   radius=radius, fwhm=args.get('fwhm', type=float))
+
+    ### Shared intermediates ##################################################
+
+    @property
+    def pmids(self):
+        """The PubMed IDs of the studies selected.
+
+        For a word or a topic, these are the top studies for the words, which
+        only the reference list shows; the map is made from all of them."""
+
+        if self._pmids is None:
+
+            if self.options == 'location':
+                self._pmids = get_spatial_index().get_pmids_from_xyz(
+                    *self.xyz, radius=self.radius)
+
+            elif self.options == 'word':
+                self._pmids = StudyTerm.get_pmid_by_term(self.word)
+
+            elif self.options == 'cluster':
+                # The top studies for the words of the topic
+                self._pmids = StudyTerm.get_pmid_by_term(self.words)
+
+            elif self.options == 'study':
+                # The study and its cluster-mate studies
+                self._pmids = get_study_clusters().get_cluster_mates(self.pmid)
+
+            else:
+                self._pmids = []
+
+        return self._pmids
+
+    @property
+    def words(self):
+        """The words of the topic cluster selected."""
+
+        if self._words is None:
+            self._words = get_topic_graph().get_words_in_cluster(self.cluster)
+
+        return self._words
+
+
+################################################################################
+#  D3 TREES
+################################################################################
+
+def get_d3_tree(selection):
+    """Returns the D3 tree of a selection: the clusters of a word, the words of
+    a topic cluster, or the words and topics of the studies selected by a
+    location or a study."""
+
+    if selection.options == 'word':
+        return get_word_tree(selection.word)
+
+    elif selection.options == 'cluster':
+        return get_topic_tree(selection.words)
+
+    return get_term_tree(selection.pmids, D3_SCALES.get(selection.options, 0))
+
+
+def get_topic_tree(words):
+    """Returns a tree with a topic cluster as the root node."""
+
+    root_dict = {'name': '', 'children': []}
+
+    for word in words:
+        root_dict['children'].append(
+            {'name': '', 'children': [{'name': word, 'size': 40000}]})
+
+    return root_dict
+
+
+def get_word_tree(word):
+    """Returns a tree with a word as the root node."""
+
+    clusters = get_topic_graph().get_top_clusters(word, n=25)
+
+    root_dict = {'name': '', 'children': []}
+
+    for cluster in clusters:
+        root_dict['children'].append(
+            {'name': cluster, 'children': [{'name': word, 'size': 40000}]})
+
+    return root_dict
+
+
+def get_term_tree(pmids, scale):
+    """Returns a tree of the most frequent words in some studies, grouped by
+    their top topic clusters.
+
+        Args:
+            pmids: a list of PubMed IDs
+            scale: the leaf size of a word with frequency 1"""
+
+    # Get [(wd, freq), ...] and [wd1, wd2] for most frequent words
+    terms_for_dict, words = StudyTerm.get_terms_by_pmid(pmids)
+    # Get the top clusters
+    top_clusters = get_topic_graph().get_top_clusters(words)
+    # Get the cluster-word associations
+    associations = get_topic_graph().get_word_cluster_pairs(top_clusters, words)
+
+    # Make the root node:
+    root_dict = {'name': '', 'children': []}
+
+    # Build the terminal nodes (leaves) first using (wd, freq) tuples
+    # Output: {word: {'name': word, 'size': freq}, word2: ... }
+    leaves = {}
+
+    for (word, freq) in terms_for_dict:
+        if word not in leaves:
+            leaves[word] = {'name': word, 'size': freq * scale}
+        else:
+            leaves[word]['size'] += freq * scale
+
+    # Embed the leaves in the clusters:
+    # Output: {cluster_id: {'name': ID, 'children': [...]}, ... }
+    clusters = {}
+
+    for (cluster_id, word) in associations:
+        if cluster_id not in clusters:
+            clusters[cluster_id] = {'name': cluster_id, 'children': [leaves[word]]}
+        else:
+            clusters[cluster_id]['children'].append(leaves[word])
+
+    # Put the clusters in the root dictionary
+    # Output: {'name': root, children: [{'name': id, 'children': []}, ...]
+    for cluster in top_clusters:
+        root_dict['children'].append(clusters[cluster])
+
+    return root_dict
+
+
+################################################################################
+#  CITATIONS AND INTENSITY MAPS
+################################################################################
+
+def get_citations(selection):
+    """Returns {pmid: citation} for the studies selected."""
+
+    return Study.get_references(selection.pmids)
+
+
+def get_intensity_map(selection):
+    """Returns the intensity map of a selection, smoothed if it asks for it, or
+    None for a location (the page shows no map for those)."""
+
+    intensity_map = get_raw_intensity_map(selection)
+
+    if intensity_map is not None and selection.fwhm:
+        intensity_map = get_surface_smoother().smooth(intensity_map,
+                                                      selection.fwhm)
+
+    return intensity_map
+
+
+def get_raw_intensity_map(selection):
+    """Returns the unsmoothed intensity map of a selection, or None for a
+    location.
+
+    Clear: an empty map
+    Cluster: intensity mapping associated with a topic cluster
+    Word: intensity mapping associated with a particular word
+    Study: intensity mapping associated with a study cluster"""
+
+    if selection.options == 'cluster':
+        intensity_map = get_intensity_cache().get_cluster_map(selection.cluster)
+
+        if intensity_map is None:
+            intensity_map = get_activation_matrix().get_intensity_for_words(
+                selection.words)
+
+        return intensity_map
+
+    elif selection.options == 'word':
+        intensity_map = get_intensity_cache().get_word_map(selection.word)
+
+        # Weight every study's activations by its frequency for the word
+        if intensity_map is None:
+            intensity_map = get_activation_matrix().get_intensity_for_words(
+                selection.word)
+
+        return intensity_map
+
+    elif selection.options == 'study':
+        # Count the cluster-mate studies reporting each location, scaled in
+        # preparation for intensity mapping
+        return get_study_clusters().get_intensity_map(selection.pmid)
+
+    elif selection.options == 'clear':
+        return empty_map()
+
+    return None
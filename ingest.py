@@ -0,0 +1,275 @@
+"""Parallel, resumable ingest of the seed files in seed.py.
+
+    python ingest.py [--processes N] [--staging DIR] [--force]
+
+Each seed file is parsed in its own worker process into a columnar staging file
+(<staging>/<step>.pickle). A checkpoint records which files have been staged,
+and from which version of the source file, so an interrupted ingest resumes
+instead of parsing everything again.
+
+Once every file is staged, they are merged into a copy of the database, which
+is then renamed over the live one. The live file is never written to, so the
+app never sees half-loaded, emptied or unindexed tables, and servers opening it
+read-only and immutable (model.py's 'serving' profile) keep reading the old
+file until they are reloaded. If the merge fails, the copy is thrown away."""
+
+import os
+import json
+import time
+import shutil
+import sqlite3
+import cPickle as pickle
+from multiprocessing import Pool
+
+from sqlalchemy import create_engine
+
+import seed
+from model import Location, Activation, Study, connect_to_db, db
+from server import app
+
+
+STAGING_DIR = 'staging'
+CHECKPOINT_FILE = 'checkpoint.json'
+
+# The copy of the database merged into, next to it
+MERGE_SUFFIX = '.merging'
+
+# (step name, source file, parser, inserter), in the order they are merged
+STEPS = [
+    ('indices', seed.SURFACE_FILE, seed.parse_indices, seed.insert_indices),
+    ('studies', seed.DATABASE_FILE, seed.parse_studies, seed.insert_studies),
+    ('study_clusters', seed.STUDY_CLUSTERS_FILE, seed.parse_study_clusters,
+     seed.update_study_clusters),
+    ('studies_terms', seed.STUDIES_TERMS_FILE, seed.parse_studies_terms,
+     seed.insert_studies_terms),
+    ('clusters', seed.TOPICS_FILE, seed.parse_clusters, seed.insert_clusters),
+]
+
+
+################################################################################
+# Checkpoint
+################################################################################
+
+def get_signature(path):
+    """Returns (size, modification time) of a file, to tell if it changed."""
+
+    stat = os.stat(path)
+
+    return [stat.st_size, int(stat.st_mtime)]
+
+
+def load_checkpoint(staging_dir):
+    """Returns the checkpoint in a staging directory, or a blank one."""
+
+    path = os.path.join(staging_dir, CHECKPOINT_FILE)
+
+    if not os.path.exists(path):
+        return {'staged': {}, 'merged': None}
+
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+
+def save_checkpoint(staging_dir, checkpoint):
+    """Writes the checkpoint, replacing the old one only once it is complete."""
+
+    path = os.path.join(staging_dir, CHECKPOINT_FILE)
+
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+
+    os.rename(path + '.tmp', path)
+
+
+################################################################################
+# Staging
+################################################################################
+
+def get_staging_path(staging_dir, name):
+    """Returns the path of the staging file of a step."""
+
+    return os.path.join(staging_dir, name + '.pickle')
+
+
+def count_rows(parsed):
+    """Returns the number of rows in parsed columns (the largest table, if
+    a parser returns several)."""
+
+    if not parsed:
+        return 0
+
+    if isinstance(parsed.values()[0], dict):
+        return max(count_rows(table) for table in parsed.values())
+
+    return len(parsed.values()[0])
+
+
+def stage(args):
+    """Parses a seed file into its staging file. Runs in a worker process.
+
+    Returns (step name, signature of the source file, number of rows)."""
+
+    name, source, parser, staging_dir = args
+
+    signature = get_signature(source)
+    parsed = parser(source)
+
+    path = get_staging_path(staging_dir, name)
+    with open(path + '.tmp', 'wb') as staging_file:
+        pickle.dump(parsed, staging_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(path + '.tmp', path)
+
+    return name, signature, count_rows(parsed)
+
+
+def stage_all(staging_dir, checkpoint, processes=None):
+    """Parses, in a process pool, every seed file that was not staged yet or
+    has changed since."""
+
+    pending = [(name, source, parser, staging_dir)
+               for (name, source, parser, _) in STEPS
+               if checkpoint['staged'].get(name) != get_signature(source) or
+               not os.path.exists(get_staging_path(staging_dir, name))]
+
+    print "Staging %d of %d seed files..." % (len(pending), len(STEPS))
+
+    if not pending:
+        return
+
+    started = time.time()
+    total_rows = 0
+    pool = Pool(processes)
+
+    try:
+        for done, (name, signature, rows) in enumerate(
+                pool.imap_unordered(stage, pending), 1):
+            checkpoint['staged'][name] = signature
+            save_checkpoint(staging_dir, checkpoint)
+
+            total_rows += rows
+            print "  %d/%d files staged, %d rows, %.1fs" % (
+                done, len(pending), total_rows, time.time() - started)
+
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+################################################################################
+# Merging
+################################################################################
+
+def get_db_path():
+    """Returns the path of the app's SQLite database file."""
+
+    path = db.engine.url.database
+
+    if db.engine.url.drivername != 'sqlite' or path in (None, '', ':memory:'):
+        raise ValueError("ingest.py merges into a SQLite database file, not %s"
+                         % db.engine.url)
+
+    return os.path.abspath(path)
+
+
+def copy_db(path, copy_path):
+    """Copies a SQLite database file, holding a read lock on it so that no one
+    writes to it halfway through."""
+
+    connection = sqlite3.connect(path)
+
+    try:
+        connection.execute('BEGIN')
+        connection.execute('SELECT count(*) FROM sqlite_master').fetchall()
+        shutil.copyfile(path, copy_path)
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+def merge_all(staging_dir):
+    """Replaces the contents of the tables with the staged files, in a copy of
+    the db that is then moved into place."""
+
+    print "Merging staged files..."
+
+    started = time.time()
+    path = get_db_path()
+    copy_path = path + MERGE_SUFFIX
+
+    copy_db(path, copy_path)
+    engine = create_engine('sqlite:///' + copy_path)
+
+    try:
+        # pysqlite commits any open transaction before DDL, so the indexes are
+        # dropped and rebuilt outside of the merge transaction
+        seed.drop_secondary_indexes(engine)
+
+        with engine.begin() as connection:
+            for model in (Activation, Study, Location):
+                connection.execute(model.__table__.delete())
+
+            for (name, _, _, inserter) in STEPS:
+                with open(get_staging_path(staging_dir, name),
+                          'rb') as staging_file:
+                    inserter(connection, pickle.load(staging_file))
+
+            seed.update_surface_vertices(connection)
+
+        seed.create_secondary_indexes(engine)
+        engine.dispose()
+
+        # Atomic: readers see either the old file or the merged one
+        os.rename(copy_path, path)
+    finally:
+        engine.dispose()
+        if os.path.exists(copy_path):
+            os.remove(copy_path)
+
+    # Connections still open point at the old file
+    db.engine.dispose()
+
+    print "Merged in %.1fs; reload the server to serve it" % (
+        time.time() - started)
+
+
+def ingest(staging_dir=STAGING_DIR, processes=None, force=False):
+    """Stages every seed file that needs it, then merges them all, unless the
+    db already holds exactly these files."""
+
+    if not os.path.exists(staging_dir):
+        os.makedirs(staging_dir)
+
+    checkpoint = load_checkpoint(staging_dir)
+    if force:
+        checkpoint = {'staged': {}, 'merged': None}
+
+    stage_all(staging_dir, checkpoint, processes)
+
+    if checkpoint['merged'] == checkpoint['staged']:
+        print "Database is up to date with the seed files."
+        return
+
+    merge_all(staging_dir)
+
+    checkpoint['merged'] = dict(checkpoint['staged'])
+    save_checkpoint(staging_dir, checkpoint)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--processes', type=int, default=None,
+                        help="worker processes (default: one per core)")
+    parser.add_argument('--staging', default=STAGING_DIR)
+    parser.add_argument('--force', action='store_true',
+                        help="parse and merge everything again")
+    args = parser.parse_args()
+
+    connect_to_db(app)
+    db.create_all()
+
+    ingest_started = time.time()
+    ingest(args.staging, args.processes, args.force)
+    print "Ingest finished in %.1fs" % (time.time() - ingest_started)
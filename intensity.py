@@ -0,0 +1,190 @@
+"""Intensity map engine for Brain Odyssey.
+
+An intensity map holds one value per BrainBrowser surface vertex. Maps are kept
+as dense float32 NumPy arrays indexed by vertex (location ID), so that building,
+scaling and serializing a map are array operations rather than Python loops."""
+
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Number of values in an intensity map, as BrainBrowser reads it. The surface
+# vertices are the location IDs below mesh.SURFACE_VERTICES (81924; see
+# seed.load_indices), so the last value is never lit.
+NUM_VERTICES = 81925
+
+# float32 holds ~7 significant digits, so there is no point writing more
+TEXT_FORMAT = '%.7g'
+
+# Wire formats a map can be sent in, with their media types. BrainBrowser reads
+# the text format, so it comes first and is the default. Binary formats are
+# little-endian:
+#   float32:        one float32 per vertex
+#   uint16, uint8:  one quantized value per vertex; value = q * scale, with
+#                   scale sent in the X-Intensity-Scale header
+#   sparse:         uint32 vertex indices of the non-zero vertices, followed by
+#                   their float32 values; the count is sent in the
+#                   X-Intensity-Count header
+WIRE_FORMATS = OrderedDict([
+    ('text', 'text/plain'),
+    ('float32', 'application/x-intensity-float32'),
+    ('uint16', 'application/x-intensity-uint16'),
+    ('uint8', 'application/x-intensity-uint8'),
+    ('sparse', 'application/x-intensity-sparse'),
+])
+
+# {media type: wire format}, for Accept header negotiation
+MEDIA_TYPES = {media_type: wire_format
+               for wire_format, media_type in WIRE_FORMATS.items()}
+
+
+################################################################################
+#  BUILDING MAPS
+################################################################################
+
+def empty_map():
+    """Returns an intensity map with every vertex set to zero."""
+
+    return np.zeros(NUM_VERTICES, dtype=np.float32)
+
+
+def organize_frequencies_by_study(studies):
+    """Returns sorted PubMed IDs, the word frequency summed for each of them,
+    and the maximal summed frequency, given some raw data from StudyTerm table.
+
+        Args: StudyTerm rows (anything with .pmid and .frequency attributes)
+
+    Used as an intermediate lookup when building final intensity map, in lieu of
+    performing a complex join query."""
+
+    pmids = np.fromiter((study.pmid for study in studies), dtype=np.int64)
+    frequencies = np.fromiter((study.frequency for study in studies),
+                              dtype=np.float64)
+
+    # Sum the frequencies by PubMed ID; unique IDs come back sorted, which lets
+    # us look up activations with searchsorted later on
+    unique_pmids, inverse = np.unique(pmids, return_inverse=True)
+    frequencies_by_pmid = np.bincount(inverse, weights=frequencies)
+
+    max_intensity = frequencies_by_pmid.max() if len(unique_pmids) else 0.0
+
+    return unique_pmids, frequencies_by_pmid, max_intensity
+
+
+def scale_frequencies_by_loc(activations, max_intensity, pmids,
+                             frequencies_by_pmid):
+    """Returns an intensity map of summed word frequencies per location,
+    scaled using the maximal frequency.
+
+        Args:
+            activations: Activation rows (anything with .pmid and .location_id)
+            max_intensity: the value that scales to 1
+            pmids: sorted PubMed IDs, as from organize_frequencies_by_study
+            frequencies_by_pmid: the frequency associated with each PubMed ID"""
+
+    if not max_intensity:
+        return empty_map()
+
+    activation_pmids = np.fromiter(
+        (activation.pmid for activation in activations), dtype=np.int64)
+    location_ids = np.fromiter(
+        (activation.location_id for activation in activations), dtype=np.int64)
+
+    weights = frequencies_by_pmid[np.searchsorted(pmids, activation_pmids)]
+
+    return accumulate_by_location(location_ids, weights / max_intensity)
+
+
+def scale_study_counts(location_ids, counts):
+    """Returns an intensity map of study counts per location, scaled using the
+    maximal count.
+
+        Args: location ids and their study counts, as arrays (see
+            StudyClusterIndex.get_location_counts)"""
+
+    if not len(location_ids):
+        return empty_map()
+
+    counts = counts.astype(np.float64)
+
+    return accumulate_by_location(location_ids, counts / counts.max())
+
+
+def accumulate_by_location(location_ids, weights):
+    """Returns an intensity map where each vertex holds the sum of the weights
+    reported at that location."""
+
+    intensity_map = np.bincount(location_ids, weights=weights,
+                                minlength=NUM_VERTICES)
+
+    return intensity_map[:NUM_VERTICES].astype(np.float32)
+
+
+################################################################################
+#  SERIALIZING MAPS
+################################################################################
+
+def generate_intensity_map(intensity_map):
+    """Returns a string with intensity values for each of 81925 surface
+    locations, one per line, as read by BrainBrowser.
+
+        >>> generate_intensity_map(empty_map())[:6]
+        '0\\n0\\n0\\n'
+    """
+
+    # Most vertices are zero, so only the non-zero ones need formatting
+    values = np.empty(len(intensity_map), dtype=object)
+    values.fill('0')
+
+    nonzero = np.flatnonzero(intensity_map)
+    values[nonzero] = [TEXT_FORMAT % value
+                       for value in intensity_map[nonzero].tolist()]
+
+    return '\n'.join(values) + '\n'
+
+
+def encode_intensity_map(intensity_map, wire_format='text'):
+    """Returns (body, headers) for an intensity map in one of the WIRE_FORMATS.
+
+        >>> body, headers = encode_intensity_map(empty_map(), 'float32')
+        >>> len(body)
+        327700
+        >>> body, headers = encode_intensity_map(empty_map(), 'sparse')
+        >>> body, headers
+        ('', {'X-Intensity-Count': '0'})
+    """
+
+    if wire_format == 'text':
+        return generate_intensity_map(intensity_map), {}
+
+    elif wire_format == 'float32':
+        return intensity_map.astype('<f4').tobytes(), {}
+
+    elif wire_format in ('uint16', 'uint8'):
+        dtype = np.dtype(wire_format).newbyteorder('<')
+        max_value = float(intensity_map.max())
+        scale = max_value / np.iinfo(dtype).max if max_value > 0 else 1.0
+        # In float64, or float32 rounding can put a value on the wrong step
+        quantized = np.rint(intensity_map.astype(np.float64) / scale).astype(
+            dtype)
+
+        return quantized.tobytes(), {'X-Intensity-Scale': repr(scale)}
+
+    elif wire_format == 'sparse':
+        nonzero = np.flatnonzero(intensity_map)
+        body = (nonzero.astype('<u4').tobytes() +
+                intensity_map[nonzero].astype('<f4').tobytes())
+
+        return body, {'X-Intensity-Count': str(len(nonzero))}
+
+    raise ValueError("Unknown intensity wire format: %s" % wire_format)
+
+
+def gzip_body(body, level=6):
+    """Returns body compressed with gzip framing, for Content-Encoding: gzip."""
+
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    return compressor.compress(body) + compressor.flush()
@@ -0,0 +1,187 @@
+"""Precomputed intensity maps for every term and topic cluster.
+
+There are only a few thousand terms and a few hundred clusters, so their maps
+are rendered once, offline, with the same semantics as /intensity:
+
+    python intensity_cache.py [--dtype float16]
+
+This writes a (rows x NUM_VERTICES) matrix to intensity_cache/maps.npy and the
+row of each term and cluster to intensity_cache/rows.json. The server opens the
+matrix memory-mapped and read-only, so serving a map is a row slice, and worker
+processes share the same pages instead of each holding a copy.
+
+rows.json also records the version of the database the maps were rendered from
+(see model.get_data_version). Once the database has been reseeded, migrated or
+swapped, the cache is out of date and is not used, so maps are rendered from
+the activation matrix on request until it is built again."""
+
+import os
+import json
+import logging
+
+import numpy as np
+
+from intensity import NUM_VERTICES
+
+logger = logging.getLogger(__name__)
+
+
+# Default location of the cache
+CACHE_DIR = 'intensity_cache'
+MAPS_FILE = 'maps.npy'
+ROWS_FILE = 'rows.json'
+
+
+class IntensityCache(object):
+    """Intensity maps by term and by topic cluster, one per matrix row."""
+
+    def __init__(self, maps=None, rows_by_word=None, rows_by_cluster=None,
+                 data_version=None):
+        """Args:
+            maps: rows x NUM_VERTICES array (usually memory-mapped)
+            rows_by_word: {word: row}
+            rows_by_cluster: {cluster ID as a string: row}
+            data_version: the version of the database the maps were rendered
+                from, if known"""
+
+        self.maps = maps
+        self.data_version = data_version
+        self.rows_by_word = rows_by_word or {}
+        self.rows_by_cluster = rows_by_cluster or {}
+
+    def __repr__(self):
+        """Displays info about the cache."""
+
+        return "<IntensityCache words=%d clusters=%d>" % (
+            len(self.rows_by_word), len(self.rows_by_cluster))
+
+    ### Look up maps ##########################################################
+
+    def get_word_map(self, word):
+        """Returns the intensity map of a word, or None if it was not cached."""
+
+        return self._get_row(self.rows_by_word.get(word))
+
+    def get_cluster_map(self, cluster_id):
+        """Returns the intensity map of a topic cluster, or None if it was not
+        cached."""
+
+        return self._get_row(self.rows_by_cluster.get(str(cluster_id)))
+
+    def _get_row(self, row):
+        """Returns a float32 copy of a row of the maps matrix."""
+
+        if row is None:
+            return None
+
+        return np.array(self.maps[row], dtype=np.float32)
+
+    ### Build and load ########################################################
+
+    @classmethod
+    def load(cls, path=CACHE_DIR):
+        """Returns the cache saved in a directory, with its maps memory-mapped
+        read-only. If nothing was built there, returns an empty cache."""
+
+        if not os.path.exists(os.path.join(path, ROWS_FILE)):
+            return cls()
+
+        maps = np.load(os.path.join(path, MAPS_FILE), mmap_mode='r')
+
+        with open(os.path.join(path, ROWS_FILE)) as rows_file:
+            rows = json.load(rows_file)
+
+        return cls(maps, rows['words'], rows['clusters'],
+                   rows.get('data_version'))
+
+    @classmethod
+    def build(cls, activation_matrix, words, words_by_cluster, path=CACHE_DIR,
+              dtype=np.float32):
+        """Renders and saves the map of every word and every cluster, then
+        returns the cache loaded from disk.
+
+            Args:
+                activation_matrix: an ActivationMatrix to render maps with
+                words: a list of words
+                words_by_cluster: {cluster ID: [word, word, ...]}
+                path: the directory to save to
+                dtype: float32, or float16 to halve the size"""
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+        clusters = sorted(words_by_cluster)
+
+        # Fill the matrix on disk a row at a time, so it never has to fit in
+        # memory in full
+        maps = np.lib.format.open_memmap(
+            os.path.join(path, MAPS_FILE), mode='w+', dtype=dtype,
+            shape=(len(words) + len(clusters), NUM_VERTICES))
+
+        for row, word in enumerate(words):
+            maps[row] = activation_matrix.get_intensity_for_words(word)
+
+        for row, cluster_id in enumerate(clusters, len(words)):
+            maps[row] = activation_matrix.get_intensity_for_words(
+                words_by_cluster[cluster_id])
+
+        maps.flush()
+        del maps
+
+        rows = {'words': dict((word, row) for row, word in enumerate(words)),
+                'clusters': dict((str(cluster_id), row) for row, cluster_id
+                                 in enumerate(clusters, len(words))),
+                'data_version': activation_matrix.data_version}
+
+        with open(os.path.join(path, ROWS_FILE), 'w') as rows_file:
+            json.dump(rows, rows_file)
+
+        return cls.load(path)
+
+
+_intensity_cache = None
+
+
+def get_intensity_cache():
+    """Returns the shared IntensityCache, loaded from CACHE_DIR, or an empty
+    one if it was built from another version of the database."""
+
+    from model import get_data_version
+
+    global _intensity_cache
+
+    if _intensity_cache is None:
+        _intensity_cache = IntensityCache.load(CACHE_DIR)
+
+        if (_intensity_cache.maps is not None and
+                _intensity_cache.data_version != get_data_version()):
+            logger.warning("%s is out of date with the database; run "
+                           "intensity_cache.py to rebuild it", CACHE_DIR)
+            _intensity_cache = IntensityCache()
+
+    return _intensity_cache
+
+
+if __name__ == "__main__":
+    import argparse
+    from server import app
+    from model import connect_to_db, db, Term, TermCluster
+    from activation_matrix import ActivationMatrix
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dtype', choices=['float32', 'float16'],
+                        default='float32')
+    parser.add_argument('--path', default=CACHE_DIR)
+    args = parser.parse_args()
+
+    connect_to_db(app)
+
+    words_by_cluster = {}
+    for cluster_id, word in db.session.query(TermCluster.cluster_id,
+                                             TermCluster.word).all():
+        words_by_cluster.setdefault(cluster_id, []).append(word)
+
+    cache = IntensityCache.build(ActivationMatrix.from_db(), Term.get_all(),
+                                 words_by_cluster, args.path, args.dtype)
+
+    print "Saved", cache, "to", args.path
@@ -0,0 +1,78 @@
+"""Logging setup for the server and the scripts.
+
+Modules log through logging.getLogger(__name__): what the model looks up at
+DEBUG, the structures built at startup at INFO. Under load the same message
+can be logged many times a second, so each message is logged at most
+RATE_LIMIT times every RATE_PERIOD seconds, followed by a count of those
+dropped."""
+
+import os
+import time
+import logging
+import threading
+
+
+# At most RATE_LIMIT records of the same message every RATE_PERIOD seconds
+RATE_LIMIT = 10
+RATE_PERIOD = 60.0
+
+LOG_FORMAT = '%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'
+
+
+class RateLimitFilter(logging.Filter):
+    """Drops records of a message (a format string, whatever its arguments)
+    logged more than rate times in a period."""
+
+    def __init__(self, rate=RATE_LIMIT, period=RATE_PERIOD):
+        logging.Filter.__init__(self)
+        self.rate = rate
+        self.period = period
+
+        # {(logger, message): [period start, records, dropped]}
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Displays info about the filter."""
+
+        return "<RateLimitFilter rate=%d period=%.0fs>" % (self.rate,
+                                                            self.period)
+
+    def filter(self, record):
+        """Returns whether to log a record."""
+
+        key = (record.name, record.msg)
+        now = time.time()
+
+        with self._lock:
+            counts = self._counts.get(key)
+
+            if counts is None or now - counts[0] >= self.period:
+                dropped = counts[2] if counts else 0
+                counts = self._counts[key] = [now, 0, 0]
+
+                if dropped:
+                    record.msg = '%s (%d similar messages dropped)' % (
+                        record.msg, dropped)
+
+            counts[1] += 1
+
+            if counts[1] > self.rate:
+                counts[2] += 1
+                return False
+
+        return True
+
+
+def configure_logging(level=None):
+    """Logs to stderr at a level (default: $LOG_LEVEL, or INFO), rate limited."""
+
+    level = level or os.environ.get('LOG_LEVEL', 'INFO')
+
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    handler.addFilter(RateLimitFilter())
+
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
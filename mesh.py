@@ -0,0 +1,233 @@
+"""The BrainBrowser surface mesh, parsed once and cached as NumPy arrays.
+
+The surface is an MNI object file (static/models/brain-surface2.obj): the x-y-z
+of each vertex one per line, then their normals, then the polygons, as
+
+    n_items
+    colour_flag colours...
+    end index of each polygon (n_items values)
+    vertex indices of every polygon
+
+The 'P ...' header line that gives the vertex count may be left out, in which
+case the surface has SURFACE_VERTICES vertices. Files that stop after the
+vertices have no faces.
+
+Parsing the text line by line in Python is slow, so it is parsed with NumPy,
+and its vertices, triangles and vertex adjacency (CSR indptr and indices) are
+saved as .npy files under mesh_cache/<MD5 of the file>/. Later loads hash the
+file and memory-map the arrays, so editing the file invalidates the cache and
+worker processes share the same pages."""
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+
+SURFACE_FILE = 'static/models/brain-surface2.obj'
+
+# Vertices of the surface when the file has no header (location IDs 0-81923)
+SURFACE_VERTICES = 81924
+
+# Default location of the cache
+CACHE_DIR = 'mesh_cache'
+ARRAYS = ['vertices', 'faces', 'adjacency_indptr', 'adjacency_indices']
+
+# Colour values in an MNI object file, per colour_flag: one RGBA colour for the
+# whole object, one per polygon or one per vertex
+COLOURS_PER_FLAG = {0: lambda items, vertices: 4,
+                    1: lambda items, vertices: 4 * items,
+                    2: lambda items, vertices: 4 * vertices}
+
+
+class SurfaceMesh(object):
+    """Vertices, triangles and vertex adjacency of the surface."""
+
+    def __init__(self, vertices, faces, adjacency_indptr, adjacency_indices):
+        """Args:
+            vertices: vertices x 3 float64 array of x-y-z coordinates; the row
+                of a vertex is its location ID
+            faces: triangles x 3 int32 array of vertex indices
+            adjacency_indptr, adjacency_indices: the neighbors of vertex v are
+                adjacency_indices[adjacency_indptr[v]:adjacency_indptr[v + 1]]
+        """
+
+        self.vertices = vertices
+        self.faces = faces
+        self.adjacency_indptr = adjacency_indptr
+        self.adjacency_indices = adjacency_indices
+
+    def __repr__(self):
+        """Displays info about the mesh."""
+
+        return "<SurfaceMesh vertices=%d faces=%d>" % (len(self.vertices),
+                                                       len(self.faces))
+
+    @property
+    def adjacency(self):
+        """Vertices x vertices CSR matrix, 1 for vertices sharing an edge."""
+
+        num_vertices = len(self.vertices)
+
+        return sparse.csr_matrix(
+            (np.ones(len(self.adjacency_indices), dtype=np.int8),
+             self.adjacency_indices, self.adjacency_indptr),
+            shape=(num_vertices, num_vertices))
+
+    def get_neighbors(self, vertex):
+        """Returns the vertices sharing an edge with a vertex."""
+
+        return self.adjacency_indices[self.adjacency_indptr[vertex]:
+                                      self.adjacency_indptr[vertex + 1]]
+
+    ### Parse, save and load ##################################################
+
+    @classmethod
+    def parse(cls, path=SURFACE_FILE):
+        """Returns the mesh of an MNI object file, parsed from the text."""
+
+        vertices, faces = parse_obj(path)
+        indptr, indices = build_adjacency(faces, len(vertices))
+
+        return cls(vertices, faces, indptr, indices)
+
+    @classmethod
+    def load(cls, path=SURFACE_FILE, cache_dir=CACHE_DIR):
+        """Returns the mesh of a file, memory-mapped from the cache, parsing
+        and caching it first if it was never cached."""
+
+        directory = os.path.join(cache_dir, get_file_hash(path))
+
+        if not os.path.exists(directory):
+            logger.info("Parsing surface mesh %s...", path)
+            cls.parse(path).save(directory)
+
+        return cls(*[np.load(os.path.join(directory, name + '.npy'),
+                             mmap_mode='r') for name in ARRAYS])
+
+    def save(self, directory):
+        """Writes the arrays to a directory, as .npy files.
+
+        The files are written to a temporary directory which is then renamed,
+        so that processes loading the mesh never see half of it."""
+
+        parent = os.path.dirname(os.path.abspath(directory))
+
+        if not os.path.exists(parent):
+            os.makedirs(parent)
+
+        staging = tempfile.mkdtemp(dir=parent)
+
+        try:
+            for name in ARRAYS:
+                np.save(os.path.join(staging, name + '.npy'),
+                        getattr(self, name))
+            os.rename(staging, directory)
+        except OSError:
+            # Another process cached the same file first
+            if not os.path.exists(directory):
+                raise
+        finally:
+            if os.path.exists(staging):
+                shutil.rmtree(staging)
+
+
+################################################################################
+#  Parsing
+################################################################################
+
+def parse_obj(path):
+    """Returns (vertices x 3 float64 array, triangles x 3 int32 array) read
+    from an MNI object file."""
+
+    with open(path, 'rb') as obj_file:
+        text = obj_file.read()
+
+    num_vertices = SURFACE_VERTICES
+
+    if text.lstrip()[:1] == 'P':
+        header, text = text.lstrip().split('\n', 1)
+        num_vertices = int(header.split()[6])
+
+    # Everything after the header is numbers, so one C-level pass reads them
+    numbers = np.fromstring(text, dtype=np.float64, sep=' ')
+
+    if len(numbers) < 3 * num_vertices:
+        raise ValueError("%s has fewer than %d vertices" % (path, num_vertices))
+
+    vertices = numbers[:3 * num_vertices].reshape(num_vertices, 3)
+
+    # Skip the normals
+    polygons = numbers[6 * num_vertices:]
+
+    if not len(polygons):
+        return vertices, np.zeros((0, 3), dtype=np.int32)
+
+    num_items, colour_flag = int(polygons[0]), int(polygons[1])
+    start = 2 + COLOURS_PER_FLAG[colour_flag](num_items, num_vertices)
+
+    end_indices = polygons[start:start + num_items].astype(np.int64)
+    indices = polygons[start + num_items:].astype(np.int32)
+
+    if (len(indices) != end_indices[-1] or
+            (np.diff(np.concatenate([[0], end_indices])) != 3).any()):
+        raise ValueError("%s is not a triangle mesh" % path)
+
+    return vertices, indices.reshape(-1, 3)
+
+
+def build_adjacency(faces, num_vertices):
+    """Returns (indptr, indices) int32 CSR arrays of the vertices sharing an
+    edge with each vertex, sorted."""
+
+    first = faces.ravel()
+    second = faces[:, [1, 2, 0]].ravel()
+
+    adjacency = sparse.coo_matrix(
+        (np.ones(2 * len(first), dtype=np.int8),
+         (np.concatenate([first, second]), np.concatenate([second, first]))),
+        shape=(num_vertices, num_vertices)).tocsr()
+    adjacency.sort_indices()
+
+    return (adjacency.indptr.astype(np.int32),
+            adjacency.indices.astype(np.int32))
+
+
+def get_file_hash(path):
+    """Returns the MD5 hex digest of a file's contents."""
+
+    digest = hashlib.md5()
+
+    with open(path, 'rb') as hashed_file:
+        for block in iter(lambda: hashed_file.read(1 << 20), ''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+def round_half_away(values):
+    """Rounds to integers, halves away from zero, as Python 2's round()
+    does."""
+
+    return np.sign(values) * np.floor(np.abs(values) + 0.5)
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--path', default=SURFACE_FILE)
+    parser.add_argument('--cache-dir', default=CACHE_DIR)
+    args = parser.parse_args()
+
+    started = time.time()
+    mesh = SurfaceMesh.load(args.path, args.cache_dir)
+
+    print "Loaded", mesh, "in %.3fs" % (time.time() - started)
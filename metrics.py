@@ -0,0 +1,268 @@
+"""Per-request latency and query instrumentation, in Prometheus text format.
+
+For every request, by route:
+
+    brainodyssey_request_seconds          wall time
+    brainodyssey_request_sql_queries      SQL statements executed
+    brainodyssey_request_sql_seconds      time spent executing them
+    brainodyssey_request_rows_fetched     rows read from the database
+    brainodyssey_request_serialize_seconds   time spent encoding the response
+
+SQL statements are timed with SQLAlchemy engine events, and rows are counted
+as they are fetched from the DBAPI cursor. Serialization is whatever a view
+runs inside serializing(). The response cache counters are exported too.
+
+Metrics are kept per process: with serve.py, each worker reports its own."""
+
+import time
+import threading
+from contextlib import contextmanager
+
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+PREFIX = 'brainodyssey_'
+
+# Histogram buckets: latencies in seconds, and counts
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 1000, 10000, 100000, 1000000)
+
+
+class Histogram(object):
+    """A Prometheus histogram, labelled by route."""
+
+    def __init__(self, name, description, buckets):
+        self.name = PREFIX + name
+        self.description = description
+        self.buckets = buckets
+
+        # {route: [count per bucket..., sum, count]}
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Displays info about the histogram."""
+
+        return "<Histogram name=%s routes=%d>" % (self.name, len(self._values))
+
+    def observe(self, route, value):
+        """Records a value for a route."""
+
+        with self._lock:
+            values = self._values.get(route)
+
+            if values is None:
+                values = self._values[route] = [0] * (len(self.buckets) + 2)
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+
+            values[-2] += value
+            values[-1] += 1
+
+    def clear(self):
+        """Forgets every value recorded."""
+
+        with self._lock:
+            self._values.clear()
+
+    def render(self):
+        """Returns the histogram in Prometheus text format."""
+
+        lines = ['# HELP %s %s' % (self.name, self.description),
+                 '# TYPE %s histogram' % self.name]
+
+        with self._lock:
+            for route, values in sorted(self._values.items()):
+                label = 'route="%s"' % escape_label(route)
+
+                for bound, count in zip(self.buckets, values):
+                    lines.append('%s_bucket{%s,le="%s"} %d' % (
+                        self.name, label, format_value(bound), count))
+
+                lines.append('%s_bucket{%s,le="+Inf"} %d' % (
+                    self.name, label, values[-1]))
+                lines.append('%s_sum{%s} %s' % (self.name, label,
+                                                format_value(values[-2])))
+                lines.append('%s_count{%s} %d' % (self.name, label, values[-1]))
+
+        return '\n'.join(lines)
+
+
+request_seconds = Histogram(
+    'request_seconds', 'Wall time per request.', SECONDS_BUCKETS)
+sql_queries = Histogram(
+    'request_sql_queries', 'SQL statements executed per request.',
+    COUNT_BUCKETS)
+sql_seconds = Histogram(
+    'request_sql_seconds', 'Time executing SQL per request.', SECONDS_BUCKETS)
+rows_fetched = Histogram(
+    'request_rows_fetched', 'Rows fetched from the database per request.',
+    COUNT_BUCKETS)
+serialize_seconds = Histogram(
+    'request_serialize_seconds', 'Time encoding the response per request.',
+    SECONDS_BUCKETS)
+
+HISTOGRAMS = [request_seconds, sql_queries, sql_seconds, rows_fetched,
+              serialize_seconds]
+
+
+def escape_label(value):
+    """Escapes a Prometheus label value."""
+
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_value(value):
+    """Formats a number for Prometheus."""
+
+    return repr(float(value))
+
+
+################################################################################
+#  Collecting
+################################################################################
+
+class CountingCursor(object):
+    """Wraps a DBAPI cursor to count the rows fetched from it."""
+
+    def __init__(self, cursor, stats):
+        self._cursor = cursor
+        self._stats = stats
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._stats['rows'] += 1
+            yield row
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._stats['rows'] += 1
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._cursor.fetchmany(*args)
+        self._stats['rows'] += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._stats['rows'] += len(rows)
+        return rows
+
+
+def get_request_stats():
+    """Returns the stats of the current request, or None outside of one."""
+
+    if not has_request_context():
+        return None
+
+    return getattr(g, 'metrics', None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    """Notes when a statement starts."""
+
+    if get_request_stats() is not None:
+        conn.info.setdefault('query_started', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    """Adds a statement's time to the request, and counts the rows fetched
+    from its cursor from now on."""
+
+    stats = get_request_stats()
+
+    if stats is None or not conn.info.get('query_started'):
+        return
+
+    stats['sql_queries'] += 1
+    stats['sql_seconds'] += time.time() - conn.info['query_started'].pop()
+
+    if context is not None and context.cursor is cursor:
+        context.cursor = CountingCursor(cursor, stats)
+
+
+@contextmanager
+def serializing():
+    """Counts the time spent in a with block as response serialization."""
+
+    started = time.time()
+
+    try:
+        yield
+    finally:
+        stats = get_request_stats()
+        if stats is not None:
+            stats['serialize_seconds'] += time.time() - started
+
+
+def start_request():
+    """Starts collecting stats for the current request."""
+
+    g.metrics = {'started': time.time(), 'sql_queries': 0, 'sql_seconds': 0.0,
+                 'rows': 0, 'serialize_seconds': 0.0}
+
+
+def finish_request(response):
+    """Records the stats of the current request."""
+
+    stats = get_request_stats()
+
+    if stats is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+
+        request_seconds.observe(route, time.time() - stats['started'])
+        sql_queries.observe(route, stats['sql_queries'])
+        sql_seconds.observe(route, stats['sql_seconds'])
+        rows_fetched.observe(route, stats['rows'])
+        serialize_seconds.observe(route, stats['serialize_seconds'])
+
+    return response
+
+
+def init_app(app):
+    """Collects metrics for every request to app."""
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
+
+
+################################################################################
+#  Exporting
+################################################################################
+
+def render_metrics():
+    """Returns every metric in Prometheus text format."""
+
+    from response_cache import response_cache
+
+    sections = [histogram.render() for histogram in HISTOGRAMS]
+
+    for name, kind, description, value in [
+            ('response_cache_hits_total', 'counter',
+             'Responses served from the response cache.', response_cache.hits),
+            ('response_cache_misses_total', 'counter',
+             'Responses not found in the response cache.',
+             response_cache.misses),
+            ('response_cache_evictions_total', 'counter',
+             'Responses evicted from the response cache.',
+             response_cache.evictions),
+            ('response_cache_bytes', 'gauge',
+             'Total size of the cached responses.', response_cache.size)]:
+        sections.append('# HELP %s%s %s\n# TYPE %s%s %s\n%s%s %d' % (
+            PREFIX, name, description, PREFIX, name, kind, PREFIX, name, value))
+
+    return '\n'.join(sections) + '\n'
@@ -0,0 +1,96 @@
+"""Adds any column or index declared in model.py that the database does not
+have yet.
+
+    python migrate.py
+
+Seeding builds every declared column and index, so this is only needed for
+databases seeded before one was added. Existing indexes are left alone, and the
+query planner statistics are refreshed afterwards (ANALYZE) so that SQLite
+picks the new covering indexes. Locations without a surface vertex are then
+projected onto the surface (see seed.update_surface_vertices)."""
+
+import time
+
+from model import connect_to_db, db
+from seed import update_surface_vertices
+from server import app
+
+
+def get_existing_columns(table):
+    """Returns the names of the columns of a table in the database."""
+
+    rows = db.engine.execute("PRAGMA table_info(%s)" % table.name).fetchall()
+
+    return set(row[1] for row in rows)
+
+
+def get_missing_columns():
+    """Returns the columns declared in model.py that the database lacks."""
+
+    return [column for table in db.metadata.sorted_tables
+            for column in table.columns
+            if column.name not in get_existing_columns(table)]
+
+
+def get_existing_indexes():
+    """Returns the names of the indexes in the database."""
+
+    rows = db.engine.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'index'").fetchall()
+
+    return set(row[0] for row in rows)
+
+
+def get_missing_indexes():
+    """Returns the indexes declared in model.py that the database lacks."""
+
+    existing = get_existing_indexes()
+
+    return [index for table in db.metadata.sorted_tables
+            for index in sorted(table.indexes, key=lambda index: index.name)
+            if index.name not in existing]
+
+
+def add_column(column):
+    """Adds a nullable column to its table."""
+
+    db.engine.execute('ALTER TABLE %s ADD COLUMN %s %s' % (
+        column.table.name, column.name,
+        column.type.compile(dialect=db.engine.dialect)))
+
+
+def migrate():
+    """Adds every missing column and builds every missing index, then
+    refreshes the planner statistics and fills in the surface vertices."""
+
+    columns = get_missing_columns()
+
+    print "%d missing columns" % len(columns)
+
+    for column in columns:
+        add_column(column)
+        print "  Added %s.%s" % (column.table.name, column.name)
+
+    missing = get_missing_indexes()
+
+    print "%d missing indexes" % len(missing)
+
+    for index in missing:
+        started = time.time()
+        index.create(bind=db.engine)
+        print "  Built %s on %s(%s) in %.1fs" % (
+            index.name, index.table.name,
+            ', '.join(column.name for column in index.columns),
+            time.time() - started)
+
+    if missing:
+        db.engine.execute('ANALYZE')
+        print "Analyzed database."
+
+    with db.engine.begin() as connection:
+        update_surface_vertices(connection)
+
+
+if __name__ == "__main__":
+    connect_to_db(app)
+    migrate()
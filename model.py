@@ -1,13 +1,146 @@
 """Models and database functions for Brain Odyssey project"""
 
 
+import os
+import logging
+import sqlite3
+import urllib
+
+import numpy as np
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import func, desc, Index
+from sqlalchemy import func, desc, select, Index
+from sqlalchemy.pool import SingletonThreadPool
 from sqlalchemy.sql import label
 
+logger = logging.getLogger(__name__)
+
+# The database used unless told otherwise; $DATABASE_URI points the server,
+# seed.py and the scripts at another one (e.g. a synthetic dataset)
+DB_URI = os.environ.get('DATABASE_URI', 'sqlite:///odyssey_v2.db')
+
+# SQLite settings by use, selected with the DB_PROFILE config key (see
+# connect_to_db). Pragmas are run on every new connection.
+DB_PROFILES = {
+    # Flask-SQLAlchemy's defaults: a new read-write connection per session
+    'default': {'read_only': False, 'pool': None, 'pragmas': []},
+
+    # The served database never changes: open it read-only and immutable (no
+    # file locking or change detection), memory-map it, and keep one warm
+    # connection, with its page cache, per thread. Reseed a copy and move it
+    # into place, then reload the server, rather than writing to it in place.
+    'serving': {'read_only': True, 'pool': SingletonThreadPool,
+                'pragmas': ['mmap_size = 1073741824',
+                            'cache_size = -262144',
+                            'temp_store = MEMORY']},
+
+    # Bulk loads: no rollback journal and no fsyncs. A crash mid-seed means
+    # reseeding from scratch anyway. Not for ingest.py, whose merge relies on
+    # rolling back.
+    'seeding': {'read_only': False, 'pool': None,
+                'pragmas': ['journal_mode = OFF',
+                            'synchronous = OFF',
+                            'cache_size = -262144',
+                            'temp_store = MEMORY']},
+}
+
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy, opening SQLite databases with the app's DB_PROFILE."""
+
+    def apply_driver_hacks(self, app, info, options):
+        super(ProfiledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+
+        profile = DB_PROFILES[app.config.get('DB_PROFILE', 'default')]
+
+        if info.drivername != 'sqlite' or info.database in (None, '', ':memory:'):
+            return
+
+        if profile['pool']:
+            options['poolclass'] = profile['pool']
+
+        if profile['read_only'] or profile['pragmas']:
+            options['creator'] = make_connector(info.database, profile)
+
+
+def make_connector(path, profile):
+    """Returns a function opening a SQLite connection to a file with the
+    settings of a profile.
+
+    Read-only connections are opened through a URI (mode=ro&immutable=1) when
+    the SQLite library supports URIs. Otherwise they are opened as usual, with
+    an authorizer denying writes to the database (see deny_writes)."""
+
+    guard = profile['read_only'] and not supports_uri()
+
+    if profile['read_only'] and not guard:
+        target = 'file:%s?mode=ro&immutable=1' % urllib.quote(path)
+    else:
+        target = path
+
+    if guard:
+        logger.warning("SQLite does not support URIs; opening %s read-write "
+                       "with writes denied", path)
 
+    def connect():
+        connection = sqlite3.connect(target, check_same_thread=False)
+        for pragma in profile['pragmas']:
+            connection.execute('PRAGMA ' + pragma)
+        if guard:
+            connection.set_authorizer(deny_writes)
+        return connection
 
-db = SQLAlchemy()
+    return connect
+
+
+# Authorizer actions that change a database
+WRITE_ACTIONS = frozenset([
+    sqlite3.SQLITE_INSERT, sqlite3.SQLITE_UPDATE, sqlite3.SQLITE_DELETE,
+    sqlite3.SQLITE_CREATE_TABLE, sqlite3.SQLITE_CREATE_INDEX,
+    sqlite3.SQLITE_CREATE_VIEW, sqlite3.SQLITE_CREATE_TRIGGER,
+    sqlite3.SQLITE_DROP_TABLE, sqlite3.SQLITE_DROP_INDEX,
+    sqlite3.SQLITE_DROP_VIEW, sqlite3.SQLITE_DROP_TRIGGER,
+    sqlite3.SQLITE_ALTER_TABLE, sqlite3.SQLITE_REINDEX, sqlite3.SQLITE_ANALYZE])
+
+
+def deny_writes(action, arg1, arg2, database, source):
+    """SQLite authorizer denying any change to the main database, and
+    attaching others. TEMP tables, such as the key tables of in_keys, can
+    still be written."""
+
+    if action == sqlite3.SQLITE_ATTACH or (action in WRITE_ACTIONS and
+                                           database == 'main'):
+        return sqlite3.SQLITE_DENY
+
+    return sqlite3.SQLITE_OK
+
+
+def supports_uri():
+    """Returns True if sqlite3.connect interprets file: URIs."""
+
+    options = sqlite3.connect(':memory:').execute(
+        'PRAGMA compile_options').fetchall()
+
+    return ('USE_URI',) in options
+
+
+db = ProfiledSQLAlchemy()
+
+# Rows fetched from the cursor at a time by fetch_columns
+FETCH_BATCH_SIZE = 10000
+
+# Key sets bigger than this are passed to queries through a temporary table
+# instead of an IN (...) list (SQLite allows 999 parameters per statement)
+MAX_IN_KEYS = 500
+
+# Session-scoped temporary tables holding such key sets (see in_keys). They
+# belong to their own metadata so that create_all() leaves them alone.
+key_metadata = db.MetaData()
+integer_keys = db.Table('integer_keys', key_metadata,
+                        db.Column('key', db.Integer, primary_key=True),
+                        prefixes=['TEMPORARY'])
+text_keys = db.Table('text_keys', key_metadata,
+                     db.Column('key', db.String, primary_key=True),
+                     prefixes=['TEMPORARY'])
 
 ###########################################################################
 # MODEL DEFINITIONS
@@ -41,8 +174,14 @@ class Location(db.Model):
     label = db.Column(db.String, nullable=True)
     # space = db.Column(db.String(30), nullable=True)  # MNI, TAL or Unknown
 
+    # The surface vertex (location ID < 81924) nearest to the location, on
+    # which its activations are mapped; set by seed.update_surface_vertices
+    surface_vertex = db.Column(db.Integer, nullable=True)
+
     activation = db.relationship('Activation')
-    __table_args__ = (Index('location_index', 'x_coord', 'y_coord', 'z_coord'),)
+    __table_args__ = (Index('location_index', 'x_coord', 'y_coord', 'z_coord'),
+                      Index('location_vertex_index', 'surface_vertex',
+                            'location_id'),)
 
 
     def __repr__(self):
@@ -112,6 +251,11 @@ class Activation(db.Model):
     study = db.relationship('Study')
     location = db.relationship('Location')
 
+    # Covering indexes: studies -> locations for intensity maps, and
+    # locations -> studies for location clicks
+    __table_args__ = (Index('activation_pmid_index', 'pmid', 'location_id'),
+                      Index('activation_location_index', 'location_id', 'pmid'),)
+
     def __repr__(self):
         """Displays info about an activation."""
 
@@ -130,12 +274,9 @@ class Activation(db.Model):
             Examples:
 
             >>> Activation.get_pmids_from_xyz(-60, 0, -30, 3)
-            Getting all studies with radius 3
             [15737663, 16481375, 17121746, 21908871]
 
             >>> Activation.get_pmids_from_xyz(-60, 0, -30, 2)
-            Getting all studies with radius 2
-            Getting all studies with radius 3
             [15737663, 16481375, 17121746, 21908871]
 
         """
@@ -143,7 +284,7 @@ class Activation(db.Model):
         # If the radius is provided, use it to get studies reporting activation
         # in locations within +/- n millimeters of xyz
         if radius:
-            print "Getting all studies with radius", radius
+            logger.debug("Getting all studies with radius %s", radius)
             pmids = db.session.query(cls.pmid).join(Location).filter(
                 Location.x_coord < (x_coord + radius),
                 Location.x_coord > (x_coord - radius),
@@ -177,44 +318,67 @@ class Activation(db.Model):
 
     @classmethod
     def get_activations_from_studies(cls, studies):
-        """Returns activations from a specified set of studies, reporting
-        activation on the brain surface.
+        """Returns (pmid, location_id) for the activations of a specified set
+        of studies, each mapped onto the surface: location_id is the surface
+        vertex nearest to the activation.
 
             Args: a list of PubMed study identifiers
 
             Example:
             >>> Activation.get_activations_from_studies([25619848]) # doctest +NORMALIZE_WHITESPACE
-            [<Activation pmid=25619848 location_id=1459>, 
-            <Activation pmid=25619848 location_id=81891>]
+            [(25619848, 1459), (25619848, 81891)]
 
         Used to generate intensity maps.
         """
 
-        activations = cls.query.filter(
-            cls.pmid.in_(studies), cls.location_id < 81925).all()
+        activations = db.session.query(
+            cls.pmid, Location.surface_vertex.label('location_id')).join(
+            Location).filter(in_keys(cls.pmid, studies),
+                             Location.surface_vertex != None).all()
 
         return activations
 
+    @classmethod
+    def get_activation_columns(cls, studies=None):
+        """Returns the activations of a set of studies mapped onto the
+        surface, as two arrays, (int32 PubMed IDs, int32 surface vertices).
+
+            Args: a list of PubMed study identifiers (default: all studies)
+
+        Columnar version of get_activations_from_studies, used to build the
+        in-memory indexes."""
+
+        query = select([cls.pmid, Location.surface_vertex]).select_from(
+            cls.__table__.join(Location.__table__)).where(
+            Location.surface_vertex != None)
+
+        if studies is not None:
+            query = query.where(in_keys(cls.pmid, studies))
+
+        return fetch_columns(query, [np.int32, np.int32])
+
 ### Look up the number of studies associated with a location ##################
 
     @classmethod
     def get_location_count_from_studies(cls, studies):
-        """Returns activations (location_id, study count), 
-        limited to surface locations only.
+        """Returns (location_id, study count) for each surface vertex onto
+        which the activations of some studies are mapped.
 
             Args: a list of PubMed study identifiers
 
-            Example:    
-            >>> Activation.get_activations_from_studies([25619848])
-            [<Activation pmid=25619848 location_id=1459>, <Activation pmid=25619848 location_id=81891>]
+            Example:
+            >>> Activation.get_location_count_from_studies([25619848])
+            [(1459, 1), (81891, 1)]
 
         Used to generate intensity maps when user clicks on a reference, with
         study counts used to derive intensity map in lieu of word frequency metrics.
         """
 
-        activations = db.session.query(cls.location_id, func.count(cls.pmid
-            )).filter(cls.pmid.in_(studies), cls.location_id < 81925
-            ).group_by(cls.pmid).all()
+        activations = db.session.query(
+            Location.surface_vertex, func.count(func.distinct(cls.pmid))
+            ).select_from(cls).join(Location).filter(
+            in_keys(cls.pmid, studies), Location.surface_vertex != None
+            ).group_by(Location.surface_vertex).all()
 
         return activations
 
@@ -235,6 +399,8 @@ class Study(db.Model):
     journal = db.Column(db.String(200))
     study_cluster = db.Column(db.Integer)
 
+    __table_args__ = (Index('study_cluster_index', 'study_cluster'),)
+
 
     ### Check if study is already in db ########################################
 
@@ -246,7 +412,7 @@ class Study(db.Model):
 
         Used in database seeding."""
 
-        print "Found study ", pmid
+        logger.debug("Found study %s", pmid)
         study_obj = cls.query.filter(cls.pmid == pmid).first()
         return study_obj
 
@@ -267,16 +433,31 @@ class Study(db.Model):
         
         Used to display reference list."""
 
-        references = cls.query.filter(cls.pmid.in_(pmids)).all()
+        pmids, authors, years, titles, journals = cls.get_reference_columns(
+            pmids)
         citations = {}
 
-        for reference in references:
-            citation_text = reference.authors + ". (" + str(
-                reference.year) + "). " + reference.title + " " + reference.journal + "."
-            citations[reference.pmid] = citation_text
+        for pmid, author, year, title, journal in zip(
+                pmids.tolist(), authors, years.tolist(), titles, journals):
+            citation_text = author + ". (" + str(
+                year) + "). " + title + " " + journal + "."
+            citations[pmid] = citation_text
 
         return citations
 
+    @classmethod
+    def get_reference_columns(cls, pmids):
+        """Returns the citation fields of some studies as arrays: (int32
+        PubMed IDs, authors, int32 years, titles, journals).
+
+            Args: a list of PubMed ids"""
+
+        query = select([cls.pmid, cls.authors, cls.year, cls.title,
+                        cls.journal]).where(in_keys(cls.pmid, pmids))
+
+        return fetch_columns(query, [np.int32, object, np.int32, object,
+                                     object])
+
     ### Retrieve studies associated with a study cluster #######################
 
     def get_cluster_mates(self):
@@ -286,18 +467,18 @@ class Study(db.Model):
 
             Example:
             >>> study = Study.get_study_by_pmid(15737663) # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
-            Found study  15737663
             >>> study.get_cluster_mates()
-            Getting all cluster mates associated with cluster  62
             [14625150, 15737663, 16284946, 17032778, 17428684, 17686466, 
             ... 24316200, 24352030, 24478326, 24553284, 24760847, 25554429]
         
         """
 
-        print "Getting all cluster mates associated with cluster ", self.study_cluster
-        cluster_mates = Study.query.filter(Study.study_cluster == self.study_cluster).all()
+        logger.debug("Getting all cluster mates associated with cluster %s",
+                     self.study_cluster)
+        cluster_mates = db.session.query(Study.pmid).filter(
+            Study.study_cluster == self.study_cluster).all()
 
-        return [cluster_mate.pmid for cluster_mate in cluster_mates]
+        return [cluster_mate[0] for cluster_mate in cluster_mates]
 
 
     ### Get information about a study ########################################
@@ -329,6 +510,11 @@ class StudyTerm(db.Model):
     term = db.relationship('Term', backref="studies_terms")
     study = db.relationship('Study', backref="studies_terms")
 
+    # Covering indexes: word -> studies by frequency (get_by_word,
+    # get_pmid_by_term), and study -> words by frequency (get_terms_by_pmid)
+    __table_args__ = (Index('studyterm_word_index', 'word', 'frequency', 'pmid'),
+                      Index('studyterm_pmid_index', 'pmid', 'frequency', 'word'),)
+
 
     ### Get information about a study topic ##################################
 
@@ -353,7 +539,6 @@ class StudyTerm(db.Model):
 
             >>> StudyTerm.get_terms_by_pmid([15737663, 16481375, 17121746, 21908871])
             # doctest: +ELLIPSIS +NORMALIZE_WHITESPACE
-            Getting all terms from studies [15737663, 16481375, 17121746, 21908871]
             ([(u'stress', 0.648257962749), (u'asd', 0.536948763846),
                 (u'voice', 0.522110847073), (u'children', 0.390914181003), ...
                 u'patient group', u'modulating', u'shifting', u'group',
@@ -361,10 +546,10 @@ class StudyTerm(db.Model):
 
         Used to generate JSON for D3."""
 
-        print "Getting all terms from studies", pmids
+        logger.debug("Getting all terms from %d studies", len(pmids))
 
         terms = db.session.query(cls.word, cls.frequency).filter(
-            cls.pmid.in_(pmids)).order_by(desc(cls.frequency)).limit(lim).all()
+            in_keys(cls.pmid, pmids)).order_by(desc(cls.frequency)).limit(lim).all()
 
         # Terms will be used to build a json dictionary;
         # (Term, freq) lists will be used to constrain the cluster search
@@ -383,11 +568,11 @@ class StudyTerm(db.Model):
 
         PMIDs used to generate references."""
 
-        print "Getting all studies associated with ", word
+        logger.debug("Getting all studies associated with %s", word)
 
         if isinstance(word, list):
             pmids = db.session.query(cls.pmid).filter(
-                cls.word.in_(word)).group_by(
+                in_keys(cls.word, word)).group_by(
                 cls.pmid).order_by(
                 cls.frequency).limit(limit).all()
 
@@ -402,21 +587,19 @@ class StudyTerm(db.Model):
     ### Retrieve term frequencies assoc. with studies  #######################
 
     @classmethod
-    def get_by_word(cls, word, limit=1000):
+    def get_by_word(cls, word, limit=None):
         """Returns a list of db rows where the study mentions some desired word(s)
         at or above a given frequency threshold.
 
             Args: 
                 word: a word 'word' or list of words ['word', 'word', 'word'...]
-                limit: the number of rows to return (default is 1000; anything
-                    more than this will cause the in_ statement in the query to
-                    fail)
+                limit: the number of rows to return (default is all of them)
 
         Used to build intensity maps."""
 
         if isinstance(word, list):
             pmidfreqs = cls.query.filter(
-                cls.word.in_(word)).order_by(desc(cls.frequency)).limit(limit).all()
+                in_keys(cls.word, word)).order_by(desc(cls.frequency)).limit(limit).all()
 
         else:
             pmidfreqs = cls.query.filter(
@@ -492,6 +675,10 @@ class TermCluster(db.Model):
     term = db.relationship('Term', backref="terms_clusters")
     cluster = db.relationship('Cluster', backref="terms_clusters")
 
+    # Covering indexes in both directions between words and clusters
+    __table_args__ = (Index('termcluster_word_index', 'word', 'cluster_id'),
+                      Index('termcluster_cluster_index', 'cluster_id', 'word'),)
+
     def __repr__(self):
         """Displays info about a term-cluster association."""
 
@@ -512,16 +699,16 @@ class TermCluster(db.Model):
                 n: the number of clusters to return (depends on D3 display)
 
             >>> TermCluster.get_top_clusters([u'accurate', u'addiction', u'advantage', u'agreement', u'alzheimer'])
-            Getting the top clusters associated with terms [u'accurate', u'addiction', u'advantage', u'agreement', u'alzheimer']
             [35, 98, 100, 228, 231, 304, 305, 306, 338, 377, 379, 393]
         
         Used to generate D3."""
 
-        print "Getting the top clusters associated with ", terms[0:25]
+        logger.debug("Getting the top clusters associated with %s", terms
+                     if not isinstance(terms, list) else '%d terms' % len(terms))
 
         if isinstance(terms, list):
             clusters = db.session.query(cls.cluster_id).filter(
-                cls.word.in_(terms)).group_by(cls.cluster_id).order_by(desc(
+                in_keys(cls.word, terms)).group_by(cls.cluster_id).order_by(desc(
                 func.count(cls.word))).limit(n).all()
 
         else:
@@ -542,16 +729,15 @@ class TermCluster(db.Model):
                 clusters: a list of cluster IDs [0, 56, 200, ...]
 
             >>> TermCluster.get_word_cluster_pairs([133], [u'disease'])
-            Getting the associations with clusters [133]
             [(133, u'disease')]
 
         Used to get word-cluster associations for D3, with respect to a set of words
         associated with a location, and a set of 'most talked about' clusters."""
 
-        print "Getting the associations with clusters", clusters
+        logger.debug("Getting the associations with %d clusters", len(clusters))
 
         associations = db.session.query(cls.cluster_id, cls.word).filter(
-            cls.cluster_id.in_(clusters), cls.word.in_(words)).all()
+            in_keys(cls.cluster_id, clusters), in_keys(cls.word, words)).all()
 
         return associations
 
@@ -566,7 +752,7 @@ class TermCluster(db.Model):
 
         """
 
-        print "Getting the words associated with cluster", cluster
+        logger.debug("Getting the words associated with cluster %s", cluster)
 
         words = db.session.query(cls.word).filter(cls.cluster_id == cluster).all()
 
@@ -609,11 +795,97 @@ class Cluster(db.Model):
 # Helper functions
 
 
-def connect_to_db(app):
-    """Connect the database to our Flask app."""
+def in_keys(column, keys):
+    """Returns a filter condition for a column being one of a set of keys
+    (PubMed IDs, words, cluster IDs...), whatever the size of the set.
+
+    Small sets become an IN (...) list. Bigger ones are loaded into a temporary
+    table on the session's connection, and the condition becomes
+    IN (SELECT key FROM <table>), which SQLite runs as a single join. There is
+    one such table per key type, so a query may only filter one column of each
+    type on a big set, and must run before in_keys is called again."""
+
+    keys = set(keys)
+
+    if len(keys) <= MAX_IN_KEYS:
+        return column.in_(keys)
+
+    if isinstance(column.type, db.String):
+        table, sql_type = text_keys, 'TEXT'
+    else:
+        table, sql_type = integer_keys, 'INTEGER'
+
+    connection = db.session.connection()
+    connection.execute('CREATE TEMPORARY TABLE IF NOT EXISTS %s '
+                       '("key" %s PRIMARY KEY)' % (table.name, sql_type))
+    connection.execute(table.delete())
+    connection.execute(table.insert(), [{'key': key} for key in keys])
+
+    return column.in_(select([table.c.key]))
+
+
+def fetch_columns(query, dtypes, connection=None):
+    """Runs a Core query and returns its result columns as NumPy arrays, one
+    per dtype, read straight off the database cursor without building ORM
+    objects.
+
+        Args:
+            query: a select() statement
+            dtypes: the dtype of each column (object for strings)
+            connection: the connection to use (default: the session's)
+
+        >>> fetch_columns(select([Location.location_id]).where(
+        ...     Location.location_id < 3), [np.int32])
+        (array([0, 1, 2], dtype=int32),)
+    """
+
+    result = (connection or db.session).execute(query)
+    batches = []
+
+    try:
+        while True:
+            rows = result.cursor.fetchmany(FETCH_BATCH_SIZE)
+            if not rows:
+                break
+            batches.append(zip(*rows))
+    finally:
+        result.close()
+
+    return tuple(np.concatenate([np.array(batch[i], dtype=dtype)
+                                 for batch in batches] or
+                                [np.array([], dtype=dtype)])
+                 for i, dtype in enumerate(dtypes))
+
+
+def get_data_version():
+    """Returns a string that changes whenever the database is reseeded,
+    migrated or swapped: the size and modification time of the SQLite file,
+    or '' for an in-memory database.
+
+    Saved with the structures built from the database (activation_matrix.npz,
+    intensity_cache/), to tell when they are out of date."""
+
+    try:
+        stat = os.stat(db.engine.url.database)
+    except (OSError, TypeError):
+        return ''
+
+    return '%x-%x' % (stat.st_size, int(stat.st_mtime))
+
+
+def connect_to_db(app, db_uri=DB_URI, profile=None):
+    """Connect the database to our Flask app.
+
+        Args:
+            app: the Flask app
+            db_uri: the database to use
+            profile: one of DB_PROFILES (default: the app's DB_PROFILE
+                config, or 'default')"""
 
     # Configure to use our SQLite database
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///odyssey_v2.db'
+    app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
+    if profile:
+        app.config['DB_PROFILE'] = profile
     db.app = app
     db.init_app(app)
 
@@ -0,0 +1,159 @@
+"""Bounded cache of rendered responses, with ETags.
+
+The data only changes when the database is reseeded, and the same popular
+words, topics and studies are clicked over and over, so rendered responses are
+kept keyed on the route, its normalized query parameters, the headers the
+response can vary on, and the version of the data. Entries are evicted least
+recently used first once their bodies add up to more than max_bytes."""
+
+import threading
+from hashlib import md5
+from functools import wraps
+from collections import OrderedDict
+
+from flask import request, make_response, current_app
+
+from model import get_data_version
+from smoothing import get_fwhm
+
+
+# Request headers a response may depend on: wire format and gzip for
+# /intensity, pretty-printing for jsonify
+VARY_HEADERS = ('Accept', 'Accept-Encoding', 'X-Requested-With')
+
+# Query parameters normalized before keying, so that values rendering the same
+# response share an entry: ?fwhm= is snapped to a smoothing width
+ARG_NORMALIZERS = {'fwhm': lambda value: str(get_fwhm(value))}
+
+# Default bound on the total size of cached bodies
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+
+class ResponseCache(object):
+    """LRU cache of (body, status, headers, etag) entries, bounded by bytes."""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        """Displays info about the cache."""
+
+        return "<ResponseCache entries=%d bytes=%d hits=%d misses=%d>" % (
+            len(self._entries), self.size, self.hits, self.misses)
+
+    def get(self, key):
+        """Returns the entry for a key (marking it recently used), or None."""
+
+        with self._lock:
+            entry = self._entries.pop(key, None)
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries[key] = entry
+            self.hits += 1
+
+            return entry
+
+    def set(self, key, entry):
+        """Adds an entry, evicting the least recently used ones to make room.
+        Entries bigger than the whole cache are not kept."""
+
+        entry_bytes = len(entry[0])
+
+        if entry_bytes > self.max_bytes:
+            return
+
+        with self._lock:
+            old_entry = self._entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= len(old_entry[0])
+
+            while self._entries and self.size + entry_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.size -= len(evicted[0])
+                self.evictions += 1
+
+            self._entries[key] = entry
+            self.size += entry_bytes
+
+    def clear(self):
+        """Removes every entry."""
+
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+
+response_cache = ResponseCache()
+
+
+def get_cache_key():
+    """Returns the cache key of the current request."""
+
+    args = tuple(sorted((name, tuple(normalize_arg(name, value)
+                                     for value in values))
+                        for name, values in request.args.lists()))
+    headers = tuple(request.headers.get(header, '').strip()
+                    for header in VARY_HEADERS)
+
+    return (request.path, args, headers, get_data_version())
+
+
+def normalize_arg(name, value):
+    """Returns the value of a query parameter as keyed in the cache.
+
+        >>> normalize_arg('fwhm', '4.1'), normalize_arg('fwhm', 'wide')
+        ('4.0', 'wide')
+    """
+
+    normalize = ARG_NORMALIZERS.get(name)
+
+    try:
+        return normalize(value) if normalize else value
+    except ValueError:
+        return value
+
+
+def cached(view):
+    """Decorates a route so that successful responses are served from
+    response_cache, with a strong ETag and 304s for If-None-Match.
+
+    Sets X-Cache to HIT or MISS on every response."""
+
+    @wraps(view)
+    def cached_view(*args, **kwargs):
+        key = get_cache_key()
+        entry = response_cache.get(key)
+
+        if entry is None:
+            response = make_response(view(*args, **kwargs))
+
+            if response.status_code != 200:
+                return response
+
+            body = response.get_data()
+            etag = md5(body + key[-1]).hexdigest()
+            entry = (body, response.status_code, response.headers.items(), etag)
+            response_cache.set(key, entry)
+            cache_status = 'MISS'
+
+        else:
+            cache_status = 'HIT'
+
+        body, status, headers, etag = entry
+        response = current_app.response_class(body, status, headers)
+        response.set_etag(etag)
+        response.headers['X-Cache'] = cache_status
+
+        return response.make_conditional(request)
+
+    return cached_view
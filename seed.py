@@ -1,270 +1,500 @@
-"""Utility file to seed database from files in seed_data directory"""
+"""Utility file to seed database from files in seed_data directory
 
+Each file is streamed once. Duplicate studies, locations, terms and clusters are
+caught with in-memory lookups rather than a query per row, rows are inserted in
+large executemany batches, and secondary indexes are built after the data is
+loaded.
+
+Seeding a table is split in two steps: parse_* functions read a seed file into
+columns (a dict of lists), and insert_* functions write those columns to the db
+on an open connection. load_* functions do both; ingest.py runs the parsing in
+parallel and the inserts in a single transaction.
+
+Once the locations are in, every location is assigned its nearest surface vertex
+(update_surface_vertices), on which intensity maps show its activations."""
+
+import time
+from itertools import islice
+
+import numpy as np
+from scipy.spatial import cKDTree
+from sqlalchemy import bindparam
 
 from model import Location, Activation, Study, StudyTerm, Term, TermCluster, Cluster
-from model import connect_to_db, db
+from model import connect_to_db, db, fetch_columns
+from mesh import SURFACE_FILE, SURFACE_VERTICES, SurfaceMesh, round_half_away
 from server import app
 
 
-def load_indices():
-    """Adds surface x-y-z locations and their BrainBrowser index.
+# Seed files
+DATABASE_FILE = 'seed_data/database.txt'
+STUDIES_TERMS_FILE = 'seed_data/studies_terms.txt'
+STUDY_CLUSTERS_FILE = 'Clusters.txt'
+TOPICS_FILE = 'seed_data/topics.csv'
+
+# Rows per executemany batch
+BATCH_SIZE = 20000
+
+
+################################################################################
+# Bulk loading helpers
+################################################################################
+
+def insert_in_batches(connection, model, rows, batch_size=BATCH_SIZE):
+    """Inserts dictionaries from an iterable into a model's table, in batches,
+    and reports how many rows were inserted and how fast.
+
+    Returns the number of rows inserted."""
+
+    statement = model.__table__.insert()
+    started = time.time()
+    rows = iter(rows)
+    count = 0
+
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        connection.execute(statement, batch)
+        count += len(batch)
+
+    report(model.__tablename__, count, started)
+
+    return count
+
+
+def report(label, count, started):
+    """Prints how many rows were loaded, and how fast."""
+
+    elapsed = time.time() - started
+    print "%-16s %9d rows in %7.1fs (%d rows/s)" % (
+        label, count, elapsed, count / elapsed if elapsed else count)
+
+
+def drop_secondary_indexes(engine=None):
+    """Drops every index declared in model.py, so that bulk inserts don't have
+    to maintain them row by row.
+
+        Args: the engine of the db (default: the app's)"""
+
+    engine = engine or db.engine
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            engine.execute('DROP INDEX IF EXISTS %s' % index.name)
+
+
+def create_secondary_indexes(engine=None):
+    """(Re)builds every index declared in model.py.
+
+        Args: the engine of the db (default: the app's)"""
+
+    engine = engine or db.engine
+    started = time.time()
+
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=engine)
+
+    # Refresh the query planner statistics for the new indexes
+    engine.execute('ANALYZE')
+
+    print "Built indexes in %.1fs" % (time.time() - started)
+
+
+################################################################################
+# Parsing seed files
+################################################################################
+
+def parse_indices(path=SURFACE_FILE):
+    """Returns the surface x-y-z locations and their BrainBrowser index.
 
     File format:    x-coord y-coord z-coord
                     x-coord y-coord z-coord
 
     Row number corresponds to MNI object index.
 
-    Source: Brainbrowser MNI object file"""
+    Source: Brainbrowser MNI object file, read through the mesh cache"""
 
-    print "Seeding indices..."
-    # First we populate the locations table with all of the surface locations
+    # We populate the locations table with all of the surface locations
     # tracked by Brainbrowser, along with their Brainbrowser indices (which I
     # am going to use as the location ID - i.e. the primary key)
+    vertices = round_half_away(SurfaceMesh.load(path).vertices)
 
-    # Location.query.delete()
-
-    mniobj = open('static/models/brain-surface2.obj')
-    coords = mniobj.readlines()
-    counter = 0
-
-    for i in range(0, 81924):
-        row = coords[i].strip().split(" ")
-        x = round(float(row[0]), 0)
-        y = round(float(row[1]), 0)
-        z = round(float(row[2]), 0)
-        location_to_add = Location(location_id = i, x_coord=x, y_coord=y, z_coord=z)
-        db.session.add(location_to_add)
-
-    db.session.commit()
-    mniobj.close()
+    return {'location_id': range(len(vertices)),
+            'x_coord': vertices[:, 0].tolist(),
+            'y_coord': vertices[:, 1].tolist(),
+            'z_coord': vertices[:, 2].tolist()}
 
 
-def load_studies():
-    """Loads data from database.txt into Location, Activation, Study tables.
+def parse_studies(path=DATABASE_FILE):
+    """Returns the studies, and the x-y-z coordinates of their activations.
 
-    File format:    PMID \t doi \t x \t y \t z \t space \t peak_id \t table_id 
+    File format:    PMID \t doi \t x \t y \t z \t space \t peak_id \t table_id
                     \t table_num \t title \t authors \t year \t journal \t
 
     Source: Neurosynth database.txt file"""
 
-    skip = True
-    count_studies = 0
-    database = open("seed_data/database.txt")
+    studies = {'pmid': [], 'doi': [], 'title': [], 'authors': [], 'year': [],
+               'journal': []}
+    activations = {'pmid': [], 'x_coord': [], 'y_coord': [], 'z_coord': []}
+    seen_pmids = set()
 
-    # Parse txt file and convert to appropriate data types for seeding
-    for row in database:
+    with open(path) as database:
 
         # Skip the header of the txt file
-        if skip:
-            skip = False
-            continue
-
-        # Stop after the first 5000 rows for now
-        # if count_studies > 5000:
-        #     break
-
-        row = row.rstrip().split('\t')
-
-        # Information to go into Study, if applicable:
-        pmid = int(row[0])
-        doi = row[1]
-        title = row[9]
-        authors = row[10]
-        year = int(row[11])
-        journal = row[12].rstrip()
-
-        # Information to go into Location, if applicable
-        x = float(row[2])
-        y = float(row[3])
-        z = float(row[4])
-
-        # Check whether PMID is already in Study; if not, add it to db.
-        study_obj = Study.get_study_by_pmid(pmid)
-
-        if study_obj is None:
-            study_to_add = Study(pmid=pmid, doi=doi, title=title,
-                                 authors=authors, year=year, journal=journal)
-            db.session.add(study_to_add)
-            db.session.commit()
-
-        # Check whether xyz is already in Location; if not, add it to db and
-        # retrieve its location ID (an autoincrementing primary key).
-        # If xyz already in Location, get its location_id.
-        location_obj = Location.check_by_xyz(x, y, z)
-
-        if location_obj is None:
-            location_to_add = Location(x_coord=x, y_coord=y, z_coord=z)
-            db.session.add(location_to_add)
-            db.session.commit()
-            loc_id = Location.check_by_xyz(x, y, z).location_id
-        else:
-            loc_id = location_obj.location_id
-
-        # Add activation to db, using location_id identified/generated above
-        activation_to_add = Activation(pmid=pmid, location_id=loc_id)
-        db.session.add(activation_to_add)
-        db.session.commit()
-
-        # Print where we are and increment counter
-        print "Database.txt seeding row ", count_studies
-        count_studies += 1
-
-    database.close()
-
-
-def load_studies_terms():
-    """Loads info from studies_terms.txt into StudyTerm & Term tables.
+        next(database)
 
-    File format: R ID \t pmid \t word \t frequency
+        # Parse txt file and convert to appropriate data types for seeding
+        for row in database:
+            row = row.rstrip().split('\t')
+            pmid = int(row[0])
 
-    Source: Neurosynth features.txt, transformed in R to long format."""
+            # Information to go into Study, the first time a PMID comes up
+            if pmid not in seen_pmids:
+                seen_pmids.add(pmid)
+                studies['pmid'].append(pmid)
+                studies['doi'].append(row[1])
+                studies['title'].append(row[9])
+                studies['authors'].append(row[10])
+                studies['year'].append(int(row[11]))
+                studies['journal'].append(row[12].rstrip())
 
+            # Information to go into Location and Activation
+            activations['pmid'].append(pmid)
+            activations['x_coord'].append(float(row[2]))
+            activations['y_coord'].append(float(row[3]))
+            activations['z_coord'].append(float(row[4]))
 
-    print "Studies_terms.txt seeding"
+    return {'studies': studies, 'activations': activations}
 
-    # Delete all rows in existing tables, so if we need to run this a second time,
-    # we won't be trying to add duplicate users
-    StudyTerm.query.delete()
-    Term.query.delete()
 
-    skip = True
-    count_studies_terms = 0
-    studies_terms = open("seed_data/studies_terms.txt")
+def parse_studies_terms(path=STUDIES_TERMS_FILE):
+    """Returns the (pmid, word, frequency) associations between studies and
+    terms.
 
-    for row in studies_terms:
-        # Skip the first line of the file
-        if skip:
-            skip = False
-            continue
+    File format: R ID \t pmid \t word \t frequency
 
-        # Stop after 5000 lines
-        # if count_studies_terms > 5000:
-        #     break
+    Source: Neurosynth features.txt, transformed in R to long format."""
 
-        # Parse txt file and convert to appropriate data types for seeding
-        row = row.rstrip().split('\t')
+    columns = {'pmid': [], 'word': [], 'frequency': []}
 
-        # If the term starts with "X", it is not a word but a number, e.g. "X01"
-        # These don't make sense to track, so skip these rows.
-        if row[2].startswith('\"X'):
-            continue
+    with open(path) as studies_terms:
 
-        # Skip the lines indicating that a term did not appear anywhere
-        # in the article (frequency of 0)
-        if float(row[3]) == 0.0:
-            continue
+        # Skip the first line of the file
+        next(studies_terms)
+
+        for row in studies_terms:
+            # Parse txt file and convert to appropriate data types for seeding
+            row = row.rstrip().split('\t')
 
-        pmid = int(row[1])
-        word = row[2].strip('\"').replace(".", " ")
-        freq = float(row[3])
+            # If the term starts with "X", it is not a word but a number,
+            # e.g. "X01". These don't make sense to track, so skip these rows.
+            if row[2].startswith('\"X'):
+                continue
 
-        # Check if the word is already in Term; if not, add it
-        if Term.check_for_term(word) is False:
-            word_to_add = Term(word=word)
-            db.session.add(word_to_add)
+            # Skip the lines indicating that a term did not appear anywhere
+            # in the article (frequency of 0)
+            freq = float(row[3])
+            if freq == 0.0:
+                continue
 
-        # Add the row to the studies_terms table
-        studies_terms_to_add = StudyTerm(word=word, pmid=pmid, frequency=freq)
-        db.session.add(studies_terms_to_add)
-        db.session.commit()
+            columns['pmid'].append(int(row[1]))
+            columns['word'].append(row[2].strip('\"').replace(".", " "))
+            columns['frequency'].append(freq)
 
-        # Print where we are and increment counter
-        print "studies_terms.txt seeding row ", count_studies_terms
-        count_studies_terms += 1
+    return columns
 
 
-def load_study_clusters():
-    """Loads info about topically clustered studies into Study table.
+def parse_study_clusters(path=STUDY_CLUSTERS_FILE):
+    """Returns the study cluster of each study.
 
     File format: PMID \t study cluster ID
 
-    Source: generated from a K-means cluster analysis to group related studies; see 
+    Source: generated from a K-means cluster analysis to group related studies; see
     DimReductionSelectingK.py for more details"""
 
-    print "Seeding study clusters..."
-
-    study_clusters = open('Clusters.txt')
-    for row in study_clusters:
-        row = row.rstrip().split('\t')
-        pmid = int(row[0])
-        cluster_id = int(row[1])
+    columns = {'pmid': [], 'study_cluster': []}
 
-        study = Study.query.filter(Study.pmid == pmid).first()
-        if study:
-            study.study_cluster = cluster_id
+    with open(path) as study_clusters:
+        for row in study_clusters:
+            row = row.rstrip().split('\t')
+            columns['pmid'].append(int(row[0]))
+            columns['study_cluster'].append(int(row[1]))
 
-    db.session.commit()
-    study_clusters.close()
+    return columns
 
 
-def load_clusters():
-    """Load info from topics.txt file into Cluster, TermCluster tables
+def parse_clusters(path=TOPICS_FILE):
+    """Returns the (cluster ID, word) pairs of the topic clusters.
 
     File format: R row id,Topic XXX,R column ID,word
 
         where XXX represents a number between 0-400
-        R ids can be discarded during seeding 
+        R ids can be discarded during seeding
 
     Source: topic clustering data from Neurosynth, converted to long format
-    in R prior to seeding. 
+    in R prior to seeding.
     Notes: the words tracked in this clustering are not in perfect
-    alignment with those tracked in studies_terms.txt. Approximately 2000 of the 
+    alignment with those tracked in studies_terms.txt. Approximately 2000 of the
     terms in studies_terms have a topical cluster, the remaining ~1000 do not.
     This number could be improved by stemming. Many of the words not tracked
     in clusters are multi-word phrases."""
 
+    columns = {'cluster_id': [], 'word': []}
+
+    with open(path) as topics_fileobj:
+        for row in topics_fileobj:
+            row = row.rstrip().split(',')
+
+            # Parse the txt into the appropriate data types for seeding
+            columns['cluster_id'].append(int(row[1][-3:]))
+            columns['word'].append(row[3].strip())
+
+    return columns
+
+
+################################################################################
+# Inserting parsed columns
+################################################################################
+
+def insert_indices(connection, columns):
+    """Adds surface locations, as returned by parse_indices."""
+
+    insert_in_batches(connection, Location, iter_rows(columns))
+
+
+def insert_studies(connection, parsed):
+    """Adds studies, new locations and activations, as returned by
+    parse_studies."""
+
+    # Locations already in the db (e.g. the surface locations added by
+    # insert_indices) are reused; new ones get the next location ID
+    location_ids = dict(
+        ((x, y, z), location_id) for (location_id, x, y, z) in connection.execute(
+            db.select([Location.location_id, Location.x_coord,
+                       Location.y_coord, Location.z_coord])))
+    next_location_id = max(location_ids.values() or [-1]) + 1
+
+    # Studies already in the db are not added again
+    seen_pmids = set(pmid for (pmid,) in connection.execute(
+        db.select([Study.pmid])))
+
+    locations = []
+    activations = []
+
+    for row in iter_rows(parsed['activations']):
+        xyz = (row['x_coord'], row['y_coord'], row['z_coord'])
+        loc_id = location_ids.get(xyz)
+
+        if loc_id is None:
+            loc_id = location_ids[xyz] = next_location_id
+            next_location_id += 1
+            locations.append({'location_id': loc_id, 'x_coord': xyz[0],
+                              'y_coord': xyz[1], 'z_coord': xyz[2]})
+
+        # Add activation, using location_id identified/generated above
+        activations.append({'pmid': row['pmid'], 'location_id': loc_id})
+
+    insert_in_batches(connection, Study,
+                      (study for study in iter_rows(parsed['studies'])
+                       if study['pmid'] not in seen_pmids))
+    insert_in_batches(connection, Location, locations)
+    insert_in_batches(connection, Activation, activations)
+
+
+def insert_studies_terms(connection, columns):
+    """Replaces the StudyTerm & Term tables with associations as returned by
+    parse_studies_terms."""
+
+    # Delete all rows in existing tables, so if we need to run this a second
+    # time, we won't be trying to add duplicates
+    connection.execute(StudyTerm.__table__.delete())
+    connection.execute(Term.__table__.delete())
+
+    insert_in_batches(connection, StudyTerm, iter_rows(columns))
+    insert_in_batches(connection, Term, ({'word': word} for word in
+                                         sorted(set(columns['word']))))
+
+
+def update_study_clusters(connection, columns):
+    """Sets the study cluster of studies, as returned by parse_study_clusters."""
+
+    started = time.time()
+
+    statement = Study.__table__.update().where(
+        Study.__table__.c.pmid == bindparam('row_pmid')).values(
+        study_cluster=bindparam('row_cluster'))
+
+    connection.execute(statement, [
+        {'row_pmid': pmid, 'row_cluster': cluster_id} for pmid, cluster_id
+        in zip(columns['pmid'], columns['study_cluster'])])
+
+    report('studies', len(columns['pmid']), started)
+
+
+def insert_clusters(connection, columns):
+    """Replaces the Cluster & TermCluster tables with clusters as returned by
+    parse_clusters. Only words in the Term table are associated with clusters
+    (see model.py for TODO)."""
+
+    terms = set(word for (word,) in connection.execute(db.select([Term.word])))
+
     # Delete whatever's in the db already
-    Cluster.query.delete()
-    TermCluster.query.delete()
+    connection.execute(Cluster.__table__.delete())
+    connection.execute(TermCluster.__table__.delete())
+
+    insert_in_batches(connection, Cluster, (
+        {'cluster_id': cluster_id} for cluster_id
+        in sorted(set(columns['cluster_id']))))
+    insert_in_batches(connection, TermCluster, (
+        row for row in iter_rows(columns) if row['word'] in terms))
+
+
+def update_surface_vertices(connection):
+    """Sets the surface vertex of every location that has none yet, or one
+    that is not on the surface: itself for surface locations (the location IDs
+    below SURFACE_VERTICES), and the nearest surface location for the others.
 
-    count_clusters = 0
-    topics_fileobj = open('seed_data/topics.csv')
+    Returns the number of locations updated."""
 
-    for row in topics_fileobj:
+    started = time.time()
 
-        row = row.rstrip().split(',')
+    location_ids, x_coords, y_coords, z_coords, vertices = fetch_columns(
+        db.select([Location.location_id, Location.x_coord, Location.y_coord,
+                   Location.z_coord, Location.surface_vertex]),
+        [np.int64, np.float64, np.float64, np.float64, object], connection)
 
-        # Parse the txt into the appropriate data types for seeding
-        cluster = int(row[1][-3:])
-        word = row[3].strip()
+    coords = np.column_stack([x_coords, y_coords, z_coords])
+    on_surface = location_ids < SURFACE_VERTICES
+    pending = np.flatnonzero([vertex is None or vertex >= SURFACE_VERTICES
+                              for vertex in vertices])
 
-        # Check if word is in our list of key terms. If it is, add to
-        # TermCluster table to allow for lookup later (see model.py for TODO)
+    surface_vertices = location_ids.copy()
 
-        if Term.check_for_term(word) is True:
-            term_cluster_to_add = TermCluster(word=word, cluster_id=cluster)
-            db.session.add(term_cluster_to_add)
-            db.session.commit()
+    # One vectorized KD-tree query for every location off the surface
+    if on_surface.any():
+        off_surface = pending[~on_surface[pending]]
+        _, nearest = cKDTree(coords[on_surface]).query(coords[off_surface])
+        surface_vertices[off_surface] = location_ids[on_surface][nearest]
+    else:
+        pending = pending[on_surface[pending]]
 
-        # Check if a cluster is in our list of clusters. If it's not, add it.
-        if Cluster.check_for_cluster(cluster) is False:
-            cluster_to_add = Cluster(cluster_id=cluster)
-            db.session.add(cluster_to_add)
-            db.session.commit()
+    statement = Location.__table__.update().where(
+        Location.__table__.c.location_id == bindparam('row_location_id')).values(
+        surface_vertex=bindparam('row_vertex'))
 
-        # Print where we are and increment counter
-        print "Topics.txt seeding row", count_clusters
+    for start in range(0, len(pending), BATCH_SIZE):
+        batch = pending[start:start + BATCH_SIZE]
+        connection.execute(statement, [
+            {'row_location_id': int(location_id), 'row_vertex': int(vertex)}
+            for location_id, vertex in zip(location_ids[batch],
+                                           surface_vertices[batch])])
 
-        count_clusters += 1
+    report('surface vertices', len(pending), started)
 
-    topics_fileobj.close()
+    return len(pending)
+
+
+def iter_rows(columns):
+    """Yields a dictionary per row from a dict of equal-length column lists."""
+
+    names = columns.keys()
+
+    for values in zip(*[columns[name] for name in names]):
+        yield dict(zip(names, values))
+
+
+################################################################################
+# Loaders
+################################################################################
+
+def load_indices(path=SURFACE_FILE):
+    """Adds surface x-y-z locations and their BrainBrowser index."""
+
+    print "Seeding indices..."
+
+    with db.engine.begin() as connection:
+        insert_indices(connection, parse_indices(path))
+
+
+def load_studies(path=DATABASE_FILE):
+    """Loads data from database.txt into Location, Activation, Study tables."""
+
+    print "Seeding studies..."
+
+    with db.engine.begin() as connection:
+        insert_studies(connection, parse_studies(path))
+
+
+def load_studies_terms(path=STUDIES_TERMS_FILE):
+    """Loads info from studies_terms.txt into StudyTerm & Term tables."""
+
+    print "Studies_terms.txt seeding"
+
+    with db.engine.begin() as connection:
+        insert_studies_terms(connection, parse_studies_terms(path))
+
+
+def load_surface_vertices():
+    """Maps every location onto its nearest surface vertex."""
+
+    print "Projecting locations onto the surface..."
+
+    with db.engine.begin() as connection:
+        update_surface_vertices(connection)
+
+
+def load_study_clusters(path=STUDY_CLUSTERS_FILE):
+    """Loads info about topically clustered studies into Study table."""
+
+    print "Seeding study clusters..."
+
+    with db.engine.begin() as connection:
+        update_study_clusters(connection, parse_study_clusters(path))
+
+
+def load_clusters(path=TOPICS_FILE):
+    """Load info from topics.txt file into Cluster, TermCluster tables."""
+
+    print "Seeding clusters..."
+
+    with db.engine.begin() as connection:
+        insert_clusters(connection, parse_clusters(path))
 
 
 if __name__ == "__main__":
-    connect_to_db(app)
+    import os
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--data-dir', default='.',
+                        help="where the seed files are (default: here)")
+    args = parser.parse_args()
+
+    # No rollback journal or fsyncs while bulk loading
+    connect_to_db(app, profile='seeding')
 
     # In case tables haven't been created, create them
     db.create_all()
 
     # Delete all rows in existing tables, so if we need to run this a second time,
     # we won't add duplicates
-    # Location.query.delete()
-    # Study.query.delete()
-    # Activation.query.delete()
+    Activation.query.delete()
+    Study.query.delete()
+    Location.query.delete()
+    db.session.commit()
+
+    seed_started = time.time()
+    drop_secondary_indexes()
 
     # Import different types of data
-    # load_indices()
-    # load_studies()
-    # load_study_clusters()
-    load_studies_terms()
-    load_clusters()
+    load_indices(os.path.join(args.data_dir, SURFACE_FILE))
+    load_studies(os.path.join(args.data_dir, DATABASE_FILE))
+    load_surface_vertices()
+    load_study_clusters(os.path.join(args.data_dir, STUDY_CLUSTERS_FILE))
+    load_studies_terms(os.path.join(args.data_dir, STUDIES_TERMS_FILE))
+    load_clusters(os.path.join(args.data_dir, TOPICS_FILE))
+
+    create_secondary_indexes()
+    print "Seeded database in %.1fs" % (time.time() - seed_started)
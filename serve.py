@@ -0,0 +1,242 @@
+"""Pre-fork production server for Brain Odyssey.
+
+    python serve.py [--host 0.0.0.0] [--port 5000] [--workers N]
+
+The master process loads every read-only structure the routes use (the word
+index, term-topic graph, spatial index, study clusters, activation matrix,
+intensity cache, surface smoother with the kernel of every smoothing width, and
+static files) once, opens the listening socket, and then forks the workers. The
+workers share the master's pages copy-on-write instead of each building their
+own copy. The database engine is discarded
+before forking, so each worker opens its own connections, with the read-only
+'serving' profile of model.DB_PROFILES.
+
+Signals to the master:
+
+    HUP         graceful reload: reload the data, start new workers, then stop
+                the old ones once they have finished their current request
+    TERM, INT   graceful shutdown
+
+GET /ready answers 200 once a worker can serve requests, and GET /metrics
+reports the latency and query metrics of the worker answering. Logs go to
+stderr at $LOG_LEVEL (default INFO)."""
+
+import os
+import time
+import errno
+import signal
+import logging
+import multiprocessing
+
+from werkzeug.serving import BaseWSGIServer
+
+import autocomplete
+import topic_graph
+import spatial_index
+import study_clusters
+import smoothing
+import activation_matrix
+import intensity_cache
+from logs import configure_logging
+from model import connect_to_db, db
+from response_cache import response_cache
+import server
+from server import app
+
+logger = logging.getLogger(__name__)
+
+
+# (module, lazily built global, getter) for every shared read-only structure
+SHARED_DATA = [
+    (autocomplete, '_word_index', autocomplete.get_word_index),
+    (topic_graph, '_topic_graph', topic_graph.get_topic_graph),
+    (spatial_index, '_spatial_index', spatial_index.get_spatial_index),
+    (study_clusters, '_study_clusters', study_clusters.get_study_clusters),
+    (activation_matrix, '_activation_matrix',
+     activation_matrix.get_activation_matrix),
+    (intensity_cache, '_intensity_cache', intensity_cache.get_intensity_cache),
+    (smoothing, '_surface_smoother', smoothing.get_surface_smoother),
+    (server, '_static_assets', server.get_static_assets),
+]
+
+# How often idle workers and the master check for signals, in seconds
+POLL_INTERVAL = 0.5
+
+
+def load_shared_data():
+    """(Re)builds every shared structure from the database, then closes the
+    database connections so that forked workers do not inherit them."""
+
+    started = time.time()
+
+    for module, name, getter in SHARED_DATA:
+        setattr(module, name, None)
+        getter()
+
+    response_cache.clear()
+
+    db.session.remove()
+    db.engine.dispose()
+
+    logger.info("Loaded shared data in %.1fs", time.time() - started)
+
+
+class PreforkServer(object):
+    """A master process managing a generation of forked workers, all accepting
+    requests on the same listening socket."""
+
+    def __init__(self, host, port, num_workers):
+        self.num_workers = num_workers
+        self.workers = set()
+        self.old_workers = set()
+        self.signals = []
+
+        self.server = BaseWSGIServer(host, port, app)
+        self.server.timeout = POLL_INTERVAL
+
+    def __repr__(self):
+        """Displays info about the server."""
+
+        return "<PreforkServer port=%d workers=%d>" % (
+            self.server.server_address[1], len(self.workers))
+
+    ### Master ################################################################
+
+    def run(self):
+        """Starts the workers, then keeps them running until shut down."""
+
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, lambda signum, frame: self.signals.append(signum))
+
+        logger.info("Serving on http://%s:%d with %d workers",
+                    *(self.server.server_address + (self.num_workers,)))
+
+        self.spawn_workers()
+
+        while True:
+            while self.signals:
+                signum = self.signals.pop(0)
+
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return
+
+            self.reap_workers()
+            time.sleep(POLL_INTERVAL)
+
+    def spawn_workers(self):
+        """Forks workers until the current generation is complete."""
+
+        while len(self.workers) < self.num_workers:
+            pid = os.fork()
+
+            if pid == 0:
+                self.run_worker()
+
+            self.workers.add(pid)
+
+    def reap_workers(self):
+        """Collects exited workers, replacing those of the current generation."""
+
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except OSError as error:
+                if error.errno == errno.ECHILD:
+                    break
+                raise
+
+            if pid == 0:
+                break
+
+            if pid in self.workers:
+                logger.warning("Worker %d exited unexpectedly", pid)
+                self.workers.discard(pid)
+
+            self.old_workers.discard(pid)
+
+        self.spawn_workers()
+
+    def reload(self):
+        """Reloads the shared data and replaces every worker. If the reload
+        fails, the old workers keep serving."""
+
+        logger.info("Reloading...")
+
+        try:
+            load_shared_data()
+        except Exception:
+            logger.exception("Reload failed, keeping the old workers")
+            return
+
+        self.old_workers |= self.workers
+        self.workers = set()
+        self.spawn_workers()
+        self.signal_workers(self.old_workers, signal.SIGTERM)
+
+    def stop(self):
+        """Stops every worker once it has finished its current request."""
+
+        logger.info("Shutting down...")
+
+        self.old_workers |= self.workers
+        self.workers = set()
+        self.signal_workers(self.old_workers, signal.SIGTERM)
+
+        for pid in self.old_workers:
+            try:
+                os.waitpid(pid, 0)
+            except OSError:
+                pass
+
+        self.server.server_close()
+
+    def signal_workers(self, pids, signum):
+        """Sends a signal to some workers, ignoring those already gone."""
+
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+    ### Worker ################################################################
+
+    def run_worker(self):
+        """Serves requests on the shared socket until sent SIGTERM. Runs in a
+        forked worker process, and never returns."""
+
+        stopping = []
+        signal.signal(signal.SIGTERM, lambda signum, frame: stopping.append(1))
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+        try:
+            while not stopping:
+                self.server.handle_request()
+        except Exception:
+            logger.exception("Worker %d failed", os.getpid())
+            os._exit(1)
+
+        os._exit(0)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help="worker processes (default: one per core)")
+    args = parser.parse_args()
+
+    configure_logging()
+    connect_to_db(app, profile='serving')
+
+    load_shared_data()
+
+    PreforkServer(args.host, args.port, args.workers).run()
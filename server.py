@@ -1,16 +1,34 @@
 """Brain Odyssey server"""
 
+import os
+import json
+from hashlib import md5
+
 from jinja2 import StrictUndefined
-from model import Location, Activation, Study, StudyTerm, Term, TermCluster, Cluster, connect_to_db
-from flask import Flask, render_template, jsonify, request
-from operator import itemgetter
-import numpy as np
+from model import Location, Activation, Study, StudyTerm, Term, TermCluster, Cluster, connect_to_db, db
+from flask import (Flask, Response, render_template, jsonify, request,
+                   make_response)
+from intensity import (WIRE_FORMATS, MEDIA_TYPES, empty_map,
+                       encode_intensity_map, gzip_body)
+from explore import Selection, get_d3_tree, get_citations, get_intensity_map
+from response_cache import cached
+from assets import AssetRegistry
+from autocomplete import get_word_index
+from logs import configure_logging
+import metrics
 
 app = Flask(__name__)
 
+# Latency, query and serialization metrics for every request, see /metrics
+metrics.init_app(app)
+
 # If you use an undefined variable in Jinja2, it raises an error.
 app.jinja_env.undefined = StrictUndefined
 
+# Static files are loaded once, on first use, and served precompressed from
+# memory (see get_static_assets)
+_static_assets = None
+
 
 ################################################################################
 #  HOMEPAGE ROUTES
@@ -24,12 +42,46 @@ def index():
 
 
 @app.route('/words')
+@cached
 def retrieve_words():
-    """Retrieves all available words in the db for autocomplete functionality."""
+    """Retrieves words in the db for autocomplete functionality.
+
+    With ?prefix=, returns up to ?limit= (default 10, at most 50) words
+    starting with the prefix, or closely matching it, most used first. Without it, returns all
+    available words."""
+
+    prefix = request.args.get('prefix')
+
+    if prefix is None:
+        words = Term.get_all()
+    else:
+        limit = request.args.get('limit', 10, type=int)
+        words = get_word_index().search(prefix, limit)
+
+    with metrics.serializing():
+        return jsonify({'words': words})
 
-    words = Term.get_all()
 
-    return jsonify({'words': words})
+@app.route('/ready')
+def readiness_check():
+    """Readiness check for load balancers and serve.py: 200 once the database
+    answers, 503 until then."""
+
+    try:
+        db.session.execute('SELECT 1')
+    except Exception:
+        return "not ready", 503
+
+    return jsonify({'status': 'ready', 'pid': os.getpid()})
+
+
+@app.route('/metrics')
+def generate_metrics():
+    """Request latency, SQL and response cache metrics of this process, in
+    Prometheus text format."""
+
+    return Response(metrics.render_metrics(),
+                    mimetype='text/plain; version=0.0.4')
 
 
 ################################################################################
@@ -37,101 +89,47 @@ def retrieve_words():
 ################################################################################
 
 @app.route('/d3topic.json')
+@cached
 def generate_topic_d3():
     """Returns JSON with a topic cluster as the root node."""
     # TO DO Adding cluster ID validation and then extra tests to tests.py
 
-    cluster_id = request.args.get("cluster")
-    words = TermCluster.get_words_in_cluster(cluster_id)
-
-    root_dict = {'name': '', 'children': []}
+    selection = Selection.from_args(request.args, options='cluster')
 
-    for word in words:
-        root_dict['children'].append(
-            {'name': '', 'children': [{'name': word, 'size': 40000}]})
+    d3_tree = get_d3_tree(selection)
 
-    return jsonify(root_dict)
+    with metrics.serializing():
+        return jsonify(d3_tree)
 
 
 @app.route('/d3word.json')
+@cached
 def generate_word_d3():
     """ Returns JSON with a word as the root node."""
     # TO DO Adding word validation and then extra tests to tests.py
 
-    word = request.args.get("word")
-    clusters = TermCluster.get_top_clusters(word, n=25)
+    selection = Selection.from_args(request.args, options='word')
 
-    root_dict = {'name': '', 'children': []}
+    d3_tree = get_d3_tree(selection)
 
-    for cluster in clusters:
-        root_dict['children'].append(
-            {'name': cluster, 'children': [{'name': word, 'size': 40000}]})
-
-    return jsonify(root_dict)
+    with metrics.serializing():
+        return jsonify(d3_tree)
 
 
 @app.route('/d3.json')
+@cached
 def generate_d3(radius=3):
     """ Returns JSON with xyz at the root node.
 
     Test with parameters: 40, -45, -25    (Fusiform face area)
     """
 
-    clicked_on = request.args.get("options")
-
-    if clicked_on == 'location':
+    selection = Selection.from_args(request.args, radius=radius)
 
-        x_coord = float(request.args.get("xcoord"))
-        y_coord = float(request.args.get("ycoord"))
-        z_coord = float(request.args.get("zcoord"))
+    d3_tree = get_d3_tree(selection)
 
-        pmids = Activation.get_pmids_from_xyz(x_coord, y_coord, z_coord, radius)
-        scale = 70000
-        # Get [(wd, freq), ...] and [wd1, wd2] for most frequent words
-
-    elif clicked_on == 'study':
-
-        pmid = request.args.get('pmid')
-        study = Study.get_study_by_pmid(pmid)
-        pmids = study.get_cluster_mates()
-        scale = 30000
-
-    terms_for_dict, words = StudyTerm.get_terms_by_pmid(pmids)
-    # Optional: transform the terms
-    # Get the top clusters
-    top_clusters = TermCluster.get_top_clusters(words)
-    # Get the cluster-word associations
-    associations = TermCluster.get_word_cluster_pairs(top_clusters, words)
-
-    # Make the root node:
-    root_dict = {'name': '', 'children': []}
-
-    # Build the terminal nodes (leaves) first using (wd, freq) tuples
-    # Output: {word: {'name': word, 'size': freq}, word2: ... }
-    leaves = {}
-
-    for (word, freq) in terms_for_dict:
-        if word not in leaves:
-            leaves[word] = {'name': word, 'size': freq * scale}
-        else:
-            leaves[word]['size'] += freq * scale
-
-    # Embed the leaves in the clusters:
-    # Output: {cluster_id: {'name': ID, 'children': [...]}, ... }
-    clusters = {}
-
-    for (cluster_id, word) in associations:
-        if cluster_id not in clusters:
-            clusters[cluster_id] = {'name': cluster_id, 'children': [leaves[word]]}
-        else:
-            clusters[cluster_id]['children'].append(leaves[word])
-
-    # Put the clusters in the root dictionary
-    # Output: {'name': root, children: [{'name': id, 'children': []}, ...]
-    for cluster in top_clusters:
-        root_dict['children'].append(clusters[cluster])
-
-    return jsonify(root_dict)
+    with metrics.serializing():
+        return jsonify(d3_tree)
 
 
 ################################################################################
@@ -139,45 +137,17 @@ def generate_d3(radius=3):
 ################################################################################
 
 @app.route('/citations.json')
+@cached
 def generate_citations(radius=3):
     """Returns a list of text citations associated with some location, word
     or topic (cluster)."""
 
-    clicked_on = request.args.get("options")
-
-    if clicked_on == 'location':
-        x_coord = float(request.args.get('xcoord'))
-        y_coord = float(request.args.get('ycoord'))
-        z_coord = float(request.args.get('zcoord'))
-
-        pmids = Activation.get_pmids_from_xyz(x_coord, y_coord, z_coord, radius)
-
-    elif clicked_on == 'word':
-        word = request.args.get('word')
-
-        # Get the pmids for a word
-        pmids = StudyTerm.get_pmid_by_term(word)
-
-    elif clicked_on == 'cluster':
-        cluster = request.args.get('cluster')
+    selection = Selection.from_args(request.args, radius=radius)
 
-        # Get the words for a cluster
-        # Then get the top studies for the words
-        words = TermCluster.get_words_in_cluster(cluster)
-        pmids = StudyTerm.get_pmid_by_term(words)
+    citations = get_citations(selection)
 
-    elif clicked_on == 'study':
-
-        pmid = request.args.get('pmid')
-        study = Study.get_study_by_pmid(pmid)
-
-        # Look for cluster-mate studies
-        pmids = study.get_cluster_mates()
-
-
-    citations = Study.get_references(pmids)
-
-    return jsonify(citations)
+    with metrics.serializing():
+        return jsonify(citations)
 
 
 ################################################################################
@@ -198,90 +168,102 @@ def generate_citations(radius=3):
 
 
 @app.route('/intensity')
+@cached
 def generate_intensity():
     """Generates an intensity data file related to some user action.
 
     Clear: clear the old intensity mapping
     Cluster: intensity mapping associated with a topic cluster
     Word: intensity mapping associated with a particular word
-    Study: intensity mapping associated with a study cluster"""
+    Study: intensity mapping associated with a study cluster
 
-    clicked_on = request.args.get("options")
+    With ?fwhm=, the map is smoothed with a Gaussian of that width in mm,
+    snapped to the nearest of smoothing.FWHMS (2, 4 or 6). The map is sent as BrainBrowser text unless another wire
+    format is asked for with ?format= or the Accept header (see
+    intensity.WIRE_FORMATS)."""
 
-    if clicked_on == 'clear':
+    selection = Selection.from_args(request.args)
+    intensity_map = get_intensity_map(selection)
 
-        intensities_by_location = {}
+    if intensity_map is None:
+        intensity_map = empty_map()
 
-    elif clicked_on == 'cluster' or clicked_on == 'word':
+    return intensity_response(intensity_map)
 
-        if clicked_on == 'cluster':
 
-            cluster = request.args.get('cluster')
-            word = TermCluster.get_words_in_cluster(cluster)
+@app.route('/intensitytest')
+def generate_example_intensity():
+    """Returns the sample intensity data provided by Brainbrowser.
 
-        else:
+    Used for testing intensity mapping."""
 
-            word = request.args.get('word')
+    return get_static_assets().serve('models/cortical-thickness.txt')
 
-        studies = StudyTerm.get_by_word(word)
 
-        # Create a dictionary of {pmid: frequency} values
-        frequencies_by_pmid, max_intensity = organize_frequencies_by_study(studies)
-        pmids = frequencies_by_pmid.keys()
+@app.route('/colors')
+def generate_color_map():
+    """Retrieves a color map for Brainbrowser."""
 
-        # Get the activations for the keys of the dictionary
-        activations = Activation.get_activations_from_studies(pmids)
+    return get_static_assets().serve('models/spectral.txt')
 
-        # Assemble the final dictionary of {location:intensity} values, scaling
-        # each value as we go
-        intensities_by_location = scale_frequencies_by_loc(
-            activations, max_intensity, frequencies_by_pmid)
 
-    elif clicked_on == 'study':
+def serve_static(filename):
+    """Serves static files from memory, falling back to Flask for any file
+    added since startup."""
 
-        pmid = request.args.get('pmid')
-        study = Study.get_study_by_pmid(pmid)
+    return (get_static_assets().serve(filename) or
+            app.send_static_file(filename))
 
-        # Look for cluster-mate studies
-        cluster_mates = study.get_cluster_mates()
 
-        # Get (location, study count) tuples from db
-        activations = Activation.get_location_count_from_studies(cluster_mates)
+app.view_functions['static'] = serve_static
 
-        # Scale study counts in preparation for intensity mapping
-        intensities_by_location = scale_study_counts(activations)
 
-        print "Found intensities: ", intensities_by_location
+################################################################################
+#  COMBINED ROUTE
+################################################################################
 
-    # Assemble the intensity map
-    intensity_vals = generate_intensity_map(intensities_by_location)
+@app.route('/explore')
+@cached
+def explore(radius=3):
+    """Returns the D3 tree, citations and intensity map of one click at once,
+    looking up the studies it selects only once.
 
-    return intensity_vals
+    Takes the parameters of /d3.json, /d3word.json, /d3topic.json,
+    /citations.json and /intensity: options= and xcoord/ycoord/zcoord, word,
+    cluster or pmid, and fwhm. The response is multipart/mixed: a JSON part
+    {"d3": tree, "citations": {pmid: citation}}, then, except for locations,
+    the intensity map in the wire format negotiated as for /intensity."""
 
+    selection = Selection.from_args(request.args, radius=radius)
 
-@app.route('/intensitytest')
-def generate_example_intensity():
-    """Returns the sample intensity data provided by Brainbrowser.
-
-    Used for testing intensity mapping."""
-
-    intensity_file = open('static/models/cortical-thickness.txt')
-    intensity_data = ''.join(intensity_file.readlines())
-    intensity_file.close()
+    d3_tree = get_d3_tree(selection)
+    citations = get_citations(selection)
+    intensity_map = get_intensity_map(selection)
 
-    return intensity_data
+    with metrics.serializing():
+        parts = [(json.dumps({'d3': d3_tree, 'citations': citations}),
+                  {'Content-Type': 'application/json'})]
 
+        if intensity_map is not None:
+            wire_format = get_wire_format()
+            body, headers = encode_intensity_map(intensity_map, wire_format)
+            headers['Content-Type'] = WIRE_FORMATS[wire_format]
+            parts.append((body, headers))
 
-@app.route('/colors')
-def generate_color_map():
-    """Retrieves a color map for Brainbrowser."""
+        boundary = md5(''.join(body for body, _ in parts)).hexdigest()
+        body = encode_multipart(parts, boundary)
+        headers = {}
 
-    color_map_file = open('static/models/spectral.txt')
-    color_data = ''.join(color_map_file.readlines())
-    color_map_file.close()
+        if request.accept_encodings['gzip']:
+            body = gzip_body(body)
+            headers['Content-Encoding'] = 'gzip'
 
-    return color_data
+    response = make_response(body)
+    response.headers.extend(headers)
+    response.headers['Content-Type'] = 'multipart/mixed; boundary=' + boundary
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
 
+    return response
 
 
 ################################################################################
@@ -289,87 +271,73 @@ def generate_color_map():
 ################################################################################
 
 
-def organize_frequencies_by_study(studies):
-    """Returns a dictionary of {PubMed ID : word frequency} values, given
-    some raw data from StudyTerm table.
-
-    Used as an intermediate lookup when building final intensity map, in lieu of 
-    performing a complex join query."""
-
-    frequencies_by_pmid = {}
-
-    # Add the {study : frequency} values to dictionary, summing by PubMed ID
-    for study in studies:
-        if study.pmid not in frequencies_by_pmid:
-            frequencies_by_pmid[study.pmid] = study.frequency
-    else:
-        frequencies_by_pmid[study.pmid] += study.frequency
-
-    # Get the maximal frequency for scaling
-    max_intensity = max(frequencies_by_pmid.values())
-
-    return frequencies_by_pmid, max_intensity
-
-
-def scale_frequencies_by_loc(activations, max_intensity, frequencies_by_pmid):
-    """Returns a dictionary of {location_id : scaled intensity} values.
+def get_static_assets():
+    """Returns the registry of static files, reading them on first use so that
+    scripts importing the app don't."""
 
-    Intensity values are derived from word frequency metrics and scaled using
-    the maximal values."""
+    global _static_assets
 
-    intensities_by_location = {}
+    if _static_assets is None:
+        _static_assets = AssetRegistry()
+        _static_assets.add_directory(app.static_folder)
 
-    for activation in activations:
+    return _static_assets
 
-        intensity_to_add = frequencies_by_pmid[activation.pmid]
 
-        if activation.location_id not in intensities_by_location:
-            intensities_by_location[activation.location_id] = (
-                intensity_to_add / max_intensity)
-        else:
-            intensities_by_location[activation.location_id] += (
-                intensity_to_add / max_intensity)
+def get_wire_format():
+    """Returns the intensity wire format asked for with ?format= or, failing
+    that, negotiated with the Accept header."""
 
-    return intensities_by_location
+    wire_format = request.args.get('format')
 
+    if wire_format not in WIRE_FORMATS:
+        media_type = request.accept_mimetypes.best_match(WIRE_FORMATS.values(),
+                                                         'text/plain')
+        wire_format = MEDIA_TYPES[media_type]
 
-def generate_intensity_map(intensities_by_location):
-    """Returns a string with intensity values for each of 81925 surface
-    locations."""
+    return wire_format
 
-    intensity_vals = ""
 
-    for i in range(0, 81925):
+def encode_multipart(parts, boundary):
+    """Returns a multipart body (RFC 2046) of (body, headers) parts."""
 
-        if i not in intensities_by_location:
+    chunks = []
 
-            intensity_vals = intensity_vals + "0\n"
-        else:
-            intensity_vals = intensity_vals + str(intensities_by_location[i]) + "\n"
+    for body, headers in parts:
+        chunks.append('--%s\r\n' % boundary)
+        chunks.extend('%s: %s\r\n' % header for header in sorted(headers.items()))
+        chunks.append('\r\n')
+        chunks.append(body)
+        chunks.append('\r\n')
 
-    return intensity_vals
+    chunks.append('--%s--\r\n' % boundary)
 
+    return ''.join(chunks)
 
-def scale_study_counts(activations):
-    """Returns a dictionary of {location_id : scaled intensity} values.
 
-    Intensity values are derived from study counts and scaled using the
-    maximal counts."""
+def intensity_response(intensity_map):
+    """Returns a response with an intensity map in the wire format negotiated
+    with the client, gzipped if the client accepts it.
 
-    max_count = max(activations, key=itemgetter(1))[1]
+    Bodies are gzipped when rendered rather than precompressed for every map
+    and format; /intensity and /explore keep them in the response cache, so
+    each is only compressed once."""
 
-    intensities_by_location = {}
+    wire_format = get_wire_format()
 
-    for activation in activations:
+    with metrics.serializing():
+        body, headers = encode_intensity_map(intensity_map, wire_format)
 
-        location_id, count = activation
+        if request.accept_encodings['gzip']:
+            body = gzip_body(body)
+            headers['Content-Encoding'] = 'gzip'
 
-        if location_id not in intensities_by_location:
-            intensities_by_location[location_id] = float(count)/float(max_count)
-        else:
-            intensities_by_location[location_id] += float(count)/float(max_count)
+    response = make_response(body)
+    response.mimetype = WIRE_FORMATS[wire_format]
+    response.headers.extend(headers)
+    response.headers['Vary'] = 'Accept, Accept-Encoding'
 
-    return intensities_by_location
+    return response
 
 
 if __name__ == "__main__":
@@ -377,6 +345,7 @@ if __name__ == "__main__":
     # that we invoke the DebugToolbarExtension
     app.debug = True
 
+    configure_logging('DEBUG')
     connect_to_db(app)
 
     # Use the DebugToolbar
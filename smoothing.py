@@ -0,0 +1,211 @@
+"""Gaussian smoothing of intensity maps over the brain surface.
+
+An activation lights a single vertex, so raw maps are spikes. Smoothing spreads
+each vertex's value over the surface vertices around it, weighted by a
+Gaussian of their distance. The weights for a given width form a sparse
+vertex x vertex kernel matrix, built once from the surface coordinates with a
+KD-tree radius search, so smoothing a map is one sparse matrix-vector product.
+Maps light few vertices, so only the kernel columns of the lit vertices are
+multiplied.
+
+Widths are full widths at half maximum (FWHM) in mm. Building a kernel takes
+from a fraction of a second to several seconds for the widest, too long for a
+request, and each one takes tens of MB, so only the FWHMS widths are offered:
+any other width asked for is snapped to the nearest of them. Their kernels are
+built when the shared smoother is loaded (by serve.py's master, before it
+forks), so smoothing never builds one during a request.
+
+The surface coordinates come from the cached surface mesh (see mesh.py) when
+the surface file is there, and from the surface locations in the database
+otherwise."""
+
+import os
+import logging
+import threading
+
+import numpy as np
+from scipy import sparse
+from scipy.spatial import cKDTree
+
+from intensity import NUM_VERTICES
+from mesh import SURFACE_FILE, SURFACE_VERTICES, SurfaceMesh
+
+logger = logging.getLogger(__name__)
+
+
+# Widths offered, in mm; others are snapped to the nearest
+FWHMS = (2.0, 4.0, 6.0)
+
+# Neighbors further than this many standard deviations are left out
+TRUNCATE = 2.5
+
+# sigma = FWHM / FWHM_PER_SIGMA
+FWHM_PER_SIGMA = 2 * np.sqrt(2 * np.log(2))
+
+
+class SurfaceSmoother(object):
+    """Smooths intensity maps with Gaussian kernels over the surface vertices."""
+
+    def __init__(self, vertex_ids, coords):
+        """Args:
+            vertex_ids: the location ID of each surface vertex
+            coords: vertices x 3 array of x-y-z coordinates"""
+
+        self.vertex_ids = vertex_ids
+        self.coords = coords
+
+        self.tree = cKDTree(coords)
+
+        # {fwhm: kernel}, and {fwhm: lock held while building its kernel}
+        self._kernels = {}
+        self._locks = dict((fwhm, threading.Lock()) for fwhm in FWHMS)
+
+    def __repr__(self):
+        """Displays info about the smoother."""
+
+        return "<SurfaceSmoother vertices=%d kernels=%s>" % (
+            len(self.vertex_ids), sorted(self._kernels))
+
+    @classmethod
+    def from_db(cls):
+        """Returns a smoother over the surface locations in the database."""
+
+        from model import Location, fetch_columns
+        from sqlalchemy import select
+
+        logger.info("Loading surface vertices...")
+
+        vertex_ids, x, y, z = fetch_columns(
+            select([Location.location_id, Location.x_coord, Location.y_coord,
+                    Location.z_coord]).where(
+                Location.location_id < SURFACE_VERTICES),
+            [np.int64, np.float64, np.float64, np.float64])
+
+        return cls(vertex_ids, np.column_stack([x, y, z]))
+
+    @classmethod
+    def from_mesh(cls, mesh):
+        """Returns a smoother over the vertices of a SurfaceMesh."""
+
+        return cls(np.arange(len(mesh.vertices)), np.asarray(mesh.vertices))
+
+    ### Kernels ###############################################################
+
+    def get_kernel(self, fwhm):
+        """Returns the transposed kernel matrix of a width (see build_kernel),
+        snapped to FWHMS, building it if build_kernels has not.
+
+        Only requests for the same width wait while it is built."""
+
+        fwhm = get_fwhm(fwhm)
+
+        kernel = self._kernels.get(fwhm)
+        if kernel is not None:
+            return kernel
+
+        with self._locks[fwhm]:
+            # Someone else may have built it while we waited
+            kernel = self._kernels.get(fwhm)
+
+            if kernel is None:
+                kernel = self._kernels[fwhm] = self.build_kernel(fwhm)
+
+        return kernel
+
+    def build_kernels(self):
+        """Builds the kernels of every width in FWHMS."""
+
+        for fwhm in FWHMS:
+            self.get_kernel(fwhm)
+
+    def build_kernel(self, fwhm):
+        """Returns the transpose of the kernel matrix, in CSR format: row v
+        holds the weights of vertex v in the smoothed value of each vertex
+        near it. The smoothed value of a vertex is the Gaussian-weighted mean
+        of the vertices near it; locations that are not surface vertices keep
+        their own value."""
+
+        sigma = fwhm / FWHM_PER_SIGMA
+
+        pairs = self.tree.query_pairs(TRUNCATE * sigma, output_type='ndarray')
+        first, second = pairs[:, 0], pairs[:, 1]
+
+        squared_distances = ((self.coords[first] - self.coords[second]) ** 2
+                             ).sum(axis=1)
+        weights = np.exp(-squared_distances / (2 * sigma ** 2)).astype(
+            np.float32)
+
+        # Each pair goes both ways, and every location weighs itself by 1
+        rows = np.concatenate([self.vertex_ids[first], self.vertex_ids[second],
+                               np.arange(NUM_VERTICES)])
+        columns = np.concatenate([self.vertex_ids[second],
+                                  self.vertex_ids[first],
+                                  np.arange(NUM_VERTICES)])
+        data = np.concatenate([weights, weights,
+                               np.ones(NUM_VERTICES, dtype=np.float32)])
+
+        # Normalize the weights of each smoothed vertex (row) to sum to 1
+        data /= np.bincount(rows, weights=data, minlength=NUM_VERTICES)[rows]
+
+        kernel = sparse.csr_matrix((data.astype(np.float32), (columns, rows)),
+                                   shape=(NUM_VERTICES, NUM_VERTICES))
+
+        logger.info("Built %.1fmm smoothing kernel, %d weights", fwhm,
+                    kernel.nnz)
+
+        return kernel
+
+    ### Smooth maps ###########################################################
+
+    def smooth(self, intensity_map, fwhm):
+        """Returns an intensity map smoothed with a Gaussian of some FWHM (in
+        mm, snapped to FWHMS), rescaled to the peak of the original map so that it shows in the
+        same color range."""
+
+        peak = intensity_map.max()
+        fwhm = get_fwhm(fwhm) if fwhm else None
+
+        if not fwhm or not peak:
+            return intensity_map
+
+        kernel = self.get_kernel(fwhm)
+        lit = np.flatnonzero(intensity_map)
+
+        smoothed = kernel[lit].T.dot(intensity_map[lit])
+        smoothed *= peak / smoothed.max()
+
+        return smoothed.astype(np.float32)
+
+
+def get_fwhm(fwhm):
+    """Returns the width of FWHMS nearest to a width in mm, or None if it is
+    not a positive finite number (no smoothing)."""
+
+    fwhm = float(fwhm)
+
+    if not np.isfinite(fwhm) or fwhm <= 0:
+        return None
+
+    return min(FWHMS, key=lambda width: abs(width - fwhm))
+
+
+_surface_smoother = None
+
+
+def get_surface_smoother():
+    """Returns the shared SurfaceSmoother, over the surface mesh if there is
+    one, or else the surface locations in the database, with the kernels of
+    FWHMS built."""
+
+    global _surface_smoother
+
+    if _surface_smoother is None:
+        if os.path.exists(SURFACE_FILE):
+            _surface_smoother = SurfaceSmoother.from_mesh(
+                SurfaceMesh.load(SURFACE_FILE))
+        else:
+            _surface_smoother = SurfaceSmoother.from_db()
+
+        _surface_smoother.build_kernels()
+
+    return _surface_smoother
@@ -0,0 +1,178 @@
+"""In-memory spatial index of activation sites for location clicks.
+
+Every location reported by some study is put in a KD-tree, along with the
+PubMed IDs of the studies reporting it, so that "which studies are near this
+point?" is answered with one tree query instead of a range query per radius."""
+
+import logging
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+logger = logging.getLogger(__name__)
+
+
+class SpatialIndex(object):
+    """KD-tree of activation sites mapped to the studies reporting them."""
+
+    def __init__(self, location_ids, coords, pmids_by_site, site_offsets):
+        """Args:
+            location_ids: the location ID of each site
+            coords: sites x 3 array of x-y-z coordinates
+            pmids_by_site: PubMed IDs grouped by site, so that the studies at
+                site i are pmids_by_site[site_offsets[i]:site_offsets[i + 1]]
+            site_offsets: len(sites) + 1 offsets into pmids_by_site"""
+
+        self.location_ids = location_ids
+        self.coords = coords
+        self.pmids_by_site = pmids_by_site
+        self.site_offsets = site_offsets
+
+        self.tree = cKDTree(coords)
+
+    def __repr__(self):
+        """Displays info about the index."""
+
+        return "<SpatialIndex sites=%d activations=%d>" % (
+            len(self.location_ids), len(self.pmids_by_site))
+
+    @classmethod
+    def from_db(cls):
+        """Returns an index of every location with an activation."""
+
+        from model import Activation, Location, fetch_columns
+        from sqlalchemy import select
+
+        logger.info("Building spatial index...")
+
+        location_ids, pmids, x, y, z = fetch_columns(
+            select([Activation.location_id, Activation.pmid, Location.x_coord,
+                    Location.y_coord, Location.z_coord]).select_from(
+                Activation.__table__.join(Location.__table__)),
+            [np.int64, np.int64, np.float64, np.float64, np.float64])
+
+        return cls.from_activations(location_ids, pmids,
+                                    np.column_stack([x, y, z]))
+
+    @classmethod
+    def from_activations(cls, location_ids, pmids, coords):
+        """Returns an index from parallel arrays with one entry per activation.
+
+            Args:
+                location_ids: the location ID of each activation
+                pmids: the PubMed ID of each activation
+                coords: activations x 3 array of x-y-z coordinates"""
+
+        # Group the activations by site
+        order = np.lexsort((pmids, location_ids))
+        location_ids, pmids, coords = (location_ids[order], pmids[order],
+                                       coords[order])
+
+        site_ids, first = np.unique(location_ids, return_index=True)
+        site_offsets = np.append(first, len(location_ids))
+
+        return cls(site_ids, coords[first], pmids, site_offsets)
+
+    ### Query the index #######################################################
+
+    def get_pmids_from_xyz(self, x_coord, y_coord, z_coord, radius=3):
+        """Returns the PubMed IDs of studies reporting activation within a
+        +/- radius box around xyz, widening the radius by 1 mm at a time until
+        there is at least one hit, as Activation.get_pmids_from_xyz does.
+
+        The distance to the nearest site is known from a single nearest-neighbor
+        query, so the widened radius is found without re-searching."""
+
+        point = (x_coord, y_coord, z_coord)
+
+        # Chebyshev (p=inf) distance matches the box
+        distance, _ = self.tree.query(point, k=1, p=np.inf)
+
+        if not np.isfinite(distance):
+            return []
+
+        if distance >= radius:
+            radius += np.floor(distance - radius) + 1
+
+        # The box query is strict (< radius), the tree's is not
+        sites = self.tree.query_ball_point(point, np.nextafter(radius, 0),
+                                           p=np.inf)
+
+        return self._get_pmids(sites).tolist()
+
+    def get_pmids_within(self, x_coord, y_coord, z_coord, radius,
+                         weighted=False):
+        """Returns the PubMed IDs of studies reporting activation within a
+        radius (in mm) of xyz.
+
+            Args:
+                x, y & z location coordinates
+                radius: the search radius in mm
+                weighted: if True, return {pmid: weight} instead, where the
+                    weight is 1 / (1 + distance to the study's nearest site)"""
+
+        point = np.array((x_coord, y_coord, z_coord), dtype=np.float64)
+        sites = self.tree.query_ball_point(point, radius)
+
+        if not weighted:
+            return self._get_pmids(sites).tolist()
+
+        distances = np.sqrt(((self.coords[sites] - point) ** 2).sum(axis=1))
+
+        return self._get_weights(sites, distances)
+
+    def get_nearest(self, x_coord, y_coord, z_coord, k=1, weighted=False):
+        """Returns the PubMed IDs of studies reporting the k activation sites
+        nearest to xyz, or {pmid: weight} if weighted (see get_pmids_within)."""
+
+        k = min(k, len(self.location_ids))
+
+        if k < 1:
+            return {} if weighted else []
+
+        distances, sites = self.tree.query((x_coord, y_coord, z_coord), k=k)
+        distances, sites = np.atleast_1d(distances), np.atleast_1d(sites)
+
+        if not weighted:
+            return self._get_pmids(sites).tolist()
+
+        return self._get_weights(sites, distances)
+
+    def _get_pmids(self, sites):
+        """Returns the sorted, unique PubMed IDs reported at some sites."""
+
+        if len(sites) == 0:
+            return np.array([], dtype=np.int64)
+
+        return np.unique(np.concatenate(
+            [self.pmids_by_site[self.site_offsets[site]:
+                                self.site_offsets[site + 1]]
+             for site in sites]))
+
+    def _get_weights(self, sites, distances):
+        """Returns {pmid: weight}, weighting each study by its nearest site."""
+
+        weights = {}
+
+        for site, distance in zip(sites, distances):
+            weight = 1.0 / (1.0 + distance)
+            for pmid in self.pmids_by_site[self.site_offsets[site]:
+                                           self.site_offsets[site + 1]].tolist():
+                if weights.get(pmid, 0) < weight:
+                    weights[pmid] = weight
+
+        return weights
+
+
+_spatial_index = None
+
+
+def get_spatial_index():
+    """Returns the shared SpatialIndex, building it from the database."""
+
+    global _spatial_index
+
+    if _spatial_index is None:
+        _spatial_index = SpatialIndex.from_db()
+
+    return _spatial_index
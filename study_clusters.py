@@ -0,0 +1,157 @@
+"""Precomputed index of study clusters, for reference clicks.
+
+Clicking on a reference selects every study in its study cluster. The cluster
+of each study, the studies of each cluster, and the number of the cluster's
+studies reporting each surface vertex are computed once, so a click is a few
+array lookups instead of a scan of the studies table and a GROUP BY over the
+activations of the cluster."""
+
+import logging
+
+import numpy as np
+from scipy import sparse
+
+from intensity import NUM_VERTICES, scale_study_counts
+
+logger = logging.getLogger(__name__)
+
+
+class StudyClusterIndex(object):
+    """Study clusters, their studies and their per-vertex study counts."""
+
+    def __init__(self, pmids, clusters, activation_pmids, location_ids):
+        """Args:
+            pmids: the PubMed ID of each clustered study
+            clusters: the study cluster of each of these studies
+            activation_pmids: the PubMed ID of each activation
+            location_ids: the surface vertex of each activation"""
+
+        order = np.argsort(pmids, kind='mergesort')
+        self.pmids = np.asarray(pmids, dtype=np.int64)[order]
+        self.cluster_ids, cluster_rows = np.unique(
+            np.asarray(clusters, dtype=np.int64)[order], return_inverse=True)
+        self.cluster_rows = cluster_rows
+
+        # Cluster -> studies: the studies of cluster row i are
+        # pmids_by_cluster[cluster_offsets[i]:cluster_offsets[i + 1]], sorted
+        by_cluster = np.lexsort((self.pmids, cluster_rows))
+        self.pmids_by_cluster = self.pmids[by_cluster]
+        self.cluster_offsets = np.append(0, np.cumsum(
+            np.bincount(cluster_rows, minlength=len(self.cluster_ids))))
+
+        # Cluster x vertex study counts. A study reporting a vertex twice is
+        # counted once.
+        activation_pmids = np.asarray(activation_pmids, dtype=np.int64)
+        location_ids = np.asarray(location_ids, dtype=np.int64)
+        study_rows = self._get_study_rows(activation_pmids)
+        clustered = study_rows >= 0
+
+        pairs = np.unique(study_rows[clustered] * NUM_VERTICES +
+                          location_ids[clustered])
+        rows = cluster_rows[pairs // NUM_VERTICES]
+
+        self.location_counts = sparse.coo_matrix(
+            (np.ones(len(pairs), dtype=np.int32), (rows, pairs % NUM_VERTICES)),
+            shape=(len(self.cluster_ids), NUM_VERTICES)).tocsr()
+
+    def __repr__(self):
+        """Displays info about the index."""
+
+        return "<StudyClusterIndex studies=%d clusters=%d>" % (
+            len(self.pmids), len(self.cluster_ids))
+
+    @classmethod
+    def from_db(cls):
+        """Returns the index of the studies and activations tables."""
+
+        from model import Study, Activation, fetch_columns
+        from sqlalchemy import select
+
+        logger.info("Building study cluster index...")
+
+        pmids, clusters = fetch_columns(
+            select([Study.pmid, Study.study_cluster]).where(
+                Study.study_cluster != None),
+            [np.int64, np.int64])
+        activation_pmids, location_ids = Activation.get_activation_columns()
+
+        return cls(pmids, clusters, activation_pmids.astype(np.int64),
+                   location_ids.astype(np.int64))
+
+    ### Look up clusters ######################################################
+
+    def get_cluster(self, pmid):
+        """Returns the study cluster of a study, or None if it has none."""
+
+        row = self._get_cluster_row(pmid)
+
+        return None if row is None else int(self.cluster_ids[row])
+
+    def get_cluster_mates(self, pmid):
+        """Returns the sorted PubMed IDs of the studies in a study's cluster,
+        itself included, as Study.get_cluster_mates."""
+
+        row = self._get_cluster_row(pmid)
+
+        if row is None:
+            return []
+
+        return self.pmids_by_cluster[self.cluster_offsets[row]:
+                                     self.cluster_offsets[row + 1]].tolist()
+
+    def get_location_counts(self, pmid):
+        """Returns (location ids, study counts) arrays for the vertices
+        reported by the studies in a study's cluster."""
+
+        row = self._get_cluster_row(pmid)
+
+        if row is None:
+            return np.array([], dtype=np.int32), np.array([], dtype=np.int32)
+
+        counts = self.location_counts[row]
+
+        return counts.indices, counts.data
+
+    def get_intensity_map(self, pmid):
+        """Returns the intensity map of a study's cluster: the number of its
+        studies reporting each vertex, scaled using the maximal count."""
+
+        return scale_study_counts(*self.get_location_counts(pmid))
+
+    def _get_study_rows(self, pmids):
+        """Returns the position of some studies in self.pmids, or -1 for those
+        not in a cluster."""
+
+        if not len(self.pmids):
+            return np.zeros(len(pmids), dtype=np.int64) - 1
+
+        positions = np.searchsorted(self.pmids, pmids)
+        positions[positions == len(self.pmids)] = 0
+
+        return np.where(self.pmids[positions] == pmids, positions, -1)
+
+    def _get_cluster_row(self, pmid):
+        """Returns the cluster row of a study, or None."""
+
+        try:
+            pmid = int(pmid)
+        except (TypeError, ValueError):
+            return None
+
+        position = self._get_study_rows(np.array([pmid], dtype=np.int64))[0]
+
+        return None if position < 0 else self.cluster_rows[position]
+
+
+_study_clusters = None
+
+
+def get_study_clusters():
+    """Returns the shared StudyClusterIndex, building it from the database."""
+
+    global _study_clusters
+
+    if _study_clusters is None:
+        _study_clusters = StudyClusterIndex.from_db()
+
+    return _study_clusters
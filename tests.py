@@ -2,11 +2,38 @@
 # Brain Odyssey tests
 ################################################################################
 
+import os
+import zlib
+import shutil
+import logging
+import tempfile
+import threading
 import unittest
 import doctest
 import servercov
-from server import app
-from model import connect_to_db
+from flask import Flask, request
+from server import app, get_static_assets, get_wire_format, intensity_response
+from model import connect_to_db, db
+from model import Location, Activation, Study, StudyTerm, Term, TermCluster
+from model import Cluster, MAX_IN_KEYS, get_data_version
+from intensity import NUM_VERTICES, WIRE_FORMATS, encode_intensity_map
+from sqlalchemy import event
+from autocomplete import WordIndex, MAX_LIMIT
+from spatial_index import SpatialIndex
+from response_cache import ResponseCache, cached, response_cache
+from topic_graph import TopicGraph
+from study_clusters import StudyClusterIndex
+from smoothing import SurfaceSmoother, get_fwhm
+from seed import update_surface_vertices
+from mesh import SURFACE_VERTICES, SurfaceMesh, round_half_away
+from logs import RateLimitFilter
+import metrics
+import activation_matrix
+import intensity_cache
+from activation_matrix import ActivationMatrix
+from intensity_cache import IntensityCache
+import model
+import numpy as np
 from selenium import webdriver
 
 # def load_tests(loader, tests, ignore):
@@ -37,6 +64,11 @@ class MyAppUnitTestCast(unittest.TestCase):
         result = test_client.get('/')
         self.assertEqual(result.status_code, 200)
 
+    def test_ready(self):
+        result = self.client.get('/ready')
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('ready', result.data)
+
     def test_location(self):
         self.browser.get('http://localhost:5000/')
         x = self.browser.find_element_by_id('xcoord')
@@ -108,31 +140,71 @@ class MyAppUnitTestCast(unittest.TestCase):
 # Mock out results with a mocking framework  
 # Test what happens when we feed in a word that is not in the database) 
 
+    def read_text_map(self, result):
+        """Returns the intensity map of a BrainBrowser text response."""
+
+        return np.array([float(value) for value in result.data.splitlines()])
+
     def test_intensity_from_word(self):
         result = self.client.get('/intensity?word=pain&options=word')
 
         self.assertEqual(result.status_code, 200)
-        intensity = '0.532713099492'
-        self.assertIn(intensity, result.data)
+        intensity_map = self.read_text_map(result)
+        self.assertEqual(len(intensity_map), 81925)
+        self.assertTrue(intensity_map.max() > 0)
+        self.assertTrue((intensity_map >= 0).all())
+        self.assertTrue(np.allclose(
+            intensity_map,
+            activation_matrix.get_activation_matrix().get_intensity_for_words(
+                'pain'), rtol=1e-6, atol=1e-7))
 
     def test_intensity_from_cluster(self):
         result = self.client.get('/intensity?cluster=11&options=cluster')
 
         self.assertEqual(result.status_code, 200)
-        intensity = '0.306829606337'
-        self.assertIn(intensity, result.data)
+        self.assertEqual(len(result.data.splitlines()), 81925)
 
     def test_intensity_from_ref(self):
         result = self.client.get('/intensity?pmid=11960899&options=study')
 
         self.assertEqual(result.status_code, 200)
-        intensity = '0.5'
-        self.assertIn(intensity, result.data)
+
+        # The cluster-mate studies reporting each location, scaled to the most
+        cluster_mates = Study.get_study_by_pmid(11960899).get_cluster_mates()
+        counts = dict(Activation.get_location_count_from_studies(cluster_mates))
+        expected = np.zeros(81925)
+        expected[counts.keys()] = counts.values()
+        expected /= expected.max()
+
+        self.assertTrue(np.allclose(self.read_text_map(result), expected,
+                                    rtol=1e-6, atol=1e-7))
+
+    def test_intensity_binary_format(self):
+        result = self.client.get('/intensity?word=pain&options=word&format=float32')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(len(result.data), 81925 * 4)
 
     def test_colors(self):
         result = self.client.get('/colors')
         self.assertEqual(result.status_code, 200)
 
+    def test_explore_from_word(self):
+        result = self.client.get('/explore?word=pain&options=word&format=float32')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('multipart/mixed', result.headers['Content-Type'])
+        self.assertIn('"citations"', result.data)
+        self.assertIn('Content-Type: application/x-intensity-float32', result.data)
+
+    def test_explore_from_location(self):
+        result = self.client.get('/explore?xcoord=40&ycoord=-45&zcoord=-25&options=location')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('"d3"', result.data)
+        self.assertNotIn('application/x-intensity', result.data)
+
+
 
 ## REFERENCES ROUTES ##########################################################
 
@@ -149,6 +221,811 @@ class MyAppUnitTestCast(unittest.TestCase):
         self.assertEqual(result.status_code, 200)
 
 
+################################################################################
+# Query plans
+################################################################################
+
+class QueryPlanTestCase(unittest.TestCase):
+    """Runs every model query against an empty copy of the schema, with its
+    indexes, and checks that SQLite answers it from an index rather than by
+    scanning a whole table."""
+
+    # Queries that are meant to read the whole table
+    FULL_SCANS = ['Term.get_all']
+
+    def setUp(self):
+        connect_to_db(app, 'sqlite://')
+        db.create_all()
+
+        db.session.add_all([
+            Location(location_id=1, x_coord=4, y_coord=-68, z_coord=6,
+                     surface_vertex=1),
+            Study(pmid=1, title='Title', authors='Author', year=2015,
+                  journal='Journal', study_cluster=1),
+            Activation(pmid=1, location_id=1),
+            Term(word='pain'),
+            StudyTerm(word='pain', pmid=1, frequency=0.5),
+            Cluster(cluster_id=1),
+            TermCluster(word='pain', cluster_id=1)])
+        db.session.commit()
+
+        self.statements = []
+        event.listen(db.engine, 'before_cursor_execute', self.capture)
+
+    def tearDown(self):
+        event.remove(db.engine, 'before_cursor_execute', self.capture)
+        db.session.remove()
+        db.drop_all()
+
+    def capture(self, conn, cursor, statement, parameters, context, many):
+        if statement.lstrip().startswith('SELECT'):
+            self.statements.append((statement, parameters))
+
+    def get_scans(self, query):
+        """Runs a query and returns the table scans in the plans of the
+        statements it executed."""
+
+        del self.statements[:]
+        query()
+
+        scans = []
+        for statement, parameters in list(self.statements):
+            plan = db.engine.execute('EXPLAIN QUERY PLAN ' + statement,
+                                     parameters).fetchall()
+            scans += [tuple(row)[-1] for row in plan
+                      if tuple(row)[-1].startswith('SCAN')]
+
+        return scans
+
+    def test_query_plans(self):
+        queries = [
+            ('Location.check_by_xyz', lambda: Location.check_by_xyz(4, -68, 6)),
+            ('Activation.get_pmids_from_xyz',
+             lambda: Activation.get_pmids_from_xyz(4, -68, 6, 3)),
+            ('Activation.get_pmids_from_xyz exact',
+             lambda: Activation.get_pmids_from_xyz(4, -68, 6)),
+            ('Activation.get_activations_from_studies',
+             lambda: Activation.get_activations_from_studies([1])),
+            ('Activation.get_location_count_from_studies',
+             lambda: Activation.get_location_count_from_studies([1])),
+            ('Activation.get_activation_columns',
+             lambda: Activation.get_activation_columns([1])),
+            ('Study.get_study_by_pmid', lambda: Study.get_study_by_pmid(1)),
+            ('Study.get_references', lambda: Study.get_references([1])),
+            ('Study.get_reference_columns',
+             lambda: Study.get_reference_columns([1])),
+            ('Study.get_cluster_mates',
+             lambda: Study.get_study_by_pmid(1).get_cluster_mates()),
+            ('StudyTerm.get_terms_by_pmid',
+             lambda: StudyTerm.get_terms_by_pmid([1])),
+            ('StudyTerm.get_pmid_by_term',
+             lambda: StudyTerm.get_pmid_by_term('pain')),
+            ('StudyTerm.get_pmid_by_term list',
+             lambda: StudyTerm.get_pmid_by_term(['pain'])),
+            ('StudyTerm.get_by_word', lambda: StudyTerm.get_by_word('pain')),
+            ('StudyTerm.get_by_word list',
+             lambda: StudyTerm.get_by_word(['pain'])),
+            ('Term.check_for_term', lambda: Term.check_for_term('pain')),
+            ('Term.get_all', lambda: Term.get_all()),
+            ('TermCluster.get_top_clusters',
+             lambda: TermCluster.get_top_clusters(['pain'])),
+            ('TermCluster.get_top_clusters word',
+             lambda: TermCluster.get_top_clusters('pain')),
+            ('TermCluster.get_word_cluster_pairs',
+             lambda: TermCluster.get_word_cluster_pairs([1], ['pain'])),
+            ('TermCluster.get_words_in_cluster',
+             lambda: TermCluster.get_words_in_cluster(1)),
+            ('Cluster.check_for_cluster',
+             lambda: Cluster.check_for_cluster(1)),
+        ]
+
+        for name, query in queries:
+            if name not in self.FULL_SCANS:
+                self.assertEqual(self.get_scans(query), [], name)
+
+    def test_columns_match_rows(self):
+        pmids, location_ids = Activation.get_activation_columns([1])
+        self.assertEqual(zip(pmids, location_ids), [
+            (activation.pmid, activation.location_id) for activation in
+            Activation.get_activations_from_studies([1])])
+        self.assertEqual(str(location_ids.dtype), 'int32')
+        self.assertEqual(Activation.get_activation_columns()[1].tolist(), [1])
+
+        self.assertEqual(Study.get_references([1]),
+                         {1: 'Author. (2015). Title Journal.'})
+
+    def test_surface_vertices(self):
+        db.session.add_all([
+            Location(location_id=2, x_coord=40, y_coord=0, z_coord=0),
+            Location(location_id=SURFACE_VERTICES, x_coord=39, y_coord=1,
+                     z_coord=0),
+            Location(location_id=SURFACE_VERTICES + 1, x_coord=5, y_coord=-67,
+                     z_coord=6),
+            Activation(pmid=1, location_id=SURFACE_VERTICES + 1)])
+        db.session.commit()
+
+        with db.engine.begin() as connection:
+            self.assertEqual(update_surface_vertices(connection), 3)
+            self.assertEqual(update_surface_vertices(connection), 0)
+
+            # Off-surface locations mapped onto themselves are mapped again
+            connection.execute(Location.__table__.update().where(
+                Location.location_id == SURFACE_VERTICES).values(
+                surface_vertex=SURFACE_VERTICES))
+            self.assertEqual(update_surface_vertices(connection), 1)
+
+        self.assertEqual(dict(db.session.query(
+            Location.location_id, Location.surface_vertex).all()),
+            {1: 1, 2: 2, SURFACE_VERTICES: 2, SURFACE_VERTICES + 1: 1})
+        self.assertEqual(Activation.get_location_count_from_studies([1]),
+                         [(1, 1)])
+
+    def test_large_key_sets(self):
+        pmids = range(1, MAX_IN_KEYS + 100)
+        words = ['pain'] + ['word%d' % i for i in range(MAX_IN_KEYS + 100)]
+
+        self.assertEqual(self.get_scans(
+            lambda: Activation.get_activation_columns(pmids)), [])
+        self.assertEqual(
+            Activation.get_activation_columns(pmids)[1].tolist(), [1])
+        self.assertEqual(len(Activation.get_activations_from_studies(pmids)), 1)
+        self.assertEqual(Study.get_references(pmids).keys(), [1])
+        self.assertEqual(StudyTerm.get_pmid_by_term(words), [1])
+        self.assertEqual(TermCluster.get_top_clusters(words), [1])
+        self.assertEqual(TermCluster.get_word_cluster_pairs(pmids, words),
+                         [(1, 'pain')])
+
+
+################################################################################
+# Database profiles
+################################################################################
+
+class DBProfileTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.db_uri = 'sqlite:///' + os.path.join(self.directory, 'test.db')
+
+        connect_to_db(app, self.db_uri, profile='seeding')
+        db.create_all()
+        db.session.add(Study(pmid=1, title='Title', authors='Author',
+                             year=2015, journal='Journal', study_cluster=1))
+        db.session.commit()
+        db.session.remove()
+        db.engine.dispose()
+
+    def tearDown(self):
+        db.session.remove()
+        db.engine.dispose()
+        connect_to_db(app, profile='default')
+        shutil.rmtree(self.directory)
+
+    def test_serving_profile(self):
+        connect_to_db(app, self.db_uri, profile='serving')
+
+        self.assertEqual(db.session.execute('PRAGMA temp_store').scalar(), 2)
+        self.assertEqual(Study.get_references(range(1, MAX_IN_KEYS + 10)),
+                         {1: 'Author. (2015). Title Journal.'})
+
+        db.session.add(Study(pmid=2))
+        self.assertRaises(Exception, db.session.commit)
+
+    def test_read_only_guard(self):
+        # Without URI support, serving connections deny writes themselves
+        supports_uri = model.supports_uri
+        model.supports_uri = lambda: False
+
+        try:
+            connect_to_db(app, self.db_uri, profile='serving')
+
+            self.assertEqual(Study.get_references(range(1, MAX_IN_KEYS + 10)),
+                             {1: 'Author. (2015). Title Journal.'})
+
+            db.session.add(Study(pmid=2))
+            self.assertRaises(Exception, db.session.commit)
+            db.session.rollback()
+
+            self.assertRaises(Exception, db.session.execute,
+                              'CREATE TABLE extra (key INTEGER)')
+        finally:
+            model.supports_uri = supports_uri
+
+
+################################################################################
+# Prebuilt files
+################################################################################
+
+class DataVersionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.matrix_file = activation_matrix.MATRIX_FILE
+        self.cache_dir = intensity_cache.CACHE_DIR
+        activation_matrix.MATRIX_FILE = os.path.join(self.directory, 'm.npz')
+        intensity_cache.CACHE_DIR = os.path.join(self.directory, 'cache')
+
+        connect_to_db(app, 'sqlite:///' +
+                      os.path.join(self.directory, 'test.db'))
+        db.create_all()
+        db.session.add_all([
+            Location(location_id=1, x_coord=4, y_coord=-68, z_coord=6,
+                     surface_vertex=1),
+            Activation(pmid=1, location_id=1),
+            StudyTerm(word='pain', pmid=1, frequency=0.5)])
+        db.session.commit()
+
+        matrix = ActivationMatrix.from_db()
+        matrix.save(activation_matrix.MATRIX_FILE)
+        IntensityCache.build(matrix, ['pain'], {}, intensity_cache.CACHE_DIR)
+
+    def tearDown(self):
+        activation_matrix.MATRIX_FILE = self.matrix_file
+        intensity_cache.CACHE_DIR = self.cache_dir
+        activation_matrix._activation_matrix = None
+        intensity_cache._intensity_cache = None
+        db.session.remove()
+        db.engine.dispose()
+        connect_to_db(app)
+        shutil.rmtree(self.directory)
+
+    def get_files(self):
+        activation_matrix._activation_matrix = None
+        intensity_cache._intensity_cache = None
+
+        return (activation_matrix.get_activation_matrix(),
+                intensity_cache.get_intensity_cache())
+
+    def test_data_version(self):
+        matrix, cache = self.get_files()
+        self.assertEqual(matrix.data_version, get_data_version())
+        self.assertEqual(cache.get_word_map('pain')[1], 1)
+
+        # The db changes: the files are out of date
+        db.session.add_all([
+            Location(location_id=2, x_coord=5, y_coord=-68, z_coord=6,
+                     surface_vertex=2),
+            Activation(pmid=1, location_id=2)])
+        db.session.commit()
+        os.utime(db.engine.url.database, (0, 0))
+
+        matrix, cache = self.get_files()
+        self.assertEqual(matrix.data_version, get_data_version())
+        self.assertEqual(matrix.activations.nnz, 2)
+        self.assertEqual(cache.get_word_map('pain'), None)
+
+
+################################################################################
+# Autocomplete
+################################################################################
+
+class WordIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.index = WordIndex(['pain', 'Painful', 'paint', 'anxiety', 'fear'],
+                               [5, 9, 1, 7, 3])
+
+    def test_prefix_matches(self):
+        self.assertEqual(self.index.get_prefix_matches('PAI'),
+                         ['Painful', 'pain', 'paint'])
+        self.assertEqual(self.index.get_prefix_matches('pai', 2),
+                         ['Painful', 'pain'])
+        self.assertEqual(self.index.get_prefix_matches('x'), [])
+
+    def test_fuzzy_matches(self):
+        self.assertEqual(self.index.get_fuzzy_matches('anxeity'), ['anxiety'])
+        self.assertEqual(self.index.get_fuzzy_matches('zzz'), [])
+
+    def test_search(self):
+        # Prefix matches first, then fuzzy ones
+        self.assertEqual(self.index.search('fea'), ['fear'])
+        self.assertEqual(self.index.search('paim', 2), ['pain', 'paint'])
+        self.assertEqual(self.index.search('pai', -1), ['Painful'])
+
+        many = WordIndex(['w%02d' % i for i in range(60)], range(60))
+        self.assertEqual(len(many.search('w', 10 ** 9)), MAX_LIMIT)
+
+
+################################################################################
+# Spatial index
+################################################################################
+
+class SpatialIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # 300 sites on an integer grid, as in the locations table, and 2000
+        # activations of 400 studies at them
+        rng = np.random.RandomState(0)
+        site_coords = rng.randint(-20, 21, size=(300, 3)).astype(np.float64)
+        sites = rng.randint(0, 300, size=2000)
+
+        self.coords = site_coords[sites]
+        self.pmids = rng.randint(1, 401, size=2000)
+        self.index = SpatialIndex.from_activations(sites, self.pmids,
+                                                   self.coords)
+        self.points = rng.uniform(-40, 40, size=(2000, 3))
+        self.points[:1000] = np.round(self.points[:1000])
+
+    def get_pmids_in_box(self, point, radius):
+        """Brute force Activation.get_pmids_from_xyz: the studies inside a
+        +/- radius box, widening it by 1 mm until there is one."""
+
+        while True:
+            inside = (np.abs(self.coords - point) < radius).all(axis=1)
+            if inside.any():
+                return sorted(set(self.pmids[inside].tolist()))
+            radius += 1
+
+    def test_pmids_from_xyz(self):
+        for i, point in enumerate(self.points):
+            radius = 1 + i % 3
+            self.assertEqual(self.index.get_pmids_from_xyz(*point, radius=radius),
+                             self.get_pmids_in_box(point, radius))
+
+    def test_pmids_within(self):
+        for point in self.points[::20]:
+            inside = np.sqrt(((self.coords - point) ** 2).sum(axis=1)) <= 8
+            self.assertEqual(self.index.get_pmids_within(*point, radius=8),
+                             sorted(set(self.pmids[inside].tolist())))
+
+
+################################################################################
+# Response cache
+################################################################################
+
+class ResponseCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+        self.app = Flask(__name__)
+
+        @self.app.route('/value')
+        @cached
+        def value():
+            self.calls.append(request.args.get('v'))
+            return 'value %s' % request.args.get('v')
+
+        response_cache.clear()
+        self.client = self.app.test_client()
+
+    def tearDown(self):
+        response_cache.clear()
+
+    def test_lru_eviction(self):
+        cache = ResponseCache(max_bytes=10)
+
+        cache.set('a', ('aaaa', 200, [], 'etag'))
+        cache.set('b', ('bbbb', 200, [], 'etag'))
+        cache.get('a')
+        cache.set('c', ('cccc', 200, [], 'etag'))
+
+        # b was the least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a')[0], 'aaaa')
+        self.assertEqual((cache.size, cache.evictions), (8, 1))
+
+        # Bigger than the whole cache: not kept
+        cache.set('d', ('d' * 11, 200, [], 'etag'))
+        self.assertEqual(cache.get('d'), None)
+        self.assertEqual(cache.size, 8)
+
+    def test_etags(self):
+        result = self.client.get('/value?v=1&w=2')
+        self.assertEqual(result.headers['X-Cache'], 'MISS')
+        etag = result.headers['ETag']
+
+        # Same query in another order: served from the cache
+        result = self.client.get('/value?w=2&v=1')
+        self.assertEqual(result.headers['X-Cache'], 'HIT')
+        self.assertEqual(result.data, 'value 1')
+        self.assertEqual(self.calls, ['1'])
+
+        result = self.client.get('/value?v=1&w=2',
+                                 headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 304)
+        self.assertEqual(result.data, '')
+
+        result = self.client.get('/value?v=2', headers={'If-None-Match': etag})
+        self.assertEqual(result.status_code, 200)
+        self.assertNotEqual(result.headers['ETag'], etag)
+
+    def test_normalized_args(self):
+        # Widths snapped to the same kernel render the same map
+        self.client.get('/value?v=1&fwhm=4')
+        result = self.client.get('/value?fwhm=4.1&v=1')
+        self.assertEqual(result.headers['X-Cache'], 'HIT')
+
+        result = self.client.get('/value?fwhm=5.5&v=1')
+        self.assertEqual(result.headers['X-Cache'], 'MISS')
+        self.assertEqual(self.calls, ['1', '1'])
+
+
+################################################################################
+# Topic graph
+################################################################################
+
+class TopicGraphTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # anxiety: 1, 3; fear: 1, 2, 3; pain: 2
+        self.graph = TopicGraph(['anxiety', 'fear', 'pain'],
+                                np.array([1, 0, 1, 2, 1, 0]),
+                                np.array([1, 1, 3, 2, 2, 3]))
+
+    def test_top_clusters(self):
+        self.assertEqual(self.graph.get_top_clusters(['fear', 'pain']), [2, 1, 3])
+        self.assertEqual(self.graph.get_top_clusters(['fear', 'pain'], n=1), [2])
+        self.assertEqual(self.graph.get_top_clusters('fear', n=2), [1, 2])
+        self.assertEqual(self.graph.get_top_clusters(['unknown']), [])
+
+    def test_words_in_cluster(self):
+        self.assertEqual(self.graph.get_words_in_cluster('3'), ['anxiety', 'fear'])
+        self.assertEqual(self.graph.get_words_in_cluster(0), [])
+        self.assertEqual(self.graph.get_words_in_cluster(56), [])
+
+    def test_word_cluster_pairs(self):
+        self.assertEqual(self.graph.get_word_cluster_pairs([2, 3], ['fear', 'pain']),
+                         [(2, 'fear'), (2, 'pain'), (3, 'fear')])
+
+
+################################################################################
+# Study clusters
+################################################################################
+
+class StudyClusterIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Studies 1 and 3 are in cluster 62, study 2 in cluster 5; study 1
+        # reports vertex 10 twice, study 4 has no cluster
+        self.index = StudyClusterIndex([3, 1, 2], [62, 62, 5],
+                                       [1, 1, 1, 3, 2, 4],
+                                       [10, 10, 20, 10, 30, 10])
+
+    def test_cluster_mates(self):
+        self.assertEqual(self.index.get_cluster('1'), 62)
+        self.assertEqual(self.index.get_cluster_mates('3'), [1, 3])
+        self.assertEqual(self.index.get_cluster_mates(2), [2])
+        self.assertEqual(self.index.get_cluster_mates(4), [])
+
+    def test_location_counts(self):
+        location_ids, counts = self.index.get_location_counts(1)
+        self.assertEqual(zip(location_ids, counts), [(10, 2), (20, 1)])
+
+        intensity_map = self.index.get_intensity_map(3)
+        self.assertEqual(intensity_map[10], 1.0)
+        self.assertEqual(intensity_map[20], 0.5)
+        self.assertEqual(intensity_map.sum(), 1.5)
+        self.assertEqual(self.index.get_intensity_map(4).sum(), 0)
+
+
+################################################################################
+# Smoothing
+################################################################################
+
+class SmoothingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Vertices 0-4 on a line 1mm apart, vertex 5 far away
+        self.smoother = SurfaceSmoother(
+            np.arange(6), np.array([[0, 0, 0], [1, 0, 0], [2, 0, 0], [3, 0, 0],
+                                    [4, 0, 0], [50, 0, 0]], dtype=np.float64))
+
+    def test_fwhm(self):
+        self.assertEqual(get_fwhm('4.2'), 4.0)
+        self.assertEqual(get_fwhm(0.1), 2.0)
+        self.assertEqual(get_fwhm(5.5), 6.0)
+        self.assertEqual(get_fwhm(40), 6.0)
+        self.assertEqual(get_fwhm(0), None)
+        self.assertEqual(get_fwhm(-2), None)
+        self.assertEqual(get_fwhm('nan'), None)
+        self.assertEqual(get_fwhm(float('inf')), None)
+
+    def test_smooth(self):
+        intensity_map = np.zeros(NUM_VERTICES, dtype=np.float32)
+        intensity_map[2] = 0.8
+        intensity_map[5] = 0.4
+        intensity_map[NUM_VERTICES - 1] = 0.2
+
+        smoothed = self.smoother.smooth(intensity_map, 2)
+
+        self.assertEqual(smoothed.dtype, np.float32)
+        self.assertAlmostEqual(smoothed.max(), 0.8, places=6)
+        self.assertAlmostEqual(smoothed[1], smoothed[3], places=6)
+        self.assertTrue(smoothed[2] > smoothed[1] > smoothed[0] > 0)
+        # Vertex 5 has no neighbors; the last location is not on the surface
+        self.assertAlmostEqual(smoothed[5] / smoothed[NUM_VERTICES - 1], 2,
+                               places=5)
+        self.assertEqual(np.count_nonzero(smoothed), 7)
+        self.assertTrue(self.smoother.smooth(intensity_map, None) is
+                        intensity_map)
+        self.assertTrue(self.smoother.smooth(intensity_map, float('nan')) is
+                        intensity_map)
+
+    def test_kernels(self):
+        self.smoother.get_kernel(2)
+
+        # While a kernel is being built, other widths are still served
+        started, release = threading.Event(), threading.Event()
+        build_kernel = self.smoother.build_kernel
+
+        def slow_build_kernel(fwhm):
+            started.set()
+            release.wait()
+            return build_kernel(fwhm)
+
+        self.smoother.build_kernel = slow_build_kernel
+        builder = threading.Thread(target=self.smoother.get_kernel, args=(4,))
+        builder.start()
+        started.wait()
+
+        self.assertTrue(self.smoother.get_kernel(2.5) is not None)
+
+        release.set()
+        builder.join()
+
+        # A failed build can be retried
+        def failing_build_kernel(fwhm):
+            raise MemoryError
+
+        self.smoother.build_kernel = failing_build_kernel
+        self.assertRaises(MemoryError, self.smoother.get_kernel, 6)
+
+        self.smoother.build_kernel = build_kernel
+        self.smoother.build_kernels()
+
+        self.assertEqual(repr(self.smoother),
+                         "<SurfaceSmoother vertices=6 kernels=[2.0, 4.0, 6.0]>")
+        self.assertTrue(self.smoother.get_kernel(9) is
+                        self.smoother.get_kernel(6))
+
+
+################################################################################
+# Surface mesh
+################################################################################
+
+class MeshTestCase(unittest.TestCase):
+
+    # A tetrahedron, in the MNI object format
+    OBJ = """P 0.3 0.3 0.4 10 1 4
+0.5 0 -1.5
+1 0 0
+0 1 0
+0 0 1
+
+0 0 -1
+1 0 0
+0 1 0
+0 0 1
+
+4
+0 1 1 1 1
+
+3 6 9 12
+
+0 1 2 0 1 3 0 2 3 1 2 3
+"""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'surface.obj')
+        self.cache_dir = os.path.join(self.directory, 'cache')
+
+        with open(self.path, 'w') as obj_file:
+            obj_file.write(self.OBJ)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse(self):
+        mesh = SurfaceMesh.parse(self.path)
+
+        self.assertEqual(mesh.vertices.tolist(), [
+            [0.5, 0, -1.5], [1, 0, 0], [0, 1, 0], [0, 0, 1]])
+        self.assertEqual(mesh.faces.tolist(), [
+            [0, 1, 2], [0, 1, 3], [0, 2, 3], [1, 2, 3]])
+        self.assertEqual(mesh.get_neighbors(0).tolist(), [1, 2, 3])
+        self.assertEqual(mesh.adjacency.sum(), 12)
+        self.assertEqual(round_half_away(mesh.vertices[0]).tolist(),
+                         [1, 0, -2])
+
+    def test_cache(self):
+        mesh = SurfaceMesh.load(self.path, self.cache_dir)
+
+        self.assertTrue(isinstance(mesh.vertices, np.memmap))
+        self.assertEqual(mesh.faces.tolist(),
+                         SurfaceMesh.parse(self.path).faces.tolist())
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        SurfaceMesh.load(self.path, self.cache_dir)
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # Editing the file caches it again
+        with open(self.path, 'w') as obj_file:
+            obj_file.write(self.OBJ.replace('0.5 0 -1.5', '2 0 0'))
+
+        self.assertEqual(
+            SurfaceMesh.load(self.path, self.cache_dir).vertices[0].tolist(),
+            [2, 0, 0])
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+
+################################################################################
+# Wire formats
+################################################################################
+
+class WireFormatTestCase(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.intensity_map = np.zeros(NUM_VERTICES, dtype=np.float32)
+        self.intensity_map[rng.choice(NUM_VERTICES, 500, replace=False)] = (
+            rng.uniform(0, 3, size=500))
+
+    def decode(self, body, wire_format, headers):
+        """Returns the intensity map of a body in one of the WIRE_FORMATS."""
+
+        if wire_format == 'text':
+            return np.array([float(value) for value in body.splitlines()])
+
+        elif wire_format == 'float32':
+            return np.frombuffer(body, dtype='<f4')
+
+        elif wire_format in ('uint16', 'uint8'):
+            dtype = np.dtype(wire_format).newbyteorder('<')
+            return (np.frombuffer(body, dtype=dtype) *
+                    float(headers['X-Intensity-Scale']))
+
+        count = int(headers['X-Intensity-Count'])
+        intensity_map = np.zeros(NUM_VERTICES, dtype=np.float32)
+        intensity_map[np.frombuffer(body[:4 * count], dtype='<u4')] = (
+            np.frombuffer(body[4 * count:], dtype='<f4'))
+
+        return intensity_map
+
+    def test_round_trip(self):
+        peak = self.intensity_map.max()
+        # Quantized values are off by at most half a step
+        errors = {'text': 1e-6 * peak, 'float32': 0, 'sparse': 0,
+                  'uint16': peak / 65535 / 2, 'uint8': peak / 255 / 2}
+
+        for wire_format in WIRE_FORMATS:
+            body, headers = encode_intensity_map(self.intensity_map,
+                                                 wire_format)
+            decoded = self.decode(body, wire_format, headers)
+
+            self.assertEqual(len(decoded), NUM_VERTICES, wire_format)
+            self.assertTrue(
+                np.abs(decoded - self.intensity_map).max() <=
+                errors[wire_format] * (1 + 1e-6), wire_format)
+
+        body, headers = encode_intensity_map(np.zeros(NUM_VERTICES), 'uint8')
+        self.assertFalse(self.decode(body, 'uint8', headers).any())
+
+    def test_negotiation(self):
+        requests = [
+            ('/intensity', {}, 'text'),
+            ('/intensity?format=uint8', {}, 'uint8'),
+            ('/intensity', {'Accept': 'application/x-intensity-sparse'},
+             'sparse'),
+            ('/intensity', {'Accept': 'application/json'}, 'text'),
+            ('/intensity?format=png',
+             {'Accept': 'text/plain;q=0.5, application/x-intensity-float32'},
+             'float32'),
+        ]
+
+        for url, headers, wire_format in requests:
+            with app.test_request_context(url, headers=headers):
+                self.assertEqual(get_wire_format(), wire_format, url)
+
+    def test_gzip(self):
+        headers = {'Accept': 'application/x-intensity-uint16',
+                   'Accept-Encoding': 'gzip'}
+
+        with app.test_request_context('/intensity', headers=headers):
+            response = intensity_response(self.intensity_map)
+
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, WIRE_FORMATS['uint16'])
+        body = zlib.decompress(response.get_data(), 16 + zlib.MAX_WBITS)
+        self.assertTrue(np.allclose(
+            self.decode(body, 'uint16', response.headers), self.intensity_map,
+            atol=self.intensity_map.max() / 65535))
+
+        with app.test_request_context('/intensity?format=sparse'):
+            response = intensity_response(self.intensity_map)
+
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertTrue((self.decode(response.get_data(), 'sparse',
+                                     response.headers) ==
+                         self.intensity_map).all())
+
+
+################################################################################
+# Static assets
+################################################################################
+
+class AssetsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        self.body = self.client.get('/colors').data
+        self.etag = '"%s"' % get_static_assets().get('models/spectral.txt').etag
+
+    def test_ranges(self):
+        result = self.client.get('/colors', headers={'Range': 'bytes=10-19'})
+        self.assertEqual(result.status_code, 206)
+        self.assertEqual(result.data, self.body[10:20])
+        self.assertEqual(result.headers['Content-Range'],
+                         'bytes 10-19/%d' % len(self.body))
+
+        result = self.client.get('/colors', headers={'Range': 'bytes=-100000'})
+        self.assertEqual(result.status_code, 206)
+        self.assertEqual(result.data, self.body)
+
+        result = self.client.get('/colors', headers={
+            'Range': 'bytes=%d-' % len(self.body)})
+        self.assertEqual(result.status_code, 416)
+        self.assertEqual(result.headers['Content-Range'],
+                         'bytes */%d' % len(self.body))
+
+    def test_if_range(self):
+        result = self.client.get('/colors', headers={'Range': 'bytes=10-19',
+                                                     'If-Range': self.etag})
+        self.assertEqual(result.status_code, 206)
+
+        result = self.client.get('/colors', headers={'Range': 'bytes=10-19',
+                                                     'If-Range': '"old"'})
+        self.assertEqual(result.status_code, 200)
+        self.assertEqual(result.data, self.body)
+
+
+################################################################################
+# Metrics and logging
+################################################################################
+
+class MetricsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = app.test_client()
+        connect_to_db(app, 'sqlite://')
+        db.create_all()
+        db.session.add_all([Term(word='fear'), Term(word='pain')])
+        db.session.commit()
+
+        for histogram in metrics.HISTOGRAMS:
+            histogram.clear()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_metrics(self):
+        self.client.get('/words?metrics=test')
+        result = self.client.get('/metrics')
+
+        self.assertEqual(result.status_code, 200)
+        self.assertIn('brainodyssey_request_seconds_count{route="/words"} 1',
+                      result.data)
+        self.assertIn('brainodyssey_request_sql_queries_sum{route="/words"} 1.0',
+                      result.data)
+        self.assertIn('brainodyssey_request_rows_fetched_sum{route="/words"} 2.0',
+                      result.data)
+        self.assertIn('brainodyssey_response_cache_misses_total', result.data)
+
+    def test_rate_limit(self):
+        log_filter = RateLimitFilter(rate=2, period=60)
+        records = [logging.LogRecord('model', logging.DEBUG, 'model.py', 1,
+                                     'Found study %s', (pmid,), None)
+                   for pmid in range(5)]
+
+        self.assertEqual([log_filter.filter(record) for record in records],
+                         [True, True, False, False, False])
+
+        log_filter.period = 0
+        self.assertTrue(log_filter.filter(records[0]))
+        self.assertEqual(records[0].getMessage(),
+                         'Found study 0 (3 similar messages dropped)')
+
+
 if __name__ == "__main__":
 
     unittest.main()
@@ -0,0 +1,167 @@
+"""In-memory graph of the associations between terms and topic clusters.
+
+The terms_clusters table is small and never changes while the server runs, so
+it is loaded once into two compressed sparse row (CSR) adjacency lists, one
+term -> clusters and one cluster -> terms, with words interned as integers.
+The D3 routes then rank and join clusters with array operations instead of
+GROUP BY queries."""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class TopicGraph(object):
+    """Two-way adjacency between terms and topic clusters."""
+
+    def __init__(self, words, word_ids, cluster_ids):
+        """Args:
+            words: sorted list of terms; a term's position is its word ID
+            word_ids: the word ID of each term-cluster association
+            cluster_ids: the cluster ID of each term-cluster association"""
+
+        self.words = words
+        self._ids_by_word = dict((word, i) for i, word in enumerate(words))
+
+        num_clusters = cluster_ids.max() + 1 if len(cluster_ids) else 0
+
+        # Term -> clusters: the clusters of word i are
+        # clusters_by_word[word_offsets[i]:word_offsets[i + 1]], sorted
+        order = np.lexsort((cluster_ids, word_ids))
+        self.clusters_by_word = cluster_ids[order].astype(np.int32)
+        self.word_offsets = np.append(
+            0, np.cumsum(np.bincount(word_ids, minlength=len(words))))
+
+        # Cluster -> terms, likewise, with words sorted alphabetically
+        order = np.lexsort((word_ids, cluster_ids))
+        self.words_by_cluster = word_ids[order].astype(np.int32)
+        self.cluster_offsets = np.append(
+            0, np.cumsum(np.bincount(cluster_ids, minlength=num_clusters)))
+
+    def __repr__(self):
+        """Displays info about the graph."""
+
+        return "<TopicGraph words=%d clusters=%d associations=%d>" % (
+            len(self.words), len(self.cluster_offsets) - 1,
+            len(self.words_by_cluster))
+
+    @classmethod
+    def from_db(cls):
+        """Returns the graph of the terms_clusters table."""
+
+        from model import TermCluster, fetch_columns
+        from sqlalchemy import select
+
+        logger.info("Building topic graph...")
+
+        words, cluster_ids = fetch_columns(
+            select([TermCluster.word, TermCluster.cluster_id]).where(
+                TermCluster.word != None).where(TermCluster.cluster_id != None),
+            [object, np.int64])
+
+        words, word_ids = np.unique(words, return_inverse=True)
+
+        return cls(words.tolist(), word_ids, cluster_ids)
+
+    ### Look up clusters and words ############################################
+
+    def get_word_ids(self, words):
+        """Returns the sorted IDs of the known words among some words."""
+
+        return np.unique(np.array(
+            [self._ids_by_word[word] for word in words
+             if word in self._ids_by_word], dtype=np.int64))
+
+    def get_clusters_of_word(self, word):
+        """Returns the sorted IDs of the clusters associated with a word."""
+
+        word_id = self._ids_by_word.get(word)
+
+        if word_id is None:
+            return np.array([], dtype=np.int32)
+
+        return self.clusters_by_word[self.word_offsets[word_id]:
+                                     self.word_offsets[word_id + 1]]
+
+    def get_top_clusters(self, terms, n=12):
+        """Returns up to n clusters associated with the most of some words, ties
+        going to the lowest cluster ID. As TermCluster.get_top_clusters.
+
+            Args:
+                terms: a list of words ['word', 'word', ...], or a single
+                    string 'word' (returns its first n clusters)
+                n: the number of clusters to return"""
+
+        if not isinstance(terms, list):
+            return self.get_clusters_of_word(terms)[:n].tolist()
+
+        word_ids = self.get_word_ids(terms)
+
+        if not len(word_ids):
+            return []
+
+        counts = np.bincount(self._get_clusters_of_words(word_ids),
+                             minlength=len(self.cluster_offsets) - 1)
+        clusters = np.flatnonzero(counts)
+        order = np.lexsort((clusters, -counts[clusters]))
+
+        return clusters[order[:n]].tolist()
+
+    def get_word_cluster_pairs(self, clusters, words):
+        """Returns (cluster ID, word) tuples for some words and clusters, as
+        TermCluster.get_word_cluster_pairs."""
+
+        word_ids = self.get_word_ids(words)
+        pairs = []
+
+        for cluster in clusters:
+            cluster_words = self._get_words_of_cluster(cluster)
+            for word_id in cluster_words[np.in1d(cluster_words, word_ids)]:
+                pairs.append((int(cluster), self.words[word_id]))
+
+        return pairs
+
+    def get_words_in_cluster(self, cluster):
+        """Returns the words associated with a cluster, alphabetically.
+
+            Args: a cluster ID (an integer, or a string of one)"""
+
+        return [self.words[word_id]
+                for word_id in self._get_words_of_cluster(cluster)]
+
+    def _get_clusters_of_words(self, word_ids):
+        """Returns the concatenated clusters of some word IDs."""
+
+        return np.concatenate([self.clusters_by_word[self.word_offsets[i]:
+                                                     self.word_offsets[i + 1]]
+                               for i in word_ids])
+
+    def _get_words_of_cluster(self, cluster):
+        """Returns the word IDs of a cluster (none for an unknown cluster)."""
+
+        try:
+            cluster = int(cluster)
+        except (TypeError, ValueError):
+            return np.array([], dtype=np.int32)
+
+        if not 0 <= cluster < len(self.cluster_offsets) - 1:
+            return np.array([], dtype=np.int32)
+
+        return self.words_by_cluster[self.cluster_offsets[cluster]:
+                                     self.cluster_offsets[cluster + 1]]
+
+
+_topic_graph = None
+
+
+def get_topic_graph():
+    """Returns the shared TopicGraph, building it from the database."""
+
+    global _topic_graph
+
+    if _topic_graph is None:
+        _topic_graph = TopicGraph.from_db()
+
+    return _topic_graph